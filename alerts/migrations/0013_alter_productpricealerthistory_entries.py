@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("alerts", "0012_auto_20190930_1947"),
+        ("solotodo", "0088_entityhistory_last_seen"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="productpricealerthistory",
+            name="entries",
+            field=models.ManyToManyField(
+                blank=True, db_constraint=False, to="solotodo.entityhistory"
+            ),
+        ),
+    ]
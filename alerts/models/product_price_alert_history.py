@@ -9,7 +9,8 @@ class ProductPriceAlertHistory(models.Model):
         ProductPriceAlert,
         on_delete=models.CASCADE,
         related_name='histories')
-    entries = models.ManyToManyField(EntityHistory, blank=True)
+    entries = models.ManyToManyField(EntityHistory, blank=True,
+                                     db_constraint=False)
 
     timestamp = models.DateTimeField(auto_now_add=True)
 
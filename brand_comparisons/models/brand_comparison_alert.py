@@ -188,10 +188,9 @@ class BrandComparisonAlert(models.Model):
 
         prev_registry = EntityHistory.objects.filter(
             entity=entity_1,
-            timestamp__gte=date_from,
-            timestamp__lte=self.last_check,
             cell_monthly_payment__isnull=True
-        ).order_by('-timestamp')
+        ).filter_seen_between(date_from, self.last_check) \
+            .order_by('-timestamp')
 
         if not prev_registry:
             prev_registry = None
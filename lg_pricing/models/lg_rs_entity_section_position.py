@@ -50,14 +50,14 @@ class LgRsEntitySectionPosition(models.Model):
             entity_history__entity__store__in=stores,
             entity_history__entity__category__in=categories,
             entity_history__entity__product__isnull=False
-        ).annotate(date=TruncDate('entity_history__timestamp'))
+        ).annotate(date=TruncDate('timestamp'))
 
         last_synchronization = cls.objects.aggregate(Max('date'))['date__max']
 
         if last_synchronization:
             print('Synchronizing since {}'.format(last_synchronization))
             positions_to_synchronize = positions_to_synchronize.filter(
-                entity_history__timestamp__gte=last_synchronization
+                timestamp__gte=last_synchronization
             )
         else:
             print('Synchronizing from scratch')
@@ -67,7 +67,7 @@ class LgRsEntitySectionPosition(models.Model):
         latest_positions = positions_to_synchronize\
             .order_by('entity_history__entity',
                       'section',
-                      'entity_history__timestamp')\
+                      'timestamp')\
             .select_related('entity_history')
         latest_positions_dict = {}
 
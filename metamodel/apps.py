@@ -0,0 +1,13 @@
+from django.apps import AppConfig
+
+
+class MetamodelConfig(AppConfig):
+    name = "metamodel"
+
+    def ready(self):
+        # Import the custom functions of settings.METAMODEL once, instead
+        # of on every document or representation that uses them
+        from metamodel.custom_functions import REGISTRIES
+
+        for registry in REGISTRIES:
+            registry.load()
@@ -0,0 +1,112 @@
+import importlib
+import time
+from collections import Counter
+
+from django.conf import settings
+
+
+def for_models(*model_names):
+    """
+    Decorator for the custom functions listed in settings.METAMODEL that
+    only handle the given metamodels (by name), so their registry only
+    calls them for those. Undecorated functions are called for every
+    metamodel.
+    """
+
+    def decorator(function):
+        function.metamodel_model_names = frozenset(model_names)
+        return function
+
+    return decorator
+
+
+class CustomFunctionRegistry:
+    """
+    The custom functions of one of the lists of settings.METAMODEL
+    (e.g. UNICODE_FUNCTIONS), imported once and dispatched by metamodel
+    name (see for_models). Keeps the number of calls and the time spent
+    in every function.
+    """
+
+    def __init__(self, setting_name):
+        self.setting_name = setting_name
+        self._functions = None
+        self._functions_by_model_name = {}
+        self.call_counts = Counter()
+        self.call_times = Counter()
+
+    def load(self):
+        if self._functions is not None:
+            return
+
+        functions = []
+        for path in settings.METAMODEL.get(self.setting_name, []):
+            path_components = path.split(".")
+            module = importlib.import_module(".".join(path_components[:-1]))
+            functions.append((path, getattr(module, path_components[-1])))
+
+        self._functions = functions
+
+    def functions_for(self, model_name):
+        """
+        Returns the (path, function) pairs that handle the given metamodel,
+        in the order of the setting.
+        """
+        try:
+            return self._functions_by_model_name[model_name]
+        except KeyError:
+            pass
+
+        self.load()
+
+        functions = tuple(
+            (path, function)
+            for path, function in self._functions
+            if model_name in getattr(function, "metamodel_model_names", [model_name])
+        )
+        self._functions_by_model_name[model_name] = functions
+
+        return functions
+
+    def call(self, model_name, *args):
+        """
+        Calls the functions that handle the given metamodel with the given
+        arguments, yielding their results. The functions after the one
+        whose result is used may be skipped by not consuming the rest of
+        the results.
+        """
+        for path, function in self.functions_for(model_name):
+            start = time.perf_counter()
+            try:
+                result = function(*args)
+            finally:
+                self.call_counts[path] += 1
+                self.call_times[path] += time.perf_counter() - start
+
+            yield result
+
+    def stats(self):
+        """
+        Returns a dict of function path => (calls, seconds)
+        """
+        return {
+            path: (self.call_counts[path], self.call_times[path])
+            for path in self.call_counts
+        }
+
+    def reset_stats(self):
+        self.call_counts.clear()
+        self.call_times.clear()
+
+
+additional_elasticsearch_fields_functions = CustomFunctionRegistry(
+    "ADDITIONAL_ELASTICSEARCH_FIELDS_FUNCTIONS"
+)
+unicode_functions = CustomFunctionRegistry("UNICODE_FUNCTIONS")
+ordering_functions = CustomFunctionRegistry("ORDERING_FUNCTIONS")
+
+REGISTRIES = [
+    additional_elasticsearch_fields_functions,
+    unicode_functions,
+    ordering_functions,
+]
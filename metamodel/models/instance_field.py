@@ -53,7 +53,9 @@ class InstanceField(models.Model):
                 except InstanceField.DoesNotExist:
                     pass
 
-        return super(InstanceField, self).save(*args, **kwargs)
+        result = super(InstanceField, self).save(*args, **kwargs)
+        self.clear_parent_instance_fields_cache()
+        return result
 
     def delete(self, *args, **kwargs):
         if settings.METAMODEL['DEBUG']:
@@ -64,6 +66,14 @@ class InstanceField(models.Model):
             self.value.delete()
 
         super(InstanceField, self).delete(*args, **kwargs)
+        self.clear_parent_instance_fields_cache()
+
+    def clear_parent_instance_fields_cache(self):
+        # Only the parent instance this field was created or loaded with
+        # knows about the change, other instances of it keep their cache
+        # (see InstanceModel.clear_instance_fields_cache)
+        if InstanceField.parent.is_cached(self):
+            self.parent.clear_instance_fields_cache()
 
     @classmethod
     def get_or_create_with_value(cls, parent, field, value):
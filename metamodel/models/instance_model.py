@@ -3,7 +3,6 @@ import json
 import time
 from datetime import date, datetime, timedelta
 from decimal import Decimal, InvalidOperation
-import importlib
 
 from PIL import Image
 from django.core.files.uploadedfile import InMemoryUploadedFile
@@ -14,13 +13,50 @@ from django.core.files import File
 from django.core.files.storage import default_storage
 from django.db import models, IntegrityError
 from django.db.models import Q, FileField
+from django.db.models.query import ModelIterable
 from django.db.models.fields.files import FieldFile
+from metamodel.custom_functions import (
+    additional_elasticsearch_fields_functions,
+    ordering_functions,
+    unicode_functions,
+)
 from metamodel.models import MetaModel, MetaField
 from metamodel.signals import instance_model_saved
 from metamodel.utils import strip_whitespace, trim, convert_image_to_inmemoryfile
 
 
 class InstanceModelQuerySet(models.QuerySet):
+    # Levels of instance fields loaded when the queryset is evaluated, see
+    # prefetch_instance_fields
+    _prefetch_instance_fields_depth = 0
+
+    def prefetch_instance_fields(self, depth=1):
+        """
+        Populates the field cache of the instance models of the queryset
+        (and of their values, up to the given depth, None for the whole
+        trees) when it is evaluated, using one query per level. See
+        InstanceModel.prefetch_instance_fields.
+        """
+        clone = self._chain()
+        clone._prefetch_instance_fields_depth = depth
+        return clone
+
+    def _clone(self):
+        clone = super(InstanceModelQuerySet, self)._clone()
+        clone._prefetch_instance_fields_depth = self._prefetch_instance_fields_depth
+        return clone
+
+    def _fetch_all(self):
+        prefetch = self._result_cache is None and (
+            self._prefetch_instance_fields_depth != 0
+        )
+
+        super(InstanceModelQuerySet, self)._fetch_all()
+
+        if prefetch and self._iterable_class is ModelIterable:
+            InstanceModel.prefetch_instance_fields(
+                self._result_cache, self._prefetch_instance_fields_depth
+            )
 
     def get_field_values(self, field):
         from metamodel.models import InstanceField
@@ -159,12 +195,8 @@ class InstanceModel(models.Model):
     def get_unicode_representation(self):
         # 1. Custom logic for unicode representation?
         if hasattr(settings, "METAMODEL"):
-            unicode_functions_paths = settings.METAMODEL.get("UNICODE_FUNCTIONS", [])
-            for path in unicode_functions_paths:
-                path_components = path.split(".")
-                module = importlib.import_module(".".join(path_components[:-1]))
-                unicode_function = getattr(module, path_components[-1])
-                result = unicode_function(self)
+            model_name = MetaModel.get_model_by_id(self.model_id).name
+            for result in unicode_functions.call(model_name, self):
                 if result:
                     return strip_whitespace(result)
 
@@ -199,6 +231,13 @@ class InstanceModel(models.Model):
                                 "".format(instance_field.field.name, self.model)
                             )
 
+            if self.id:
+                # Loads the whole tree of the instance model at once, as the
+                # unicode template, the custom functions and the receivers
+                # of instance_model_saved (e.g. the indexing of the products)
+                # follow its relations
+                InstanceModel.prefetch_instance_fields([self], depth=None)
+
             self.unicode_representation = self.get_unicode_representation()
 
             if not self.is_model_primitive():
@@ -386,6 +425,8 @@ class InstanceModel(models.Model):
         except MetaField.DoesNotExist:
             return object.__setattr__(self, name, value)
 
+        self.clear_instance_fields_cache()
+
     @classmethod
     def get_metafield_by_parent_model_id_and_field_name(cls, model_id, field_name):
 
@@ -406,6 +447,110 @@ class InstanceModel(models.Model):
             meta_field_dict = get_metafields_dict(refresh_cache=True)
             return meta_field_dict[(model_id, field_name)]
 
+    def _get_instance_fields(self, meta_field):
+        # Instance fields of the given meta field, loaded with one query
+        # for all the fields on first access (or by prefetch_instance_fields)
+        instance_fields_cache = self.__dict__.get("_instance_fields_cache")
+
+        if instance_fields_cache is None:
+            instance_fields_cache = self._set_instance_fields_cache(
+                self.fields.select_related("value__model")
+            )
+
+        return instance_fields_cache.get(meta_field.id, [])
+
+    def _set_instance_fields_cache(self, instance_fields):
+        instance_fields_cache = {}
+        for instance_field in instance_fields:
+            instance_fields_cache.setdefault(instance_field.field_id, []).append(
+                instance_field
+            )
+
+        super(InstanceModel, self).__setattr__(
+            "_instance_fields_cache", instance_fields_cache
+        )
+        return instance_fields_cache
+
+    def clear_instance_fields_cache(self):
+        """
+        Discards the cached instance fields, so they are loaded again on
+        the next dynamic attribute access. The setters of the fields already
+        do this, call it after modifying the fields of the instance model
+        through other means (e.g. InstanceField querysets).
+        """
+        self.__dict__.pop("_instance_fields_cache", None)
+
+    def refresh_from_db(self, *args, **kwargs):
+        self.clear_instance_fields_cache()
+        return super(InstanceModel, self).refresh_from_db(*args, **kwargs)
+
+    @staticmethod
+    def prefetch_instance_fields(instance_models, depth=1):
+        """
+        Populates the field cache of the given instance models using one
+        query for the instance fields of all of them, then does the same
+        for the non primitive values of those fields, up to the given
+        depth (None to follow the relations all the way down). Used to
+        load the trees of instance models used by a serialization, an
+        indexing or a template rendering in a handful of queries instead
+        of one for every dynamic attribute of every instance model.
+        """
+        from metamodel.models import InstanceField
+
+        primitive_models_dict = MetaModel.get_primitive_models_dict()
+        # Instance model id => its instance fields, for the ones already
+        # loaded
+        loaded_instance_fields = {}
+        level = 0
+
+        # Instance model id => instances of it pending to be loaded
+        frontier = {}
+        for instance_model in instance_models:
+            if instance_model.model_id not in primitive_models_dict:
+                frontier.setdefault(instance_model.id, []).append(instance_model)
+
+        while frontier and (depth is None or level < depth):
+            instance_fields_by_parent_id = {
+                instance_model_id: [] for instance_model_id in frontier
+            }
+
+            # The default ordering is kept as it defines the order of the
+            # values of the multiple fields
+            instance_fields = InstanceField.objects.filter(
+                parent__in=list(frontier)
+            ).select_related("value__model")
+
+            for instance_field in instance_fields:
+                instance_field.parent = frontier[instance_field.parent_id][0]
+                instance_fields_by_parent_id[instance_field.parent_id].append(
+                    instance_field
+                )
+
+            next_frontier = {}
+
+            for instance_model_id, parent_instance_fields in (
+                instance_fields_by_parent_id.items()
+            ):
+                loaded_instance_fields[instance_model_id] = parent_instance_fields
+
+                for instance_model in frontier[instance_model_id]:
+                    instance_model._set_instance_fields_cache(parent_instance_fields)
+
+                for instance_field in parent_instance_fields:
+                    value = instance_field.value
+                    if value.model_id in primitive_models_dict:
+                        continue
+
+                    if value.id in loaded_instance_fields:
+                        value._set_instance_fields_cache(
+                            loaded_instance_fields[value.id]
+                        )
+                    else:
+                        next_frontier.setdefault(value.id, []).append(value)
+
+            frontier = next_frontier
+            level += 1
+
     def __getattr__(self, item):
         # Prevent clashing with django's lookups (e.g. "_model_cache")
         if item.startswith("_"):
@@ -432,7 +577,7 @@ class InstanceModel(models.Model):
             self.model_id, item
         )
 
-        instance_fields = self.fields.filter(field=meta_field).select_related()
+        instance_fields = self._get_instance_fields(meta_field)
 
         if meta_field.multiple:
             if not self.is_model_primitive():
@@ -497,8 +642,6 @@ class InstanceModel(models.Model):
         return self.unicode_value
 
     def compute_ordering_value(self):
-        from metamodel.models import InstanceField
-
         if self.is_model_primitive():
             result = self.value
             model_name = self.model.name
@@ -516,15 +659,8 @@ class InstanceModel(models.Model):
                 return result.name
 
         if hasattr(settings, "METAMODEL"):
-            ordering_valur_function_path = settings.METAMODEL.get(
-                "ORDERING_FUNCTIONS", []
-            )
-
-            for path in ordering_valur_function_path:
-                path_components = path.split(".")
-                module = importlib.import_module(".".join(path_components[:-1]))
-                ordering_value_function = getattr(module, path_components[-1])
-                result = ordering_value_function(self)
+            model_name = MetaModel.get_model_by_id(self.model_id).name
+            for result in ordering_functions.call(model_name, self):
                 if result:
                     return result
 
@@ -540,10 +676,13 @@ class InstanceModel(models.Model):
                 # this can fail because Numbers can be so big
                 field_ordering_value = field_value.compute_ordering_value()
             else:
-                try:
-                    field_instance_model = self.fields.get(field__name=field_name).value
-                    field_ordering_value = field_instance_model.get_ordering_value()
-                except InstanceField.DoesNotExist:
+                meta_field = self.get_metafield_by_parent_model_id_and_field_name(
+                    self.model_id, field_name
+                )
+                instance_fields = self._get_instance_fields(meta_field)
+                if instance_fields:
+                    field_ordering_value = instance_fields[0].value.get_ordering_value()
+                else:
                     field_ordering_value = ""
                 if isinstance(field_ordering_value, str):
                     len_field = len(field_ordering_value)
@@ -623,55 +762,149 @@ class InstanceModel(models.Model):
 
         return cloned_instance
 
-    def elasticsearch_document(self):
+    def elasticsearch_document(self, builder=None):
         """
         Generates the elasticsearch document of the given InstanceModel
         based on its fields and unicode representation and automatically
         following all of its relations.
+
+        Returns a (document, keywords, related_instance_model_ids) tuple.
+        Pass an ElasticsearchDocumentBuilder to reuse the documents it
+        already built.
         """
+        if builder is None:
+            builder = ElasticsearchDocumentBuilder()
 
-        def sanitize_value(value):
-            serialized_value = value
+        return builder.build([self])[0]
 
-            if type(value) == Decimal:
-                serialized_value = float(value)
+    @staticmethod
+    def elasticsearch_documents(instance_models):
+        """
+        Batch version of elasticsearch_document, returns the documents of
+        the given instance models in the same order.
+        """
+        return ElasticsearchDocumentBuilder().build(instance_models)
 
-            try:
-                json.dumps(serialized_value)
-                return serialized_value
-            except TypeError:
-                raise
+    @staticmethod
+    def elasticsearch_document_from_snapshot(instance_id, snapshot):
+        """
+        Generates the elasticsearch document of the InstanceModel with the
+        given id using a MetamodelSnapshot instead of the database.
+        """
+        return snapshot.elasticsearch_document(instance_id)
 
-        if not self:
-            return {}, [], []
+    class Meta:
+        app_label = "metamodel"
+        ordering = ("decimal_value", "unicode_value", "unicode_representation")
 
-        result = {"id": self.id, "unicode": str(self)}
 
-        keywords = result["unicode"].split()
-        related_instance_model_ids = []
+class ElasticsearchDocumentBuilder:
+    """
+    Builds the Elasticsearch documents of instance models (see
+    InstanceModel.elasticsearch_document).
+
+    The instance fields are loaded in batches into the field cache of the
+    instance models (see InstanceModel.prefetch_instance_fields), one query
+    for every level of the relations of all the instance models being
+    built, reusing the caches that are already filled, and the
+    sub-documents are memoized by instance model id, so building the
+    documents of N instance models requires as many queries as the depth
+    of their relations instead of one per related instance model.
+
+    The memoized documents are shared between the documents that include
+    them, so use a builder for a single build session (e.g. a chunk of
+    products being indexed).
+    """
+
+    def __init__(self):
+        # Instance model id => (document, keywords, related ids)
+        self.documents = {}
+
+    def build(self, instance_models):
+        instance_models = list(instance_models)
+        self.load(
+            [
+                instance_model
+                for instance_model in instance_models
+                if "_instance_fields_cache" not in instance_model.__dict__
+            ]
+        )
 
-        meta_fields = MetaModel.get_metafields_by_model_id(self.model_id)
+        result = []
+        for instance_model in instance_models:
+            document, keywords, related_instance_model_ids = self.document(
+                instance_model
+            )
+            # The caller may modify the documents, don't give it the
+            # memoized ones
+            result.append(
+                (dict(document), list(keywords), list(related_instance_model_ids))
+            )
 
-        instance_fields = self.fields.select_related()
+        return result
 
-        instance_values_dict = {
-            instance_field.field: instance_field.value
-            for instance_field in instance_fields
-        }
+    def load(self, instance_models):
+        # Fills the instance field cache of the instance models whose
+        # documents are pending and of all of their relations, see
+        # InstanceModel.prefetch_instance_fields
+        InstanceModel.prefetch_instance_fields(
+            [
+                instance_model
+                for instance_model in instance_models
+                if instance_model.id not in self.documents
+            ],
+            depth=None,
+        )
 
-        for meta_field in meta_fields:
-            if meta_field.multiple:
-                m2m_documents = []
+    def document(self, instance_model):
+        try:
+            return self.documents[instance_model.id]
+        except KeyError:
+            pass
+
+        if instance_model.is_model_primitive():
+            # Primitive values (e.g. of multiple fields) don't have fields
+            meta_fields = []
+            instance_fields_cache = {}
+        else:
+            meta_fields = MetaModel.get_metafields_by_model_id(
+                instance_model.model_id
+            )
 
-                m2m_instance_fields = instance_fields.filter(
-                    field=meta_field
-                ).select_related()
+            if "_instance_fields_cache" not in instance_model.__dict__:
+                self.load([instance_model])
+
+            instance_fields_cache = instance_model._instance_fields_cache
+
+            # Instance models that were already cached (e.g. by a shallow
+            # prefetch) may have values that are not, load all of them
+            # at once instead of one by one when building their documents
+            self.load(
+                [
+                    instance_field.value
+                    for instance_fields in instance_fields_cache.values()
+                    for instance_field in instance_fields
+                    if not instance_field.value.is_model_primitive()
+                    and "_instance_fields_cache" not in instance_field.value.__dict__
+                ]
+            )
+
+        result = {"id": instance_model.id, "unicode": str(instance_model)}
+
+        keywords = result["unicode"].split()
+        related_instance_model_ids = []
 
-                if not m2m_instance_fields:
+        for meta_field in meta_fields:
+            instance_fields = instance_fields_cache.get(meta_field.id, [])
+
+            if meta_field.multiple:
+                if not instance_fields:
                     continue
 
-                for m2m_instance_field in m2m_instance_fields:
-                    m2m_document = m2m_instance_field.value.elasticsearch_document()
+                m2m_documents = []
+
+                for m2m_instance_field in instance_fields:
+                    m2m_document = self.document(m2m_instance_field.value)
 
                     m2m_documents.append(m2m_document[0])
                     keywords.extend(m2m_document[1])
@@ -679,10 +912,10 @@ class InstanceModel(models.Model):
 
                 result[meta_field.name] = m2m_documents
             else:
-                try:
-                    instance_value = instance_values_dict[meta_field]
-                except KeyError:
-                    instance_value = None
+                # The last value wins if a single field has several
+                instance_value = None
+                if instance_fields:
+                    instance_value = instance_fields[-1].value
 
                 if meta_field.model.name == "FileField":
                     if instance_value:
@@ -692,15 +925,15 @@ class InstanceModel(models.Model):
                     if value:
                         value = instance_value.value
 
-                    sanitized_value = sanitize_value(value)
+                    sanitized_value = self.sanitize_value(value)
                     result[meta_field.name] = sanitized_value
                     keywords.append(str(sanitized_value))
                 elif instance_value:
-                    fk_result = instance_value.elasticsearch_document()
+                    fk_result = self.document(instance_value)
                     for fk_key, fk_value in fk_result[0].items():
                         try:
-                            result[meta_field.name + "_" + fk_key] = sanitize_value(
-                                fk_value
+                            result[meta_field.name + "_" + fk_key] = (
+                                self.sanitize_value(fk_value)
                             )
                         except TypeError:
                             pass
@@ -709,125 +942,26 @@ class InstanceModel(models.Model):
                     related_instance_model_ids.append(instance_value.id)
                     related_instance_model_ids.extend(fk_result[2])
 
-        for function_path in settings.METAMODEL[
-            "ADDITIONAL_ELASTICSEARCH_FIELDS_FUNCTIONS"
-        ]:
-            path_components = function_path.split(".")
-            f_module = importlib.import_module(".".join(path_components[:-1]))
-            additional_es_fields_function = getattr(f_module, path_components[-1])
-            additional_fields = additional_es_fields_function(result, self.model.name)
+        model_name = MetaModel.get_model_by_id(instance_model.model_id).name
+
+        for additional_fields in additional_elasticsearch_fields_functions.call(
+            model_name, result, model_name
+        ):
             if additional_fields:
                 result.update(additional_fields)
 
-        return result, keywords, related_instance_model_ids
-
-    @staticmethod
-    def elasticsearch_document_from_dict(instance_id, metamodel_dict):
-        def sanitize_value(instance_model, model_name):
-            if instance_model is None:
-                return None
-
-            if model_name == "BooleanField":
-                return bool(Decimal(instance_model["decimal_value"]))
-            if model_name == "CharField":
-                return instance_model["unicode_value"]
-            if model_name == "DateField":
-                return date.fromordinal(int(instance_model["decimal_value"]))
-            if model_name == "DateTimeField":
-                epoch = datetime.utcfromtimestamp(0)
-                delta = timedelta(seconds=int(instance_model["decimal_value"]))
-                return epoch + delta
-            if model_name == "DecimalField":
-                return float(instance_model["decimal_value"])
-            if model_name == "FileField":
-                return FieldFile(
-                    default_storage.open(instance_model["unicode_value"]),
-                    FileField(),
-                    instance_model["unicode_value"],
-                )
-            if model_name == "IntegerField":
-                return int(instance_model["decimal_value"])
-            else:
-                raise Exception("Invalid primitive model name: " + model_name)
-
-        instance = metamodel_dict["IM_" + str(instance_id)]
-
-        result = {"id": instance["id"], "unicode": instance["unicode_representation"]}
-
-        keywords = result["unicode"].split()
-        related_instance_model_ids = []
+        document = (result, keywords, related_instance_model_ids)
+        self.documents[instance_model.id] = document
 
-        meta_fields = metamodel_dict["MM_" + str(instance["model_id"])]["fields"]
-        instance_fields = metamodel_dict["IM_" + str(instance["id"])]["fields"]
-
-        instance_values_dict = {
-            instance_field["field_id"]: metamodel_dict[
-                "IM_" + str(instance_field["value_id"])
-            ]
-            for instance_field in instance_fields
-        }
+        return document
 
-        for meta_field in meta_fields:
-            if meta_field["multiple"]:
-                m2m_documents = []
-
-                m2m_instance_fields = list(
-                    filter(lambda x: x["field_id"] == meta_field["id"], instance_fields)
-                )
-
-                if not m2m_instance_fields:
-                    continue
-
-                for m2m_instance_field in m2m_instance_fields:
-                    m2m_document = InstanceModel.elasticsearch_document_from_dict(
-                        m2m_instance_field["value_id"], metamodel_dict
-                    )
-
-                    m2m_documents.append(m2m_document[0])
-                    keywords.extend(m2m_document[1])
-                    related_instance_model_ids.extend(m2m_document[2])
-
-                result[meta_field["name"]] = m2m_documents
-            else:
-                instance_value = instance_values_dict.get(meta_field["id"], None)
-                model = metamodel_dict["MM_" + str(meta_field["model_id"])]
-
-                if model["name"] == "FileField":
-                    if instance_value:
-                        result[meta_field["name"]] = instance_value["unicode_value"]
-                elif model["name"] in MetaModel.NAME_INPUT_TYPES_DICT:
-                    # Is primitive
-                    sanitized_value = sanitize_value(instance_value, model["name"])
-                    result[meta_field["name"]] = sanitized_value
-                    keywords.append(str(sanitized_value))
-                elif instance_value:
-                    fk_result = InstanceModel.elasticsearch_document_from_dict(
-                        instance_value["id"], metamodel_dict
-                    )
-                    for fk_key, fk_value in fk_result[0].items():
-                        try:
-                            result[meta_field["name"] + "_" + fk_key] = fk_value
-                        except TypeError:
-                            pass
-
-                    keywords.extend(fk_result[1])
-                    related_instance_model_ids.append(instance_value["id"])
-                    related_instance_model_ids.extend(fk_result[2])
-
-        for function_path in settings.METAMODEL[
-            "ADDITIONAL_ELASTICSEARCH_FIELDS_FUNCTIONS"
-        ]:
-            path_components = function_path.split(".")
-            f_module = importlib.import_module(".".join(path_components[:-1]))
-            additional_es_fields_function = getattr(f_module, path_components[-1])
-            additional_fields = additional_es_fields_function(
-                result, metamodel_dict["MM_" + str(instance["model_id"])]["name"]
-            )
-            if additional_fields:
-                result.update(additional_fields)
+    @staticmethod
+    def sanitize_value(value):
+        serialized_value = value
 
-        return result, keywords, related_instance_model_ids
+        if type(value) == Decimal:
+            serialized_value = float(value)
 
-    class Meta:
-        app_label = "metamodel"
-        ordering = ("decimal_value", "unicode_value", "unicode_representation")
+        # Raises TypeError if the value can't be serialized
+        json.dumps(serialized_value)
+        return serialized_value
@@ -0,0 +1,389 @@
+import json
+import os
+import shutil
+from array import array
+from datetime import date, datetime, timedelta
+
+import numpy as np
+from django.db import connections, router, transaction
+
+from metamodel.custom_functions import additional_elasticsearch_fields_functions
+
+
+def _exact_searchsorted(sorted_ids, ids, column):
+    # Positions of ids in sorted_ids, all of them must be present
+    indexes = np.searchsorted(sorted_ids, ids)
+    found = indexes < len(sorted_ids)
+    found[found] = sorted_ids[indexes[found]] == ids[found]
+
+    if not found.all():
+        raise ValueError(
+            "{} references instance models missing from the snapshot "
+            "(e.g. {})".format(column, ids[~found][:10].tolist())
+        )
+
+    return indexes
+
+
+class MetamodelSnapshot:
+    """
+    Compact read only snapshot of the metamodel used to build the
+    Elasticsearch documents of instance models offline (see the
+    batch_index_es_products command).
+
+    The snapshot is a directory with one .npy file per column, loaded with
+    numpy memory mapping so the worker processes share the pages of the
+    snapshot instead of each one holding a copy of the metamodel:
+
+    * instance_model_ids: sorted instance model ids, their position in
+      this array is the index used by every other instance model column
+    * instance_model_model_ids, instance_model_decimal_values (NaN for
+      NULL), and the unicode_value and unicode_representation string
+      columns, stored as an UTF-8 blob plus n + 1 offsets (empty strings
+      stand for NULL, which is what InstanceModel.save stores)
+    * primitive_unicode: string column with str() of the primitive
+      instance models, as rendered from the database values at build time
+      (e.g. keeping the decimal places of the DecimalField values), empty
+      for the other ones
+    * instance_field_starts: n + 1 offsets of the instance fields of every
+      instance model in the instance_field_field_ids and
+      instance_field_value_indexes columns, sorted by parent and then by
+      the default InstanceField ordering (so the values of the multiple
+      fields keep their order)
+
+    The metamodels and metafields are few, so they are stored as JSON.
+    """
+
+    FORMAT_VERSION = 2
+    METADATA_FILENAME = "metadata.json"
+    STRING_COLUMNS = ["unicode_value", "unicode_representation", "primitive_unicode"]
+    CHUNK_SIZE = 20000
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(os.path.join(path, self.METADATA_FILENAME)) as f:
+            metadata = json.load(f)
+
+        if metadata["version"] != self.FORMAT_VERSION:
+            raise ValueError(
+                "Unsupported metamodel snapshot version {}, rebuild it".format(
+                    metadata["version"]
+                )
+            )
+
+        self.model_names = {
+            int(model_id): name for model_id, name in metadata["models"].items()
+        }
+        self.meta_fields_by_model_id = {}
+        for meta_field in metadata["meta_fields"]:
+            self.meta_fields_by_model_id.setdefault(meta_field["parent_id"], []).append(
+                meta_field
+            )
+
+        self.instance_model_ids = self._load("instance_model_ids")
+        self.instance_model_model_ids = self._load("instance_model_model_ids")
+        self.instance_model_decimal_values = self._load(
+            "instance_model_decimal_values"
+        )
+        self.strings = {
+            column: (self._load(column + "_offsets"), self._load(column + "_data"))
+            for column in self.STRING_COLUMNS
+        }
+        self.instance_field_starts = self._load("instance_field_starts")
+        self.instance_field_field_ids = self._load("instance_field_field_ids")
+        self.instance_field_value_indexes = self._load("instance_field_value_indexes")
+
+    def _load(self, name):
+        return np.load(os.path.join(self.path, name + ".npy"), mmap_mode="r")
+
+    @classmethod
+    def build(cls, path):
+        """
+        Creates (or replaces) the snapshot in the given directory straight
+        from values() queries and returns it. The queries run in a single
+        REPEATABLE READ transaction (on PostgreSQL), so the instance fields
+        always reference instance models of the snapshot.
+        """
+        from metamodel.models import InstanceModel
+
+        connection = connections[router.db_for_read(InstanceModel)]
+        # The isolation level can't be changed by a nested atomic block
+        set_isolation_level = (
+            connection.vendor == "postgresql" and not connection.in_atomic_block
+        )
+
+        with transaction.atomic(using=connection.alias):
+            if set_isolation_level:
+                # Must be the first statement of the transaction
+                with connection.cursor() as cursor:
+                    cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+
+            cls._build(path)
+
+        return cls(path)
+
+    @classmethod
+    def _build(cls, path):
+        from metamodel.models import MetaModel, MetaField, InstanceModel, InstanceField
+
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        def save(name, values, dtype):
+            np.save(os.path.join(tmp_path, name + ".npy"), np.asarray(values, dtype))
+
+        metadata = {
+            "version": cls.FORMAT_VERSION,
+            "models": {
+                model_id: name
+                for model_id, name in MetaModel.objects.values_list("id", "name")
+            },
+            "meta_fields": [
+                {
+                    "id": meta_field_id,
+                    "parent_id": parent_id,
+                    "model_id": model_id,
+                    "name": name,
+                    "multiple": multiple,
+                }
+                for meta_field_id, parent_id, model_id, name, multiple in (
+                    MetaField.objects.values_list(
+                        "id", "parent_id", "model_id", "name", "multiple"
+                    )
+                )
+            ],
+        }
+
+        primitive_model_names = {
+            model_id: name
+            for model_id, name in metadata["models"].items()
+            if name in MetaModel.NAME_INPUT_TYPES_DICT
+        }
+
+        print("Loading instance models")
+        ids = array("q")
+        model_ids = array("q")
+        decimal_values = array("d")
+        string_offsets = {column: array("q", [0]) for column in cls.STRING_COLUMNS}
+        string_data = {column: bytearray() for column in cls.STRING_COLUMNS}
+
+        instance_models = (
+            InstanceModel.objects.order_by("pk")
+            .values_list(
+                "id",
+                "model_id",
+                "decimal_value",
+                "unicode_value",
+                "unicode_representation",
+            )
+            .iterator(chunk_size=cls.CHUNK_SIZE)
+        )
+
+        for (
+            instance_model_id,
+            model_id,
+            decimal_value,
+            unicode_value,
+            unicode_representation,
+        ) in instance_models:
+            ids.append(instance_model_id)
+            model_ids.append(model_id)
+            decimal_values.append(
+                float("nan") if decimal_value is None else float(decimal_value)
+            )
+
+            primitive_unicode = ""
+            model_name = primitive_model_names.get(model_id)
+            if model_name == "FileField":
+                # Avoids opening the file, str() of a FieldFile is its name
+                primitive_unicode = unicode_value or ""
+            elif model_name:
+                primitive_unicode = str(
+                    InstanceModel(
+                        model_id=model_id,
+                        decimal_value=decimal_value,
+                        unicode_value=unicode_value,
+                    )
+                )
+
+            strings = [unicode_value, unicode_representation, primitive_unicode]
+            for column, value in zip(cls.STRING_COLUMNS, strings):
+                string_data[column].extend((value or "").encode("utf-8"))
+                string_offsets[column].append(len(string_data[column]))
+
+        save("instance_model_ids", ids, np.int64)
+        save("instance_model_model_ids", model_ids, np.int64)
+        save("instance_model_decimal_values", decimal_values, np.float64)
+        for column in cls.STRING_COLUMNS:
+            save(column + "_offsets", string_offsets[column], np.int64)
+            save(column + "_data", string_data[column], np.uint8)
+
+        ids = np.asarray(ids, np.int64)
+        del model_ids, decimal_values, string_offsets, string_data
+
+        print("Loading instance fields")
+        parent_ids = array("q")
+        field_ids = array("q")
+        value_ids = array("q")
+
+        instance_fields = (
+            InstanceField.objects.order_by("parent_id", "field", "value")
+            .values_list("parent_id", "field_id", "value_id")
+            .iterator(chunk_size=cls.CHUNK_SIZE)
+        )
+
+        for parent_id, field_id, value_id in instance_fields:
+            parent_ids.append(parent_id)
+            field_ids.append(field_id)
+            value_ids.append(value_id)
+
+        parent_indexes = _exact_searchsorted(
+            ids, np.asarray(parent_ids, np.int64), "InstanceField.parent"
+        )
+        save(
+            "instance_field_starts",
+            np.searchsorted(parent_indexes, np.arange(len(ids) + 1)),
+            np.int64,
+        )
+        save("instance_field_field_ids", field_ids, np.int64)
+        save(
+            "instance_field_value_indexes",
+            _exact_searchsorted(
+                ids, np.asarray(value_ids, np.int64), "InstanceField.value"
+            ),
+            np.int64,
+        )
+
+        with open(os.path.join(tmp_path, cls.METADATA_FILENAME), "w") as f:
+            json.dump(metadata, f)
+
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp_path, path)
+
+    def index_of(self, instance_model_id):
+        index = int(np.searchsorted(self.instance_model_ids, instance_model_id))
+
+        if (
+            index == len(self.instance_model_ids)
+            or self.instance_model_ids[index] != instance_model_id
+        ):
+            raise KeyError(instance_model_id)
+
+        return index
+
+    def string(self, column, index):
+        offsets, data = self.strings[column]
+        return data[offsets[index] : offsets[index + 1]].tobytes().decode("utf-8")
+
+    def primitive_value(self, index, model_name):
+        if model_name in ["CharField", "FileField"]:
+            return self.string("unicode_value", index) or None
+
+        decimal_value = float(self.instance_model_decimal_values[index])
+
+        if decimal_value != decimal_value:
+            # NaN, a NULL value
+            return None
+        if model_name == "BooleanField":
+            return bool(decimal_value)
+        if model_name == "DateField":
+            return date.fromordinal(int(decimal_value))
+        if model_name == "DateTimeField":
+            epoch = datetime.utcfromtimestamp(0)
+            return epoch + timedelta(seconds=int(decimal_value))
+        if model_name == "DecimalField":
+            return decimal_value
+        if model_name == "IntegerField":
+            return int(decimal_value)
+
+        raise Exception("Invalid primitive model name: " + model_name)
+
+    def elasticsearch_document(self, instance_model_id):
+        """
+        Same as InstanceModel.elasticsearch_document, using the snapshot
+        """
+        return self._elasticsearch_document(self.index_of(instance_model_id))
+
+    def _elasticsearch_document(self, index):
+        from metamodel.models import MetaModel
+
+        model_id = int(self.instance_model_model_ids[index])
+        model_name = self.model_names[model_id]
+
+        if model_name in MetaModel.NAME_INPUT_TYPES_DICT:
+            unicode = self.string("primitive_unicode", index)
+        else:
+            unicode = (
+                self.string("unicode_representation", index)
+                or "[No unicode representation]"
+            )
+
+        result = {"id": int(self.instance_model_ids[index]), "unicode": unicode}
+
+        keywords = unicode.split()
+        related_instance_model_ids = []
+
+        start = self.instance_field_starts[index]
+        end = self.instance_field_starts[index + 1]
+
+        value_indexes_by_field_id = {}
+        for field_id, value_index in zip(
+            self.instance_field_field_ids[start:end].tolist(),
+            self.instance_field_value_indexes[start:end].tolist(),
+        ):
+            value_indexes_by_field_id.setdefault(field_id, []).append(value_index)
+
+        for meta_field in self.meta_fields_by_model_id.get(model_id, []):
+            value_indexes = value_indexes_by_field_id.get(meta_field["id"], [])
+
+            if meta_field["multiple"]:
+                if not value_indexes:
+                    continue
+
+                m2m_documents = []
+
+                for value_index in value_indexes:
+                    m2m_document = self._elasticsearch_document(value_index)
+
+                    m2m_documents.append(m2m_document[0])
+                    keywords.extend(m2m_document[1])
+                    related_instance_model_ids.extend(m2m_document[2])
+
+                result[meta_field["name"]] = m2m_documents
+                continue
+
+            value_index = value_indexes[-1] if value_indexes else None
+            field_model_name = self.model_names[meta_field["model_id"]]
+
+            if field_model_name == "FileField":
+                if value_index is not None:
+                    result[meta_field["name"]] = self.primitive_value(
+                        value_index, field_model_name
+                    )
+            elif field_model_name in MetaModel.NAME_INPUT_TYPES_DICT:
+                value = None
+                if value_index is not None:
+                    value = self.primitive_value(value_index, field_model_name)
+
+                result[meta_field["name"]] = value
+                keywords.append(str(value))
+            elif value_index is not None:
+                fk_result = self._elasticsearch_document(value_index)
+                for fk_key, fk_value in fk_result[0].items():
+                    result[meta_field["name"] + "_" + fk_key] = fk_value
+
+                keywords.extend(fk_result[1])
+                related_instance_model_ids.append(
+                    int(self.instance_model_ids[value_index])
+                )
+                related_instance_model_ids.extend(fk_result[2])
+
+        for additional_fields in additional_elasticsearch_fields_functions.call(
+            model_name, result, model_name
+        ):
+            if additional_fields:
+                result.update(additional_fields)
+
+        return result, keywords, related_instance_model_ids
@@ -0,0 +1,113 @@
+import os
+import shutil
+import tempfile
+from decimal import Decimal
+
+from django.test import TestCase
+
+from metamodel.models import InstanceField, InstanceModel, MetaField, MetaModel
+from metamodel.snapshot import MetamodelSnapshot
+
+
+def reset_metamodel_caches():
+    # The metamodel lookups are cached in class attributes
+    MetaModel.PRIMITIVE_MODELS_DICT = None
+    MetaModel.METAMODEL_MODELS_DICT = None
+    MetaModel.METAMODEL_MODELS_FIELDS_DICT = None
+    InstanceModel.METAMODEL_METAFIELDS_DICT = None
+
+
+class MetamodelSnapshotTestCase(TestCase):
+    def setUp(self):
+        reset_metamodel_caches()
+        self.addCleanup(reset_metamodel_caches)
+
+        primitives = {
+            name: MetaModel.objects.create(name=name)
+            for name in MetaModel.NAME_INPUT_TYPES_DICT
+        }
+        processor_model = MetaModel.objects.create(name="SnapshotProcessor")
+        notebook_model = MetaModel.objects.create(name="SnapshotNotebook")
+
+        MetaField(
+            parent=processor_model, name="name", model=primitives["CharField"]
+        ).save()
+
+        notebook_fields = [
+            ("name", primitives["CharField"], False),
+            ("price", primitives["DecimalField"], False),
+            ("cores", primitives["IntegerField"], False),
+            ("is_gamer", primitives["BooleanField"], False),
+            ("processor", processor_model, False),
+            ("ram_sizes", primitives["DecimalField"], True),
+            ("release_dates", primitives["DateTimeField"], True),
+        ]
+        for ordering, (name, model, multiple) in enumerate(notebook_fields):
+            MetaField(
+                parent=notebook_model,
+                name=name,
+                model=model,
+                multiple=multiple,
+                ordering=ordering,
+            ).save()
+
+        processor = self.create_instance_model(
+            processor_model, unicode_representation="Intel Core i7-1165G7"
+        )
+        self.add_value(
+            processor,
+            "name",
+            self.create_instance_model(
+                primitives["CharField"], unicode_value="Core i7-1165G7"
+            ),
+        )
+
+        self.notebook = self.create_instance_model(
+            notebook_model, unicode_representation="Lenovo ThinkPad E14"
+        )
+        for name, model, value in [
+            ("name", "CharField", {"unicode_value": "ThinkPad E14"}),
+            ("price", "DecimalField", {"decimal_value": Decimal("1299.5")}),
+            ("cores", "IntegerField", {"decimal_value": 4}),
+            ("is_gamer", "BooleanField", {"decimal_value": 0}),
+            ("ram_sizes", "DecimalField", {"decimal_value": Decimal("8")}),
+            ("ram_sizes", "DecimalField", {"decimal_value": Decimal("16.25")}),
+            ("release_dates", "DateTimeField", {"decimal_value": 1700000000}),
+        ]:
+            self.add_value(
+                self.notebook,
+                name,
+                self.create_instance_model(primitives[model], **value),
+            )
+        self.add_value(self.notebook, "processor", processor)
+
+    @staticmethod
+    def create_instance_model(model, **kwargs):
+        instance_model = InstanceModel(model=model, **kwargs)
+        # Keeps the given unicode representation and skips the receivers of
+        # instance_model_saved
+        instance_model.save(initial=True)
+        return instance_model
+
+    @staticmethod
+    def add_value(instance_model, field_name, value):
+        InstanceField.objects.create(
+            parent=instance_model,
+            field=MetaField.objects.get(parent=instance_model.model, name=field_name),
+            value=value,
+        )
+
+    def test_elasticsearch_document(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path, ignore_errors=True)
+        snapshot = MetamodelSnapshot.build(os.path.join(path, "snapshot"))
+
+        notebook = InstanceModel.objects.get(pk=self.notebook.pk)
+        document = notebook.elasticsearch_document()
+
+        self.assertEqual(snapshot.elasticsearch_document(notebook.id), document)
+        # The unicode of the primitive values is the one of the database
+        self.assertEqual(
+            [ram_size["unicode"] for ram_size in document[0]["ram_sizes"]],
+            ["8.00000", "16.25000"],
+        )
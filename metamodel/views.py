@@ -403,7 +403,8 @@ class MetaFieldMakeMultipleView(DetailView):
 
 
 class InstanceModelDetailView(DetailView):
-    queryset = InstanceModel.get_non_primitive()
+    # The form shows the values of every field of the instance model
+    queryset = InstanceModel.get_non_primitive().prefetch_instance_fields()
     template_name = "metamodel/instance_detail.html"
 
     def get_context_data(self, **kwargs):
@@ -4,15 +4,13 @@ import xlsxwriter
 from django import forms
 from django.conf import settings
 from django.core.files.base import ContentFile
-from django.db.models import Min, DateField, Max, Avg
-from django.db.models.functions import Cast
 from django.utils import timezone
 from django_filters.fields import IsoDateTimeRangeField
 from guardian.shortcuts import get_objects_for_user
 
 from category_columns.models import CategoryColumn
 from solotodo.models import Category, Store, Country, StoreType, Currency, \
-    Entity, EntityHistory, EsProduct, Brand
+    Entity, EntityDailyPrice, EsProduct, Brand
 from solotodo_core.s3utils import PrivateS3Boto3Storage
 
 
@@ -71,12 +69,10 @@ class ReportDailyPricesForm(forms.Form):
         exclude_unavailable = self.cleaned_data['exclude_unavailable']
         brands = self.cleaned_data['brands']
 
-        ehs = EntityHistory.objects.filter(
+        ehs = EntityDailyPrice.objects.filter(
             entity__product__instance_model__model__category=category,
             entity__store__in=stores,
-            timestamp__gte=timestamp.start,
-            timestamp__lte=timestamp.stop,
-        ).annotate(date=Cast('timestamp', DateField()))
+        ).filter_by_timestamp_range(timestamp.start, timestamp.stop)
 
         if brands:
             ehs = ehs.filter(entity__product__brand__in=brands)
@@ -87,16 +83,7 @@ class ReportDailyPricesForm(forms.Form):
         if store_types:
             ehs = ehs.filter(entity__store__type__in=store_types)
 
-        if exclude_unavailable:
-            ehs = ehs.get_available()
-
-        ehs = ehs.values('entity', 'date').annotate(
-            min_normal_price=Min('normal_price'),
-            min_offer_price=Min('offer_price'),
-            min_cell_monthly_payment=Min('cell_monthly_payment'),
-            review_count=Max('review_count'),
-            review_avg_score=Avg('review_avg_score')
-        ).order_by('entity', 'date')
+        ehs = ehs.daily_summary(available_only=bool(exclude_unavailable))
 
         entity_ids = [eh['entity'] for eh in ehs]
         entities = Entity.objects.filter(pk__in=entity_ids).select_related(
@@ -163,8 +150,8 @@ class ReportDailyPricesForm(forms.Form):
             'Puntaje promedio reviews'
         ])
 
-        cell_monthly_payments_in_entities = ehs.filter(
-            min_cell_monthly_payment=False)
+        cell_monthly_payments_in_entities = [
+            eh for eh in ehs if eh['min_cell_monthly_payment'] == 0]
 
         if cell_monthly_payments_in_entities and cell_plans_in_entities:
             headers.append('Cuota arriendo')
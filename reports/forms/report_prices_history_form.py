@@ -10,8 +10,10 @@ from django_filters.fields import IsoDateTimeRangeField
 from guardian.shortcuts import get_objects_for_user
 
 from category_columns.models import CategoryColumn
+from solotodo.history_archive import EntityHistoryArchive, \
+    merge_with_archived_registries
 from solotodo.models import Category, Store, Country, StoreType, Currency, \
-    EntityHistory, EsProduct
+    Entity, EntityHistory, EsProduct
 from solotodo_core.s3utils import PrivateS3Boto3Storage
 
 
@@ -84,33 +86,56 @@ class ReportPricesHistoryForm(forms.Form):
         exclude_unavailable = self.cleaned_data['exclude_unavailable']
         report_timezone = pytz.timezone(self.cleaned_data['timezone'])
 
+        report_entities = Entity.objects.filter(
+            product__instance_model__model__category__in=categories,
+            store__in=stores,
+        )
+
+        if countries:
+            report_entities = report_entities.filter(
+                store__country__in=countries)
+
+        if store_types:
+            report_entities = report_entities.filter(
+                store__type__in=store_types)
+
         ehs = EntityHistory.objects.filter(
-            entity__product__instance_model__model__category__in=categories,
-            entity__store__in=stores,
-            timestamp__gte=timestamp.start,
-            timestamp__lte=timestamp.stop,
-        ).select_related(
+            entity__in=report_entities,
+        ).filter_seen_between(timestamp.start, timestamp.stop).select_related(
             'entity__product__instance_model',
             'entity__cell_plan__instance_model',
             'entity__currency',
             'entity__store'
         )
 
-        if countries:
-            ehs = ehs.filter(entity__store__country__in=countries)
-
-        if store_types:
-            ehs = ehs.filter(entity__store__type__in=store_types)
-
         if exclude_unavailable:
             ehs = ehs.get_available()
 
+        archived_ehs = [
+            expanded_eh
+            for archived_eh in EntityHistoryArchive().registries(
+                report_entities, timestamp.start, timestamp.stop,
+                available_only=bool(exclude_unavailable))
+            for expanded_eh in archived_eh.expand(
+                timestamp.start, timestamp.stop)]
+        archived_entities_dict = {
+            e.id: e for e in Entity.objects.filter(
+                pk__in=set(eh.entity_id for eh in archived_ehs)
+            ).select_related(
+                'product__instance_model',
+                'cell_plan__instance_model',
+                'currency',
+                'store'
+            )
+        }
+
         if categories.count() == 1:
             category = categories[0]
 
             product_ids = list(set(
                 [x['entity__product']
-                    for x in ehs.values('entity__product')]
+                    for x in ehs.values('entity__product')] +
+                [e.product_id for e in archived_entities_dict.values()]
             ))
             es_search = EsProduct.search().filter(
                 'terms', product_id=product_ids)
@@ -148,6 +173,9 @@ class ReportPricesHistoryForm(forms.Form):
         time_format = workbook.add_format({'num_format': 'hh:mm'})
         cell_plans_in_entities = [eh.entity.cell_plan for eh in
                                   ehs.filter(entity__cell_plan__isnull=False)]
+        cell_plans_in_entities.extend(
+            e.cell_plan for e in archived_entities_dict.values()
+            if e.cell_plan_id)
 
         headers = [
             'Producto',
@@ -169,8 +197,9 @@ class ReportPricesHistoryForm(forms.Form):
             'Puntaje reviews'
         ])
 
-        cell_monthly_payments_in_entities = ehs.filter(
-            cell_monthly_payment__isnull=False)
+        cell_monthly_payments_in_entities = \
+            ehs.filter(cell_monthly_payment__isnull=False).exists() or \
+            any(eh.cell_monthly_payment is not None for eh in archived_ehs)
 
         if cell_monthly_payments_in_entities:
             if cell_plans_in_entities:
@@ -193,7 +222,9 @@ class ReportPricesHistoryForm(forms.Form):
             worksheet.write(0, idx, header, header_format)
 
         row = 1
-        for eh in ehs:
+        for eh in merge_with_archived_registries(
+                ehs.expand(timestamp.start, timestamp.stop), archived_ehs,
+                archived_entities_dict):
             col = 0
 
             # Product
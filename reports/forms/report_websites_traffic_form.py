@@ -4,7 +4,7 @@ import xlsxwriter
 from django import forms
 from django.conf import settings
 from django.core.files.base import ContentFile
-from django.db.models import Min, DateField, Count
+from django.db.models import DateField, Count
 from django.db.models.functions import Cast
 from django.utils import timezone
 from django_filters.fields import IsoDateTimeRangeField
@@ -115,9 +115,7 @@ class ReportWebsitesTrafficForm(forms.Form):
         ehs = EntityHistory.objects.filter(
             entity__product__instance_model__model__category__in=categories,
             entity__store__in=stores,
-            timestamp__gte=timestamp.start,
-            timestamp__lte=timestamp.stop,
-        ).get_available().annotate(date=Cast('timestamp', DateField()))
+        ).filter_seen_between(timestamp.start, timestamp.stop).get_available()
 
         if countries:
             ehs = ehs.filter(entity__store__country__in=countries)
@@ -125,13 +123,10 @@ class ReportWebsitesTrafficForm(forms.Form):
         if store_types:
             ehs = ehs.filter(entity__store__type__in=store_types)
 
-        ehs = ehs.values('entity', 'date').annotate(
-            min_normal_price=Min('normal_price'),
-            min_offer_price=Min('offer_price'),
-            min_cell_monthly_payment=Min('cell_monthly_payment')
-        ).order_by('entity', 'date')
+        ehs_by_date = ehs.summarize_by_period(
+            'date', timestamp.start, timestamp.stop)
 
-        entity_ids = [eh['entity'] for eh in ehs]
+        entity_ids = [eh['entity'] for eh in ehs_by_date]
         entities = Entity.objects.filter(pk__in=entity_ids).select_related(
             'product__instance_model__model__category',
             'cell_plan__instance_model',
@@ -226,7 +221,7 @@ class ReportWebsitesTrafficForm(forms.Form):
             worksheet.write(0, idx, header, header_format)
 
         row = 1
-        for eh in ehs:
+        for eh in ehs_by_date:
             col = 0
             entity = entities_dict[eh['entity']]
 
@@ -5,14 +5,13 @@ from django import forms
 from django.conf import settings
 from django.core.files.base import ContentFile
 from django.db.models import Min
-from django.db.models.functions import ExtractWeek, ExtractIsoYear
 from django.utils import timezone
 from django_filters.fields import IsoDateTimeRangeField
 from guardian.shortcuts import get_objects_for_user
 
 from category_columns.models import CategoryColumn
 from solotodo.models import Category, Store, Country, StoreType, Currency, \
-    Entity, EntityHistory, EsProduct
+    Entity, EntityDailyPrice, EsProduct
 from solotodo_core.s3utils import PrivateS3Boto3Storage
 
 
@@ -62,25 +61,24 @@ class ReportWeeklyPricesForm(forms.Form):
         currency = self.cleaned_data['currency']
         timestamp = self.cleaned_data['timestamp']
 
-        ehs = EntityHistory.objects.filter(
-            entity__product__instance_model__model__category=category,
-            entity__store__in=stores,
-            timestamp__gte=timestamp.start,
-            timestamp__lte=timestamp.stop,
-        ).annotate(week=ExtractWeek('timestamp'),
-                   year=ExtractIsoYear('timestamp'))
+        report_entities = Entity.objects.filter(
+            product__instance_model__model__category=category,
+            store__in=stores,
+        )
 
         if countries:
-            ehs = ehs.filter(entity__store__country__in=countries)
+            report_entities = report_entities.filter(
+                store__country__in=countries)
 
         if store_types:
-            ehs = ehs.filter(entity__store__type__in=store_types)
-
-        ehs = ehs.values('entity', 'year', 'week').annotate(
-            min_normal_price=Min('normal_price'),
-            min_offer_price=Min('offer_price'),
-            min_cell_monthly_payment=Min('cell_monthly_payment')
-        ).order_by('entity', 'year', 'week')
+            report_entities = report_entities.filter(
+                store__type__in=store_types)
+
+        # The daily rollup also covers the archived history
+        ehs = EntityDailyPrice.objects.filter(
+            entity__in=report_entities
+        ).filter_by_timestamp_range(
+            timestamp.start, timestamp.stop).weekly_summary()
 
         entity_ids = [eh['entity'] for eh in ehs]
         entities = Entity.objects.filter(pk__in=entity_ids).select_related(
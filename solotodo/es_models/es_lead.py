@@ -1,6 +1,9 @@
+import time
+from collections import deque
+
 from django.conf import settings
 from django.utils import timezone
-from elasticsearch.helpers import bulk
+from elasticsearch.helpers import bulk, parallel_bulk
 
 
 class EsLead(object):
@@ -72,21 +75,41 @@ class EsLead(object):
 
     @classmethod
     def documents_from_db_leads(cls, db_leads):
-        db_leads = db_leads.select_related(
+        for _, action in cls._actions_from_db_leads(db_leads):
+            yield action
+
+    @classmethod
+    def _actions_from_db_leads(cls, db_leads):
+        # Yields (db_lead, bulk action) pairs
+        from solotodo.models import Product
+
+        db_leads = list(db_leads.select_related(
             'website',
             'entity_history__entity__currency',
             'entity_history__entity__store',
             'entity_history__entity__category',
             'entity_history__entity__product__instance_model',
-        )
+        ))
+
+        # One mget for the specs of every product instead of one GET per
+        # lead
+        Product.prefetch_specs(
+            [db_lead.entity_history.entity.product for db_lead in db_leads])
 
         for db_lead in db_leads:
             document = cls.document_from_db_lead(db_lead)
-            yield {
+            action = {
                 '_index': 'leads',
                 '_source': document
             }
 
+            # Same id as the documents indexed by create, so the leads
+            # already indexed are overwritten instead of duplicated
+            if db_lead.uuid:
+                action['_id'] = db_lead.uuid
+
+            yield db_lead, action
+
     @classmethod
     def create_from_db_lead(cls, db_lead):
         es = settings.ES
@@ -101,3 +124,70 @@ class EsLead(object):
     @classmethod
     def create_from_db_leads(cls, db_leads):
         bulk(settings.ES, cls.documents_from_db_leads(db_leads))
+
+    @classmethod
+    def backfill(cls, start_after_id=0, chunk_size=5000, thread_count=4):
+        """
+        Indexes every lead with an id greater than start_after_id, using
+        keyset pagination over the lead ids and concurrent bulk requests.
+        Prints its progress, including the id of the last indexed lead,
+        which can be used to resume an interrupted run. Returns that id.
+        """
+        from solotodo.models import Lead
+
+        total = Lead.objects.filter(pk__gt=start_after_id).count()
+        print('{} leads will be indexed'.format(total))
+
+        # Ids of the leads whose actions were sent, in the same order as
+        # the bulk results
+        pending_lead_ids = deque()
+
+        def actions():
+            last_id = start_after_id
+
+            while True:
+                lead_ids = list(
+                    Lead.objects.filter(pk__gt=last_id)
+                    .order_by('pk')
+                    .values_list('pk', flat=True)[:chunk_size])
+
+                if not lead_ids:
+                    return
+
+                db_leads = Lead.objects.filter(pk__in=lead_ids).order_by('pk')
+                for db_lead, action in cls._actions_from_db_leads(db_leads):
+                    pending_lead_ids.append(db_lead.pk)
+                    yield action
+
+                last_id = lead_ids[-1]
+
+        results = parallel_bulk(
+            settings.ES,
+            actions(),
+            thread_count=thread_count,
+            chunk_size=500,
+        )
+
+        indexed_count = 0
+        last_lead_id = start_after_id
+        start = time.time()
+
+        for _ in results:
+            indexed_count += 1
+            last_lead_id = pending_lead_ids.popleft()
+
+            if indexed_count % chunk_size == 0:
+                cls.print_backfill_progress(
+                    indexed_count, total, start, last_lead_id)
+
+        cls.print_backfill_progress(indexed_count, total, start, last_lead_id)
+
+        return last_lead_id
+
+    @classmethod
+    def print_backfill_progress(cls, indexed_count, total, start,
+                                last_lead_id):
+        elapsed = time.time() - start
+        print('{}/{} leads ({:.1f} docs/s, last lead id {})'.format(
+            indexed_count, total,
+            indexed_count / elapsed if elapsed else 0, last_lead_id))
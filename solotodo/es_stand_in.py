@@ -0,0 +1,2151 @@
+import ast
+import copy
+import fnmatch
+import itertools
+import math
+import operator
+import re
+import statistics
+import time
+import unicodedata
+import uuid
+from collections import Counter, OrderedDict, defaultdict, namedtuple
+from contextlib import contextmanager
+from urllib.parse import unquote
+
+from elasticsearch import Elasticsearch, Transport
+from elasticsearch.exceptions import (
+    ConflictError,
+    NotFoundError,
+    RequestError,
+    TransportError,
+)
+
+TOKEN_RE = re.compile(r"\w+")
+
+# doc['field'].value and params.name references of the scripts
+SCRIPT_DOC_VALUE_RE = re.compile(r"""doc\[['"]([^'"]+)['"]\]\.value""")
+SCRIPT_PARAM_RE = re.compile(r"params\.(\w+)")
+
+UNARY_OPERATORS = {ast.UAdd: operator.pos, ast.USub: operator.neg}
+BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.Mod: operator.mod,
+}
+
+RANGE_OPERATORS = {
+    "gt": operator.gt,
+    "gte": operator.ge,
+    "lt": operator.lt,
+    "lte": operator.le,
+}
+
+# How the scores of the matching children (or nested objects) of a row
+# are combined
+CHILD_SCORE_MODES = {
+    "none": lambda scores: 0.0,
+    "avg": statistics.mean,
+    "max": max,
+    "min": min,
+    "sum": sum,
+    "total": sum,
+}
+
+# How the function_score functions are combined, and with the query score
+SCORE_MODES = {
+    "multiply": math.prod,
+    "sum": sum,
+    "avg": statistics.mean,
+    "first": lambda scores: scores[0],
+    "max": max,
+    "min": min,
+}
+BOOST_MODES = {
+    "multiply": operator.mul,
+    "replace": lambda score, function_score: function_score,
+    "sum": operator.add,
+    "avg": lambda score, function_score: (score + function_score) / 2,
+    "max": max,
+    "min": min,
+}
+
+# Value used to sort by a multi valued field
+SORT_MODES = {
+    "min": min,
+    "max": max,
+    "sum": sum,
+    "avg": statistics.mean,
+    "median": statistics.median,
+}
+
+# Keys of the search bodies handled by LocalTransport
+SEARCH_BODY_KEYS = {
+    "query",
+    "post_filter",
+    "aggs",
+    "aggregations",
+    "sort",
+    "from",
+    "size",
+    "_source",
+    "docvalue_fields",
+    "collapse",
+    "track_total_hits",
+    "track_scores",
+    "timeout",
+    "version",
+    "seq_no_primary_term",
+}
+
+SHARDS = {"total": 1, "successful": 1, "skipped": 0, "failed": 0}
+
+# A matching row of a search
+Hit = namedtuple("Hit", ["index", "search_index", "row_id", "score"])
+
+
+# Search engine
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def _field_body(body):
+    # Splits the body of the field level queries (e.g. {"name": {"value":
+    # "x"}, "boost": 2}) into the field name and its parameters
+    ((field, params),) = (
+        (key, value) for key, value in body.items() if key not in ["boost", "_name"]
+    )
+    return field, params
+
+
+def _unsupported(error_type, info):
+    return RequestError(400, error_type, info)
+
+
+class Analyzer:
+    """
+    Subset of the Elasticsearch analysis chain: the standard, keyword and
+    whitespace tokenizers and the lowercase, asciifolding, ngram and
+    edge_ngram token filters.
+    """
+
+    def __init__(self, tokenizer, filters):
+        if tokenizer not in ["standard", "keyword", "whitespace"]:
+            raise _unsupported("unsupported_tokenizer", {"tokenizer": tokenizer})
+
+        for token_filter in filters:
+            if token_filter["type"] not in [
+                "lowercase",
+                "asciifolding",
+                "ngram",
+                "edge_ngram",
+            ]:
+                raise _unsupported("unsupported_token_filter", token_filter)
+
+        self.tokenizer = tokenizer
+        self.filters = filters
+
+    def analyze(self, text):
+        text = str(text)
+
+        if self.tokenizer == "standard":
+            tokens = TOKEN_RE.findall(text)
+        elif self.tokenizer == "whitespace":
+            tokens = text.split()
+        else:
+            tokens = [text]
+
+        for token_filter in self.filters:
+            filter_type = token_filter["type"]
+
+            if filter_type == "lowercase":
+                tokens = [token.lower() for token in tokens]
+            elif filter_type == "asciifolding":
+                tokens = [
+                    unicodedata.normalize("NFKD", token)
+                    .encode("ascii", "ignore")
+                    .decode("ascii")
+                    for token in tokens
+                ]
+            else:
+                min_gram = int(token_filter.get("min_gram", 1))
+                max_gram = int(token_filter.get("max_gram", 2))
+                grams = []
+
+                for token in tokens:
+                    starts = (
+                        [0] if filter_type == "edge_ngram" else range(len(token))
+                    )
+                    for start in starts:
+                        for length in range(min_gram, max_gram + 1):
+                            if start + length > len(token):
+                                break
+                            grams.append(token[start : start + length])
+
+                tokens = grams
+
+        return tokens
+
+
+class IndexMapping:
+    """
+    Field definitions of an index taken from the body it was created with
+    (properties, dynamic templates, analysis settings), extended with the
+    fields added by the documents written to it as Elasticsearch's dynamic
+    mapping would. Strict mappings are not enforced.
+    """
+
+    BUILT_IN_ANALYZERS = {
+        "standard": ("standard", ["lowercase"]),
+        "simple": ("standard", ["lowercase"]),
+        "whitespace": ("whitespace", []),
+        "keyword": ("keyword", []),
+    }
+
+    DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}([T ][\d:.]+)?(Z|[+-]\d{2}:?\d{2})?$")
+
+    def __init__(self, body):
+        self.body = body or {}
+        settings = self.body.get("settings", {})
+        self.analysis = settings.get("analysis") or settings.get("index", {}).get(
+            "analysis", {}
+        )
+        self.properties = {}
+        self.nested_paths = set()
+        self.join_field = None
+        # Relation name => its parent relation name
+        self.parent_relations = {}
+        self._analyzers = {}
+        self.update(self.body.get("mappings", {}))
+
+    def update(self, mappings):
+        self.dynamic_templates = mappings.get(
+            "dynamic_templates", getattr(self, "dynamic_templates", [])
+        )
+        self._add_properties(mappings.get("properties", {}), "")
+
+    def _add_properties(self, properties, prefix):
+        for name, definition in properties.items():
+            self._add_field(prefix + name, definition)
+
+    def _add_field(self, path, definition):
+        field_type = definition.get("type", "object")
+        self.properties[path] = definition
+
+        if field_type == "nested":
+            self.nested_paths.add(path)
+        if field_type == "join":
+            self.join_field = path
+            for parent, children in definition.get("relations", {}).items():
+                for child in _as_list(children):
+                    self.parent_relations[child] = parent
+
+        self._add_properties(definition.get("properties", {}), path + ".")
+
+        for name, subfield in definition.get("fields", {}).items():
+            self.properties[path + "." + name] = subfield
+
+    def definition(self, path, value=None):
+        """
+        Returns the definition of the given field, mapping it dynamically
+        from the given value if it isn't mapped yet. Returns None for the
+        unmapped fields if no value is given.
+        """
+        try:
+            return self.properties[path]
+        except KeyError:
+            if value is None:
+                return None
+
+        if isinstance(value, dict):
+            match_mapping_type = "object"
+        elif isinstance(value, bool):
+            match_mapping_type = "boolean"
+        elif isinstance(value, int):
+            match_mapping_type = "long"
+        elif isinstance(value, float):
+            match_mapping_type = "double"
+        else:
+            match_mapping_type = "string"
+
+        for template in self.dynamic_templates:
+            ((_, template),) = template.items()
+
+            if template.get("match_mapping_type", "*") not in [
+                "*",
+                match_mapping_type,
+            ]:
+                continue
+            if "path_match" in template and not fnmatch.fnmatchcase(
+                path, template["path_match"]
+            ):
+                continue
+            if "match" in template and not fnmatch.fnmatchcase(
+                path.split(".")[-1], template["match"]
+            ):
+                continue
+
+            definition = template["mapping"]
+            break
+        else:
+            if match_mapping_type == "object":
+                definition = {"type": "object"}
+            elif match_mapping_type == "boolean":
+                definition = {"type": "boolean"}
+            elif match_mapping_type == "long":
+                definition = {"type": "long"}
+            elif match_mapping_type == "double":
+                definition = {"type": "float"}
+            elif self.DATE_RE.match(value):
+                definition = {"type": "date"}
+            else:
+                definition = {
+                    "type": "text",
+                    "fields": {"keyword": {"type": "keyword", "ignore_above": 256}},
+                }
+
+        self._add_field(path, definition)
+        return definition
+
+    def analyzer(self, name):
+        try:
+            return self._analyzers[name]
+        except KeyError:
+            pass
+
+        if name in self.BUILT_IN_ANALYZERS:
+            tokenizer, filter_names = self.BUILT_IN_ANALYZERS[name]
+        else:
+            try:
+                analyzer_definition = self.analysis["analyzer"][name]
+            except KeyError:
+                raise _unsupported("unknown_analyzer", {"analyzer": name})
+            tokenizer = analyzer_definition.get("tokenizer", "standard")
+            filter_names = _as_list(analyzer_definition.get("filter"))
+
+        filters = []
+        for filter_name in filter_names:
+            if isinstance(filter_name, dict):
+                filters.append(filter_name)
+            else:
+                filters.append(
+                    self.analysis.get("filter", {}).get(filter_name)
+                    or {"type": filter_name}
+                )
+
+        analyzer = Analyzer(tokenizer, filters)
+        self._analyzers[name] = analyzer
+        return analyzer
+
+    def normalize(self, definition, value):
+        """
+        Returns the term and doc value of the given value of a non text
+        field, or None if it can't be converted (e.g. a number field with
+        a non numeric value, which Elasticsearch would reject).
+        """
+        field_type = definition.get("type")
+
+        try:
+            if field_type in ["long", "integer", "short", "byte"]:
+                return int(float(value))
+            if field_type in ["float", "double", "half_float"]:
+                return float(value)
+            if field_type == "scaled_float":
+                # The doc values keep the scaled value
+                scaling_factor = definition["scaling_factor"]
+                return round(float(value) * scaling_factor) / scaling_factor
+        except (TypeError, ValueError):
+            return None
+
+        if field_type == "boolean":
+            return value if isinstance(value, bool) else str(value) == "true"
+        if isinstance(value, bool):
+            return "true" if value else "false"
+        if field_type == "date":
+            return value
+        return str(value)
+
+
+class SearchIndex:
+    """
+    In-memory inverted index of the documents of an index (or of the
+    objects of a nested field, which get their own SearchIndex) used to
+    run searches:
+
+    * postings: field => term => ids of the rows with the term, the terms
+      are the tokens of the text fields and the normalized values of the
+      rest (see IndexMapping.normalize)
+    * doc_values: row id => field => values, used for sorting, scripts
+      and aggregations (text fields have none)
+    * the parent / child relations of the join field, if any
+
+    The rows of the documents are their ids and the rows of the nested
+    objects are (id of the parent row, path, position) tuples.
+    """
+
+    def __init__(self, mapping, prefix=""):
+        self.mapping = mapping
+        self.prefix = prefix
+        self.postings = defaultdict(lambda: defaultdict(set))
+        self.field_rows = defaultdict(set)
+        self.doc_values = {}
+        self.sources = {}
+        # Row id => insertion order, the order of the hits with the same
+        # sort values
+        self.positions = {}
+        self._next_position = itertools.count()
+        self.row_terms = {}
+        self.nested = {}
+        self.nested_rows = {}
+        # Row id => (relation name, parent id)
+        self.joins = {}
+        self.children = defaultdict(set)
+
+    # Indexing
+
+    def add(self, row_id, source):
+        self.sources[row_id] = source
+        self.positions[row_id] = next(self._next_position)
+        self.row_terms[row_id] = []
+        self.doc_values[row_id] = defaultdict(list)
+        self.nested_rows[row_id] = []
+        self._add_object(row_id, source, self.prefix)
+
+    def _add_object(self, row_id, obj, prefix):
+        for key, value in obj.items():
+            path = prefix + key
+
+            for position, item in enumerate(_as_list(value)):
+                if item is None:
+                    continue
+
+                if path == self.mapping.join_field:
+                    self._add_join(row_id, path, item)
+                    continue
+
+                definition = self.mapping.definition(path, item)
+
+                if path in self.mapping.nested_paths:
+                    nested_index = self.nested.get(path)
+                    if nested_index is None:
+                        nested_index = self.nested[path] = SearchIndex(
+                            self.mapping, path + "."
+                        )
+
+                    nested_row_id = (row_id, path, position)
+                    nested_index.add(nested_row_id, item)
+                    self.nested_rows[row_id].append((path, nested_row_id))
+                elif isinstance(item, dict):
+                    self._add_object(row_id, item, path + ".")
+                else:
+                    self._add_value(row_id, path, definition, item)
+
+    def _add_value(self, row_id, path, definition, value):
+        if definition.get("type") == "text":
+            analyzer = self.mapping.analyzer(definition.get("analyzer", "standard"))
+            terms = analyzer.analyze(value)
+        else:
+            term = self.mapping.normalize(definition, value)
+            if term is None:
+                return
+            terms = [term]
+            self.doc_values[row_id][path].append(term)
+
+        for term in terms:
+            self.postings[path][term].add(row_id)
+            self.field_rows[path].add(row_id)
+            self.row_terms[row_id].append((path, term))
+
+        for name, subfield in definition.get("fields", {}).items():
+            self._add_value(row_id, path + "." + name, subfield, value)
+
+    def _add_join(self, row_id, path, value):
+        if isinstance(value, dict):
+            relation, parent_id = value["name"], value.get("parent")
+        else:
+            relation, parent_id = value, None
+
+        self.joins[row_id] = (relation, parent_id)
+        if parent_id is not None:
+            self.children[parent_id].add(row_id)
+
+        self.postings[path][relation].add(row_id)
+        self.field_rows[path].add(row_id)
+        self.row_terms[row_id].append((path, relation))
+
+    def remove(self, row_id):
+        if row_id not in self.sources:
+            return
+
+        del self.sources[row_id]
+        del self.positions[row_id]
+        del self.doc_values[row_id]
+
+        for path, term in self.row_terms.pop(row_id):
+            rows = self.postings[path][term]
+            rows.discard(row_id)
+            if not rows:
+                del self.postings[path][term]
+            self.field_rows[path].discard(row_id)
+
+        for path, nested_row_id in self.nested_rows.pop(row_id):
+            self.nested[path].remove(nested_row_id)
+
+        relation, parent_id = self.joins.pop(row_id, (None, None))
+        if parent_id is not None:
+            self.children[parent_id].discard(row_id)
+
+    # Queries
+
+    def query(self, query, context=None):
+        """
+        Returns a dict of row id => score of the rows matching the given
+        query. The inner hits requested by the query are added to the
+        given SearchContext, if any.
+        """
+        ((query_type, body),) = query.items()
+        handler = getattr(self, "_query_{}".format(query_type), None)
+
+        if handler is None:
+            raise _unsupported("unsupported_query", {"query": query})
+
+        return handler(body, context)
+
+    def _all_rows(self, score):
+        return dict.fromkeys(self.sources, score)
+
+    def _term_rows(self, field, terms):
+        # Rows with any of the given (not normalized) terms of the field
+        definition = self.mapping.definition(field)
+        postings = self.postings.get(field, {})
+        rows = set()
+
+        if definition is None:
+            return rows
+
+        for term in terms:
+            if definition.get("type") not in ["text", "join"]:
+                term = self.mapping.normalize(definition, term)
+            rows |= postings.get(term, set())
+
+        return rows
+
+    def _query_match_all(self, body, context):
+        return self._all_rows(body.get("boost", 1.0))
+
+    def _query_match_none(self, body, context):
+        return {}
+
+    def _query_ids(self, body, context):
+        return {
+            doc_id: body.get("boost", 1.0)
+            for doc_id in body["values"]
+            if doc_id in self.sources
+        }
+
+    def _query_term(self, body, context):
+        field, params = _field_body(body)
+        if not isinstance(params, dict):
+            params = {"value": params}
+
+        boost = params.get("boost", body.get("boost", 1.0))
+        return dict.fromkeys(self._term_rows(field, [params["value"]]), boost)
+
+    def _query_terms(self, body, context):
+        field, values = _field_body(body)
+        return dict.fromkeys(self._term_rows(field, values), body.get("boost", 1.0))
+
+    def _query_range(self, body, context):
+        field, params = _field_body(body)
+        definition = self.mapping.definition(field)
+
+        if definition is None:
+            return {}
+
+        bounds = []
+        for range_operator, compare in RANGE_OPERATORS.items():
+            if params.get(range_operator) is None:
+                continue
+
+            bound = params[range_operator]
+            if definition.get("type") != "text":
+                bound = self.mapping.normalize(definition, bound)
+            if isinstance(bound, str) and bound.startswith("now"):
+                raise _unsupported("unsupported_date_math", {"range": body})
+            bounds.append((compare, bound))
+
+        rows = set()
+        for term, term_rows in self.postings.get(field, {}).items():
+            try:
+                if all(compare(term, bound) for compare, bound in bounds):
+                    rows |= term_rows
+            except TypeError:
+                # A term of another type (e.g. a dynamically mapped one)
+                continue
+
+        return dict.fromkeys(rows, params.get("boost", 1.0))
+
+    def _query_exists(self, body, context):
+        field = body["field"]
+        rows = set(self.field_rows.get(field, set()))
+
+        # Objects exist if any of their fields does
+        for path, path_rows in self.field_rows.items():
+            if path.startswith(field + "."):
+                rows |= path_rows
+        for path, nested_index in self.nested.items():
+            if path == field or path.startswith(field + "."):
+                rows |= {row_id[0] for row_id in nested_index.sources}
+
+        return dict.fromkeys(rows, body.get("boost", 1.0))
+
+    def _matching_terms_query(self, body, matches):
+        # Query for the rows with a term of the field for which the given
+        # function returns True
+        field, params = _field_body(body)
+        if not isinstance(params, dict):
+            params = {"value": params}
+
+        rows = set()
+        for term, term_rows in self.postings.get(field, {}).items():
+            if isinstance(term, str) and matches(term, params):
+                rows |= term_rows
+
+        return dict.fromkeys(rows, params.get("boost", body.get("boost", 1.0)))
+
+    def _query_wildcard(self, body, context):
+        def matches(term, params):
+            pattern = params.get("value", params.get("wildcard"))
+            if params.get("case_insensitive"):
+                return fnmatch.fnmatchcase(term.lower(), pattern.lower())
+            return fnmatch.fnmatchcase(term, pattern)
+
+        return self._matching_terms_query(body, matches)
+
+    def _query_prefix(self, body, context):
+        return self._matching_terms_query(
+            body, lambda term, params: term.startswith(params["value"])
+        )
+
+    def _query_fuzzy(self, body, context):
+        def matches(term, params):
+            value = str(params["value"])
+            fuzziness = params.get("fuzziness", "AUTO")
+            if fuzziness == "AUTO":
+                fuzziness = 0 if len(value) < 3 else 1 if len(value) < 6 else 2
+            prefix_length = params.get("prefix_length", 0)
+
+            return term[:prefix_length] == value[:prefix_length] and (
+                _edit_distance(term, value, int(fuzziness)) <= int(fuzziness)
+            )
+
+        return self._matching_terms_query(body, matches)
+
+    def _query_match(self, body, context):
+        field, params = _field_body(body)
+        if not isinstance(params, dict):
+            params = {"query": params}
+
+        definition = self.mapping.definition(field)
+        if definition is None:
+            return {}
+
+        if definition.get("type") == "text":
+            analyzer = self.mapping.analyzer(
+                definition.get(
+                    "search_analyzer", definition.get("analyzer", "standard")
+                )
+            )
+            terms = analyzer.analyze(params["query"])
+        else:
+            terms = [params["query"]]
+
+        # The score is the number of matching terms
+        matches = Counter()
+        for term in terms:
+            matches.update(self._term_rows(field, [term]))
+
+        if params.get("operator", "or").lower() == "and":
+            matches = {
+                row_id: count
+                for row_id, count in matches.items()
+                if count == len(terms)
+            }
+
+        boost = params.get("boost", 1.0)
+        return {row_id: count * boost for row_id, count in matches.items()}
+
+    def _query_bool(self, body, context):
+        must = [self.query(q, context) for q in _as_list(body.get("must"))]
+        filters = [self.query(q, context) for q in _as_list(body.get("filter"))]
+        should = [self.query(q, context) for q in _as_list(body.get("should"))]
+        must_not = [self.query(q) for q in _as_list(body.get("must_not"))]
+
+        if must or filters:
+            rows = None
+            for clause_rows in must + filters:
+                rows = (
+                    set(clause_rows) if rows is None else rows.intersection(clause_rows)
+                )
+            minimum_should_match = 0
+        elif should:
+            rows = set().union(*should)
+            minimum_should_match = 1
+        else:
+            rows = set(self.sources)
+            minimum_should_match = 0
+
+        minimum_should_match = int(
+            body.get("minimum_should_match", minimum_should_match)
+        )
+        for clause_rows in must_not:
+            rows.difference_update(clause_rows)
+
+        # Filters and must_not don't score, so a bool query with only those
+        # gives a zero score (an empty one is a match_all)
+        base_score = 0.0 if filters or must_not else 1.0
+        boost = body.get("boost", 1.0)
+        result = {}
+
+        for row_id in rows:
+            should_matches = [x[row_id] for x in should if row_id in x]
+            if len(should_matches) < minimum_should_match:
+                continue
+
+            if must or should:
+                score = sum(x[row_id] for x in must) + sum(should_matches)
+            else:
+                score = base_score
+
+            result[row_id] = score * boost
+
+        return result
+
+    def _query_constant_score(self, body, context):
+        return dict.fromkeys(
+            self.query(body["filter"], context), body.get("boost", 1.0)
+        )
+
+    def _query_function_score(self, body, context):
+        rows = self.query(body.get("query", {"match_all": {}}), context)
+
+        functions = list(body.get("functions", []))
+        if "script_score" in body or "weight" in body:
+            functions.append(
+                {
+                    key: body[key]
+                    for key in ["script_score", "weight"]
+                    if key in body
+                }
+            )
+
+        score_mode = body.get("score_mode", "multiply")
+        boost_mode = body.get("boost_mode", "multiply")
+        boost = body.get("boost", 1.0)
+        result = {}
+
+        for row_id, score in rows.items():
+            function_scores = []
+
+            for function in functions:
+                if "filter" in function and row_id not in self.query(
+                    function["filter"]
+                ):
+                    continue
+
+                function_score = function.get("weight", 1.0)
+                if "script_score" in function:
+                    function_score *= self._script_value(
+                        row_id, function["script_score"]["script"]
+                    )
+                elif set(function) - {"weight", "filter"}:
+                    raise _unsupported("unsupported_score_function", function)
+
+                function_scores.append(function_score)
+
+            if function_scores:
+                function_score = SCORE_MODES[score_mode](function_scores)
+                score = BOOST_MODES[boost_mode](score, function_score)
+
+            result[row_id] = score * boost
+
+        return result
+
+    def _script_value(self, row_id, script):
+        # Evaluates arithmetic scripts over doc['field'].value and params
+        if isinstance(script, str):
+            source, params = script, {}
+        else:
+            source = script.get("source", script.get("inline"))
+            params = script.get("params", {})
+
+        variables = {}
+
+        def doc_value(match):
+            values = self.doc_values.get(row_id, {}).get(match.group(1))
+            if not values:
+                raise _unsupported(
+                    "script_exception",
+                    {
+                        "reason": "A document doesn't have a value for a field",
+                        "field": match.group(1),
+                    },
+                )
+            name = "_v{}".format(len(variables))
+            variables[name] = values[0]
+            return name
+
+        def param_value(match):
+            name = "_v{}".format(len(variables))
+            variables[name] = params[match.group(1)]
+            return name
+
+        expression = SCRIPT_DOC_VALUE_RE.sub(doc_value, source.strip().rstrip(";"))
+        expression = SCRIPT_PARAM_RE.sub(param_value, expression)
+
+        try:
+            return float(
+                _evaluate_expression(ast.parse(expression, mode="eval"), variables)
+            )
+        except (SyntaxError, ValueError, KeyError):
+            raise _unsupported("unsupported_script", {"script": script})
+
+    def _query_nested(self, body, context):
+        path = body["path"]
+        score_mode = body.get("score_mode", "avg")
+
+        for nested_path, nested_index in self.nested.items():
+            if path == nested_path:
+                nested_rows = nested_index.query(body["query"])
+            elif path.startswith(nested_path + "."):
+                nested_rows = nested_index._query_nested(body, None)
+            else:
+                continue
+
+            scores = defaultdict(list)
+            for nested_row_id, score in nested_rows.items():
+                scores[nested_row_id[0]].append(score)
+
+            return {
+                row_id: CHILD_SCORE_MODES.get(score_mode, CHILD_SCORE_MODES["avg"])(
+                    row_scores
+                )
+                * body.get("boost", 1.0)
+                for row_id, row_scores in scores.items()
+            }
+
+        return {}
+
+    def _query_has_child(self, body, context):
+        child_type = body["type"]
+        parent_type = self.mapping.parent_relations.get(child_type)
+        score_mode = body.get("score_mode", "none")
+
+        children = defaultdict(list)
+        for child_id, score in self.query(body["query"]).items():
+            relation, parent_id = self.joins.get(child_id, (None, None))
+            if relation == child_type and parent_id is not None:
+                children[parent_id].append((child_id, score))
+
+        min_children = body.get("min_children", 1)
+        max_children = body.get("max_children")
+
+        result = {}
+        for parent_id, child_scores in children.items():
+            if self.joins.get(parent_id, (None,))[0] != parent_type:
+                continue
+            if len(child_scores) < min_children or (
+                max_children is not None and len(child_scores) > max_children
+            ):
+                continue
+
+            scores = [score for _, score in child_scores]
+            result[parent_id] = (
+                CHILD_SCORE_MODES[score_mode](scores) * body.get("boost", 1.0)
+            )
+
+        if context is not None and "inner_hits" in body:
+            context.add_inner_hits(
+                body["inner_hits"],
+                child_type,
+                {parent_id: children[parent_id] for parent_id in result},
+            )
+
+        return result
+
+    def _query_has_parent(self, body, context):
+        parent_type = body["parent_type"]
+        parents = {
+            parent_id: score
+            for parent_id, score in self.query(body["query"]).items()
+            if self.joins.get(parent_id, (None,))[0] == parent_type
+        }
+
+        result = {}
+        matching_parents = defaultdict(list)
+        for parent_id, parent_score in parents.items():
+            for child_id in self.children.get(parent_id, []):
+                score = parent_score if body.get("score") else 1.0
+                result[child_id] = score * body.get("boost", 1.0)
+                matching_parents[child_id].append((parent_id, parent_score))
+
+        if context is not None and "inner_hits" in body:
+            context.add_inner_hits(body["inner_hits"], parent_type, matching_parents)
+
+        return result
+
+
+class SearchContext:
+    """
+    Inner hits requested by the has_child and has_parent queries of a
+    search, by name.
+    """
+
+    def __init__(self):
+        self.inner_hits = OrderedDict()
+
+    def add_inner_hits(self, spec, relation, matches):
+        # matches is a dict of row id => [(related row id, score)]
+        name = spec.get("name", relation)
+        self.inner_hits[name] = (spec, matches)
+
+
+def _sort_hits(hits, sort):
+    """
+    Returns the given hits sorted with the given Elasticsearch sort, along
+    with a dict of (index, row id) => sort values of the hits (None if
+    sorting by score only).
+    """
+    specs = [_sort_spec(x) for x in _as_list(sort)] or [("_score", "desc", {})]
+
+    def sort_value(hit, field, order, params):
+        if field == "_score":
+            return hit.score
+        if field == "_doc":
+            return None
+
+        field_values = hit.search_index.doc_values.get(hit.row_id, {}).get(field)
+        if not field_values:
+            missing = params.get("missing", "_last")
+            return None if missing in ["_last", "_first"] else missing
+
+        mode = params.get("mode", "min" if order == "asc" else "max")
+        return SORT_MODES[mode](field_values)
+
+    values = {
+        (hit.index, hit.row_id): [
+            sort_value(hit, field, order, params) for field, order, params in specs
+        ]
+        for hit in hits
+    }
+
+    # Stable sorts from the last criteria to the first one, the hits
+    # without a value go last unless "missing" is "_first"
+    hits = sorted(hits, key=lambda hit: hit.search_index.positions[hit.row_id])
+    for position in reversed(range(len(specs))):
+        field, order, params = specs[position]
+        if field == "_doc":
+            continue
+
+        present, missing = [], []
+        for hit in hits:
+            if values[(hit.index, hit.row_id)][position] is None:
+                missing.append(hit)
+            else:
+                present.append(hit)
+
+        present.sort(
+            key=lambda hit: values[(hit.index, hit.row_id)][position],
+            reverse=order == "desc",
+        )
+        if params.get("missing") == "_first":
+            hits = missing + present
+        else:
+            hits = present + missing
+
+    if [field for field, _, _ in specs] == ["_score"]:
+        return hits, None
+
+    return hits, values
+
+
+def _sort_spec(spec):
+    # Returns the (field, order, params) triplet of an item of a sort
+    if isinstance(spec, str):
+        return spec, "desc" if spec == "_score" else "asc", {}
+
+    ((field, params),) = spec.items()
+    if isinstance(params, str):
+        params = {"order": params}
+
+    default_order = "desc" if field == "_score" else "asc"
+    return field, params.get("order", default_order), params
+
+
+def _edit_distance(a, b, max_distance):
+    # Levenshtein distance, stopping once it exceeds max_distance
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+
+    previous = list(range(len(b) + 1))
+    for i, a_char in enumerate(a, 1):
+        current = [i]
+        for j, b_char in enumerate(b, 1):
+            current.append(
+                min(
+                    previous[j] + 1,
+                    current[j - 1] + 1,
+                    previous[j - 1] + (a_char != b_char),
+                )
+            )
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+
+    return previous[-1]
+
+
+def _evaluate_expression(node, variables):
+    # Evaluates the arithmetic subset of the Python expressions
+    if isinstance(node, ast.Expression):
+        return _evaluate_expression(node.body, variables)
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+        return node.value
+    if isinstance(node, ast.Name):
+        return variables[node.id]
+    if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+        return UNARY_OPERATORS[type(node.op)](
+            _evaluate_expression(node.operand, variables)
+        )
+    if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+        return BINARY_OPERATORS[type(node.op)](
+            _evaluate_expression(node.left, variables),
+            _evaluate_expression(node.right, variables),
+        )
+
+    raise ValueError(ast.dump(node))
+
+
+class Aggregations:
+    """
+    Runs the aggregations of a search over "segments", (SearchIndex, row
+    ids) pairs with the matching rows of each index. Supports the terms,
+    composite, filter, filters, nested and children bucket aggregations
+    and the stats, min, max, avg, sum, value_count and cardinality metric
+    aggregations.
+    """
+
+    def run(self, aggs, segments):
+        result = {}
+
+        for name, agg in (aggs or {}).items():
+            agg = dict(agg)
+            sub_aggs = agg.pop("aggs", None) or agg.pop("aggregations", None) or {}
+            meta = agg.pop("meta", None)
+
+            ((agg_type, params),) = agg.items()
+            handler = getattr(self, "_{}".format(agg_type), None)
+
+            if handler is None:
+                raise _unsupported("unsupported_aggregation", {name: agg})
+
+            result[name] = handler(params, segments, sub_aggs)
+            if meta is not None:
+                result[name]["meta"] = meta
+
+        return result
+
+    @staticmethod
+    def _values(segments, field):
+        # Yields the values of the field of every row, one list per row
+        for search_index, row_ids in segments:
+            for row_id in row_ids:
+                yield search_index.doc_values.get(row_id, {}).get(field, [])
+
+    @staticmethod
+    def _count(segments):
+        return sum(len(row_ids) for _, row_ids in segments)
+
+    def _bucket(self, segments, sub_aggs, **bucket):
+        bucket["doc_count"] = self._count(segments)
+        bucket.update(self.run(sub_aggs, segments))
+        return bucket
+
+    # Metrics
+
+    def _numbers(self, params, segments):
+        return [
+            value
+            for values in self._values(segments, params["field"])
+            for value in values
+            if isinstance(value, (int, float)) and not isinstance(value, bool)
+        ]
+
+    def _stats(self, params, segments, sub_aggs):
+        values = self._numbers(params, segments)
+        return {
+            "count": len(values),
+            "min": min(values) if values else None,
+            "max": max(values) if values else None,
+            "avg": sum(values) / len(values) if values else None,
+            "sum": sum(values),
+        }
+
+    def _min(self, params, segments, sub_aggs):
+        values = self._numbers(params, segments)
+        return {"value": min(values) if values else None}
+
+    def _max(self, params, segments, sub_aggs):
+        values = self._numbers(params, segments)
+        return {"value": max(values) if values else None}
+
+    def _avg(self, params, segments, sub_aggs):
+        values = self._numbers(params, segments)
+        return {"value": sum(values) / len(values) if values else None}
+
+    def _sum(self, params, segments, sub_aggs):
+        return {"value": sum(self._numbers(params, segments))}
+
+    def _value_count(self, params, segments, sub_aggs):
+        return {
+            "value": sum(
+                len(values) for values in self._values(segments, params["field"])
+            )
+        }
+
+    def _cardinality(self, params, segments, sub_aggs):
+        return {
+            "value": len(
+                {
+                    value
+                    for values in self._values(segments, params["field"])
+                    for value in values
+                }
+            )
+        }
+
+    # Buckets
+
+    def _terms(self, params, segments, sub_aggs):
+        rows_per_key = defaultdict(lambda: defaultdict(set))
+
+        for search_index, row_ids in segments:
+            doc_values = search_index.doc_values
+            for row_id in row_ids:
+                values = doc_values.get(row_id, {}).get(params["field"], [])
+                if not values and "missing" in params:
+                    values = [params["missing"]]
+                for value in set(values):
+                    rows_per_key[value][search_index].add(row_id)
+
+        buckets = []
+        for key, key_rows in rows_per_key.items():
+            key_segments = list(key_rows.items())
+            if self._count(key_segments) < params.get("min_doc_count", 1):
+                continue
+
+            bucket = self._bucket(key_segments, sub_aggs, key=key)
+            if isinstance(key, bool):
+                bucket["key"] = int(key)
+                bucket["key_as_string"] = "true" if key else "false"
+            buckets.append((key, bucket))
+
+        orders = _as_list(params.get("order")) or [{"_count": "desc"}]
+        # Ties are broken by ascending key, as Elasticsearch does
+        buckets.sort(key=lambda x: x[0])
+        for order in reversed(orders):
+            ((order_by, direction),) = order.items()
+            buckets.sort(
+                key=lambda x: _bucket_order_value(x[1], order_by),
+                reverse=direction == "desc",
+            )
+
+        size = params.get("size", 10)
+        return {
+            "doc_count_error_upper_bound": 0,
+            "sum_other_doc_count": sum(x[1]["doc_count"] for x in buckets[size:]),
+            "buckets": [bucket for _, bucket in buckets[:size]],
+        }
+
+    def _composite(self, params, segments, sub_aggs):
+        sources = []
+        for source in params["sources"]:
+            ((name, source_agg),) = source.items()
+            ((source_type, source_params),) = source_agg.items()
+            if source_type != "terms":
+                raise _unsupported("unsupported_composite_source", source)
+            sources.append((name, source_params["field"]))
+
+        rows_per_key = defaultdict(lambda: defaultdict(set))
+        for search_index, row_ids in segments:
+            doc_values = search_index.doc_values
+            for row_id in row_ids:
+                row_values = doc_values.get(row_id, {})
+                for key in itertools.product(
+                    *(set(row_values.get(field, [])) for _, field in sources)
+                ):
+                    rows_per_key[key][search_index].add(row_id)
+
+        keys = sorted(rows_per_key)
+        if "after" in params:
+            after = tuple(params["after"][name] for name, _ in sources)
+            keys = [key for key in keys if key > after]
+        keys = keys[: params.get("size", 10)]
+
+        result = {
+            "buckets": [
+                self._bucket(
+                    list(rows_per_key[key].items()),
+                    sub_aggs,
+                    key=dict(zip((name for name, _ in sources), key)),
+                )
+                for key in keys
+            ]
+        }
+        if keys:
+            result["after_key"] = result["buckets"][-1]["key"]
+
+        return result
+
+    def _filter(self, params, segments, sub_aggs):
+        return self._bucket(
+            [
+                (search_index, row_ids.intersection(search_index.query(params)))
+                for search_index, row_ids in segments
+            ],
+            sub_aggs,
+        )
+
+    def _filters(self, params, segments, sub_aggs):
+        return {
+            "buckets": {
+                name: self._filter(query, segments, sub_aggs)
+                for name, query in params["filters"].items()
+            }
+        }
+
+    def _nested(self, params, segments, sub_aggs):
+        nested_segments = []
+
+        for search_index, row_ids in segments:
+            nested_index = search_index.nested.get(params["path"])
+            if nested_index is None:
+                continue
+
+            nested_segments.append(
+                (
+                    nested_index,
+                    {
+                        nested_row_id
+                        for row_id in row_ids
+                        for path, nested_row_id in search_index.nested_rows.get(
+                            row_id, []
+                        )
+                        if path == params["path"]
+                    },
+                )
+            )
+
+        return self._bucket(nested_segments, sub_aggs)
+
+    def _children(self, params, segments, sub_aggs):
+        child_segments = []
+
+        for search_index, row_ids in segments:
+            child_segments.append(
+                (
+                    search_index,
+                    {
+                        child_id
+                        for row_id in row_ids
+                        for child_id in search_index.children.get(row_id, [])
+                        if search_index.joins[child_id][0] == params["type"]
+                    },
+                )
+            )
+
+        return self._bucket(child_segments, sub_aggs)
+
+
+def _bucket_order_value(bucket, order_by):
+    if order_by in ["_count", "_key"]:
+        return bucket[order_by[1:] if order_by == "_key" else "doc_count"]
+
+    # Single value metric ("name") or stat of a multi value one
+    # ("name.max")
+    name, _, stat = order_by.partition(".")
+    value = bucket[name].get(stat or "value")
+    return (value is None, value)
+
+
+class LocalTransport(Transport):
+    """
+    Elasticsearch transport that serves the requests in-process using an
+    in-memory document store instead of a cluster, so the code paths that
+    write to Elasticsearch (e.g. EsEntity.sync_entities) can be exercised
+    and measured without one.
+
+    Supports the index, get, mget, update, delete and bulk document APIs
+    plus creating, deleting and checking indices, managing their aliases
+    and mappings. The documents are kept in an inverted index (see
+    SearchIndex) used by the search, msearch, scroll and count APIs, which
+    support the subset of the query DSL used by this project: bool,
+    term(s), range, exists, ids, wildcard, prefix, fuzzy, match, nested,
+    has_child / has_parent (with inner hits), constant_score and
+    function_score with arithmetic doc value scripts. Searches can sort,
+    collapse (with inner hits), post filter, filter the source and
+    request doc values, and aggregate (see Aggregations). Scores are
+    simplified (e.g. term queries score their boost instead of BM25).
+
+    Every request is counted by endpoint in the "requests" counter, and
+    its duration recorded in "latencies" (see latency_stats), and every
+    written document in "documents".
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.indices = {}
+        self.aliases = {}
+        self.requests = Counter()
+        self.latencies = defaultdict(list)
+        self.documents = Counter()
+        self.scrolls = {}
+        self._seq_no = itertools.count()
+
+    def reset_stats(self):
+        self.requests.clear()
+        self.latencies.clear()
+        self.documents.clear()
+
+    def latency_stats(self):
+        """
+        Returns a dict of endpoint => count, total, mean, p50, p95 and max
+        seconds of its requests
+        """
+        stats = {}
+
+        for endpoint, latencies in self.latencies.items():
+            latencies = sorted(latencies)
+            stats[endpoint] = {
+                "count": len(latencies),
+                "total": sum(latencies),
+                "mean": sum(latencies) / len(latencies),
+                "p50": _percentile(latencies, 50),
+                "p95": _percentile(latencies, 95),
+                "max": latencies[-1],
+            }
+
+        return stats
+
+    def perform_request(self, method, url, headers=None, params=None, body=None):
+        parts = [unquote(part) for part in url.split("?")[0].split("/") if part]
+        params = {
+            key: value.decode("utf-8") if isinstance(value, bytes) else value
+            for key, value in (params or {}).items()
+        }
+
+        if isinstance(body, bytes):
+            body = body.decode("utf-8")
+        if isinstance(body, str) and parts[-1:] not in [["_bulk"], ["_msearch"]]:
+            body = self.serializer.loads(body)
+        elif body is not None and not isinstance(body, str):
+            # Round trip the body as a real request would (e.g. dates and
+            # decimals end up as strings and floats)
+            body = self.serializer.loads(self.serializer.dumps(body))
+
+        endpoint = self._endpoint(method, parts)
+        handler = getattr(self, "_{}".format(endpoint), None)
+
+        if handler is None:
+            raise RequestError(
+                400, "unsupported_endpoint", {"method": method, "url": url}
+            )
+
+        self.requests[endpoint] += 1
+        start = time.perf_counter()
+        try:
+            result = handler(parts, params, body)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.latencies[endpoint].append(elapsed)
+
+        if isinstance(result, dict) and "took" in result:
+            result["took"] = int(elapsed * 1000)
+
+        return result
+
+    @staticmethod
+    def _endpoint(method, parts):
+        if not parts:
+            return "info"
+
+        if parts[-1] == "_bulk":
+            return "bulk"
+
+        if parts[0] in ["_alias", "_aliases"]:
+            return parts[0][1:]
+
+        if parts == ["_search", "scroll"] and method == "DELETE":
+            return "clear_scroll"
+
+        if parts[0].startswith("_"):
+            return "_".join(part.lstrip("_") for part in parts)
+
+        if len(parts) == 1:
+            return {
+                "HEAD": "index_exists",
+                "PUT": "create_index",
+                "DELETE": "delete_index",
+                "GET": "get_index",
+            }[method]
+
+        action = parts[1]
+
+        if action == "_alias":
+            return {"PUT": "put_alias", "DELETE": "delete_alias"}.get(method, "alias")
+
+        if action == "_doc" and len(parts) == 2:
+            return "index"
+
+        if action in ["_doc", "_create"]:
+            return {
+                "PUT": "index",
+                "POST": "index",
+                "GET": "get",
+                "HEAD": "exists",
+                "DELETE": "delete",
+            }[method]
+
+        return action[1:]
+
+    # Indices
+
+    def _concrete_index(self, index):
+        # The index behind an alias, which must point to a single index to
+        # be used for document operations
+        if index not in self.aliases:
+            return index
+
+        if len(self.aliases[index]) != 1:
+            raise RequestError(
+                400, "illegal_argument_exception", {"alias": index}
+            )
+        return next(iter(self.aliases[index]))
+
+    def _resolve_indices(self, expression):
+        indices = []
+
+        for name in expression.split(","):
+            if name in self.aliases:
+                indices.extend(sorted(self.aliases[name]))
+            elif "*" in name:
+                indices.extend(sorted(fnmatch.filter(self.indices, name)))
+            elif name in self.indices:
+                indices.append(name)
+            else:
+                raise NotFoundError(404, "index_not_found_exception", {"index": name})
+
+        return list(dict.fromkeys(indices))
+
+    def _index_aliases(self, index):
+        return {
+            alias: {} for alias, indices in self.aliases.items() if index in indices
+        }
+
+    def _index_documents(self, index, create=True):
+        index = self._concrete_index(index)
+
+        if index not in self.indices:
+            if not create:
+                raise NotFoundError(
+                    404, "index_not_found_exception", {"index": index}
+                )
+            self.indices[index] = self._new_index({})
+        return self.indices[index]["documents"]
+
+    @staticmethod
+    def _new_index(body):
+        return {
+            "body": body,
+            "documents": {},
+            "search": SearchIndex(IndexMapping(body)),
+        }
+
+    def _info(self, parts, params, body):
+        return {"name": "local", "version": {"number": "7.17.0"}}
+
+    def _index_exists(self, parts, params, body):
+        return parts[0] in self.indices or parts[0] in self.aliases
+
+    def _create_index(self, parts, params, body):
+        if parts[0] in self.indices:
+            raise RequestError(
+                400, "resource_already_exists_exception", {"index": parts[0]}
+            )
+        self.indices[parts[0]] = self._new_index(body or {})
+        return {"acknowledged": True, "index": parts[0]}
+
+    def _delete_index(self, parts, params, body):
+        for index in self._resolve_indices(parts[0]):
+            self._remove_index(index)
+        return {"acknowledged": True}
+
+    def _remove_index(self, index):
+        del self.indices[index]
+        for alias_indices in self.aliases.values():
+            alias_indices.discard(index)
+        self.aliases = {
+            alias: indices for alias, indices in self.aliases.items() if indices
+        }
+
+    def _get_index(self, parts, params, body):
+        return {
+            index: dict(
+                copy.deepcopy(self.indices[index]["body"]),
+                aliases=self._index_aliases(index),
+            )
+            for index in self._resolve_indices(parts[0])
+        }
+
+    # Aliases
+
+    def _alias(self, parts, params, body):
+        if parts[0] == "_alias":
+            indices, names = list(self.indices), parts[1:]
+        else:
+            indices, names = self._resolve_indices(parts[0]), parts[2:]
+
+        patterns = names[0].split(",") if names else ["*"]
+
+        result = {}
+        for index in indices:
+            aliases = {
+                alias: {}
+                for alias in self._index_aliases(index)
+                if any(fnmatch.fnmatch(alias, pattern) for pattern in patterns)
+            }
+            if aliases or not names:
+                result[index] = {"aliases": aliases}
+
+        if names and not result:
+            raise NotFoundError(404, "aliases_not_found_exception", {"alias": names})
+
+        return result
+
+    def _put_alias(self, parts, params, body):
+        for index in self._resolve_indices(parts[0]):
+            self.aliases.setdefault(parts[2], set()).add(index)
+        return {"acknowledged": True}
+
+    def _delete_alias(self, parts, params, body):
+        self._aliases(
+            parts,
+            params,
+            {"actions": [{"remove": {"index": parts[0], "alias": parts[2]}}]},
+        )
+        return {"acknowledged": True}
+
+    def _aliases(self, parts, params, body):
+        # Applies the actions atomically, validating them first
+        for action in body["actions"]:
+            ((action_type, options),) = action.items()
+            if action_type not in ["add", "remove", "remove_index"]:
+                raise RequestError(400, "unsupported_alias_action", action)
+            self._resolve_indices(options["index"])
+
+        for action in body["actions"]:
+            ((action_type, options),) = action.items()
+            indices = self._resolve_indices(options["index"])
+
+            for index in indices:
+                if action_type == "add":
+                    self.aliases.setdefault(options["alias"], set()).add(index)
+                elif action_type == "remove":
+                    self.aliases.get(options["alias"], set()).discard(index)
+                else:
+                    self._remove_index(index)
+
+        self.aliases = {
+            alias: indices for alias, indices in self.aliases.items() if indices
+        }
+        return {"acknowledged": True}
+
+    def _mapping(self, parts, params, body):
+        if parts[0].startswith("_"):
+            indices, names = list(self.indices), parts[1:]
+        else:
+            indices, names = self._resolve_indices(parts[0]), parts[2:]
+
+        if body is not None:
+            for index in indices:
+                self.indices[index]["search"].mapping.update(body)
+            return {"acknowledged": True}
+
+        if not names:
+            return {
+                index: {"mappings": self.indices[index]["body"].get("mappings", {})}
+                for index in indices
+            }
+
+        # Field mappings, /{index}/_mapping/field/{fields}
+        patterns = names[1].split(",")
+        result = {}
+        for index in indices:
+            properties = self.indices[index]["search"].mapping.properties
+            result[index] = {
+                "mappings": {
+                    field: {
+                        "full_name": field,
+                        "mapping": {field.split(".")[-1]: properties[field]},
+                    }
+                    for field in properties
+                    if any(fnmatch.fnmatchcase(field, x) for x in patterns)
+                }
+            }
+
+        return result
+
+    def _refresh(self, parts, params, body):
+        return {"_shards": {"failed": 0}}
+
+    # Documents
+
+    def _index(self, parts, params, body):
+        doc_id = parts[2] if len(parts) > 2 else str(next(self._seq_no))
+        op_type = "create" if parts[1] == "_create" else params.get("op_type")
+        return self._raise_for_error(
+            self._write(
+                parts[0], doc_id, body, params.get("routing"), op_type == "create"
+            )
+        )
+
+    def _write(self, index, doc_id, source, routing=None, create=False):
+        index = self._concrete_index(index)
+        documents = self._index_documents(index)
+
+        if create and doc_id in documents:
+            return self._error(
+                index, doc_id, 409, "version_conflict_engine_exception"
+            )
+
+        previous = documents.get(doc_id)
+        documents[doc_id] = {
+            "_source": source,
+            "_routing": routing,
+            "_version": previous["_version"] + 1 if previous else 1,
+            "_seq_no": next(self._seq_no),
+        }
+        self.documents[index] += 1
+
+        search_index = self.indices[index]["search"]
+        search_index.remove(doc_id)
+        search_index.add(doc_id, source)
+
+        return self._result(
+            index,
+            doc_id,
+            documents[doc_id],
+            "updated" if previous else "created",
+            200 if previous else 201,
+        )
+
+    def _get(self, parts, params, body):
+        index = self._concrete_index(parts[0])
+        documents = self._index_documents(index, create=False)
+        hit = self._hit(index, parts[2], documents.get(parts[2]))
+
+        if not hit["found"]:
+            raise NotFoundError(404, "not_found", hit)
+
+        return hit
+
+    def _exists(self, parts, params, body):
+        return parts[2] in self._index_documents(parts[0], create=False)
+
+    def _mget(self, parts, params, body):
+        default_index = parts[0] if len(parts) > 1 else None
+        docs = body.get("docs") or [{"_id": doc_id} for doc_id in body["ids"]]
+
+        result = []
+        for doc in docs:
+            index = self._concrete_index(doc.get("_index", default_index))
+            documents = self._index_documents(index, create=False)
+            result.append(self._hit(index, doc["_id"], documents.get(doc["_id"])))
+
+        return {"docs": result}
+
+    def _update(self, parts, params, body):
+        return self._raise_for_error(
+            self._apply_update(parts[0], parts[2], body, params.get("routing"))
+        )
+
+    def _apply_update(self, index, doc_id, body, routing=None):
+        index = self._concrete_index(index)
+        documents = self._index_documents(index)
+        document = documents.get(doc_id)
+
+        if "script" in body:
+            return self._error(index, doc_id, 400, "script_not_supported")
+
+        if document is None:
+            if body.get("doc_as_upsert"):
+                return self._write(index, doc_id, body["doc"], routing)
+            if "upsert" in body:
+                return self._write(index, doc_id, body["upsert"], routing)
+            return self._error(index, doc_id, 404, "document_missing_exception")
+
+        source = copy.deepcopy(document["_source"])
+        _merge_source(source, body.get("doc", {}))
+
+        if source == document["_source"]:
+            return self._result(index, doc_id, document, "noop", 200)
+
+        return self._write(index, doc_id, source, document["_routing"])
+
+    def _delete(self, parts, params, body):
+        result = self._apply_delete(parts[0], parts[2])
+
+        if result["result"] == "not_found":
+            raise NotFoundError(404, "not_found", result)
+
+        return result
+
+    def _apply_delete(self, index, doc_id):
+        index = self._concrete_index(index)
+        documents = self._index_documents(index)
+        document = documents.pop(doc_id, None)
+
+        if document is None:
+            return self._result(index, doc_id, None, "not_found", 404)
+
+        self.indices[index]["search"].remove(doc_id)
+        self.documents[index] += 1
+        return self._result(index, doc_id, document, "deleted", 200)
+
+    def _bulk(self, parts, params, body):
+        if isinstance(body, (list, tuple)):
+            body = "\n".join(
+                line if isinstance(line, str) else self.serializer.dumps(line)
+                for line in body
+            )
+
+        lines = iter(line for line in body.split("\n") if line.strip())
+        default_index = parts[0] if len(parts) > 1 else None
+
+        items = []
+        for line in lines:
+            ((op_type, meta),) = self.serializer.loads(line).items()
+            index = meta.get("_index", default_index)
+            doc_id = meta.get("_id")
+            routing = meta.get("routing", meta.get("_routing"))
+
+            if op_type == "delete":
+                result = self._apply_delete(index, doc_id)
+            else:
+                source = self.serializer.loads(next(lines))
+                if op_type == "update":
+                    result = self._apply_update(index, doc_id, source, routing)
+                else:
+                    result = self._write(
+                        index,
+                        doc_id or str(next(self._seq_no)),
+                        source,
+                        routing,
+                        op_type == "create",
+                    )
+
+            items.append({op_type: result})
+
+        return {
+            "took": 0,
+            "errors": any(
+                "error" in result for x in items for result in x.values()
+            ),
+            "items": items,
+        }
+
+    # Search
+
+    def _search(self, parts, params, body):
+        index = parts[0] if len(parts) > 1 else None
+        return self._execute_search(index, body or {}, params)
+
+    def _execute_search(self, index, body, params):
+        unsupported_keys = set(body) - SEARCH_BODY_KEYS
+        if unsupported_keys:
+            raise _unsupported("unsupported_search_option", sorted(unsupported_keys))
+
+        query = body.get("query", {"match_all": {}})
+        indices = self._resolve_indices(index) if index else list(self.indices)
+
+        # Matching rows and inner hits requested by the query, per index
+        matches = []
+        contexts = {}
+        for index_name in indices:
+            search_index = self.indices[index_name]["search"]
+            contexts[index_name] = SearchContext()
+            rows = search_index.query(query, contexts[index_name])
+            matches.append((index_name, search_index, rows))
+
+        aggs = body.get("aggs", body.get("aggregations"))
+        aggregations = None
+        if aggs:
+            aggregations = Aggregations().run(
+                aggs,
+                [(search_index, set(rows)) for _, search_index, rows in matches],
+            )
+
+        hits = []
+        for index_name, search_index, rows in matches:
+            if "post_filter" in body:
+                post_filter_rows = search_index.query(body["post_filter"])
+                rows = {
+                    row_id: score
+                    for row_id, score in rows.items()
+                    if row_id in post_filter_rows
+                }
+
+            hits.extend(
+                Hit(index_name, search_index, row_id, score)
+                for row_id, score in rows.items()
+            )
+
+        total = len(hits)
+        max_score = max((hit.score for hit in hits), default=None)
+        hits, sort_values = _sort_hits(hits, body.get("sort"))
+
+        collapse = body.get("collapse")
+        groups = OrderedDict()
+
+        def collapse_key(hit):
+            values = hit.search_index.doc_values.get(hit.row_id, {}).get(
+                collapse["field"]
+            )
+            return values[0] if values else None
+
+        if collapse:
+            for hit in hits:
+                groups.setdefault(collapse_key(hit), []).append(hit)
+            hits = [group[0] for group in groups.values()]
+
+        def render(hit):
+            response = self._search_hit(hit, sort_values, body, contexts)
+
+            if collapse:
+                key = collapse_key(hit)
+                if key is not None:
+                    response.setdefault("fields", {})[collapse["field"]] = [key]
+
+                for inner_hits in _as_list(collapse.get("inner_hits")):
+                    response.setdefault("inner_hits", {})[
+                        inner_hits["name"]
+                    ] = self._inner_hits(groups[key], inner_hits, contexts)
+
+            return response
+
+        start = int(params.get("from", body.get("from", 0)))
+        size = int(params.get("size", body.get("size", 10)))
+
+        response = {
+            "took": 0,
+            "timed_out": False,
+            "_shards": SHARDS,
+            "hits": {
+                "total": {"value": total, "relation": "eq"},
+                "max_score": max_score if sort_values is None else None,
+                "hits": [render(hit) for hit in hits[start : start + size]],
+            },
+        }
+
+        if aggregations is not None:
+            response["aggregations"] = aggregations
+
+        if "scroll" in params:
+            scroll_id = uuid.uuid4().hex
+            self.scrolls[scroll_id] = (hits[start + size :], size, render, total)
+            response["_scroll_id"] = scroll_id
+
+        return response
+
+    def _search_hit(self, hit, sort_values, request, contexts):
+        # Response of a hit, with the fields and inner hits requested by the
+        # given search (or inner hits) request
+        response = self._hit(
+            hit.index, hit.row_id, self.indices[hit.index]["documents"][hit.row_id]
+        )
+        del response["found"]
+
+        if sort_values is None:
+            response["_score"] = hit.score
+        else:
+            response["_score"] = hit.score if request.get("track_scores") else None
+            response["sort"] = sort_values[(hit.index, hit.row_id)]
+
+        source_filter = request.get("_source", True)
+        if source_filter is False:
+            del response["_source"]
+        elif source_filter is not True:
+            if isinstance(source_filter, dict):
+                includes = _as_list(source_filter.get("includes"))
+                excludes = _as_list(source_filter.get("excludes"))
+            else:
+                includes, excludes = _as_list(source_filter), []
+            response["_source"] = _filter_source(
+                response["_source"], includes, excludes
+            )
+
+        for field in request.get("docvalue_fields", []):
+            if isinstance(field, dict):
+                field = field["field"]
+            values = hit.search_index.doc_values.get(hit.row_id, {}).get(field)
+            if values:
+                response.setdefault("fields", {})[field] = sorted(values)
+
+        for name, (spec, matches) in contexts[hit.index].inner_hits.items():
+            if hit.row_id not in matches:
+                continue
+
+            related_hits = [
+                Hit(hit.index, hit.search_index, row_id, score)
+                for row_id, score in matches[hit.row_id]
+            ]
+            response.setdefault("inner_hits", {})[name] = self._inner_hits(
+                related_hits, spec, contexts
+            )
+
+        return response
+
+    def _inner_hits(self, hits, spec, contexts):
+        hits, sort_values = _sort_hits(hits, spec.get("sort"))
+        start = spec.get("from", 0)
+
+        return {
+            "hits": {
+                "total": {"value": len(hits), "relation": "eq"},
+                "max_score": max((hit.score for hit in hits), default=None)
+                if sort_values is None
+                else None,
+                "hits": [
+                    self._search_hit(hit, sort_values, spec, contexts)
+                    for hit in hits[start : start + spec.get("size", 3)]
+                ],
+            }
+        }
+
+    def _search_scroll(self, parts, params, body):
+        scroll_id = (body or {}).get("scroll_id", params.get("scroll_id"))
+
+        try:
+            hits, size, render, total = self.scrolls[scroll_id]
+        except KeyError:
+            raise NotFoundError(404, "search_context_missing_exception", scroll_id)
+
+        self.scrolls[scroll_id] = (hits[size:], size, render, total)
+
+        return {
+            "_scroll_id": scroll_id,
+            "took": 0,
+            "timed_out": False,
+            "_shards": SHARDS,
+            "hits": {
+                "total": {"value": total, "relation": "eq"},
+                "max_score": None,
+                "hits": [render(hit) for hit in hits[:size]],
+            },
+        }
+
+    def _clear_scroll(self, parts, params, body):
+        scroll_ids = _as_list((body or {}).get("scroll_id"))
+        freed = [x for x in scroll_ids if self.scrolls.pop(x, None) is not None]
+        return {"succeeded": True, "num_freed": len(freed)}
+
+    def _msearch(self, parts, params, body):
+        if isinstance(body, (list, tuple)):
+            lines = [
+                line if isinstance(line, dict) else self.serializer.loads(line)
+                for line in body
+            ]
+        else:
+            lines = [
+                self.serializer.loads(line) for line in body.split("\n") if line.strip()
+            ]
+
+        default_index = parts[0] if len(parts) > 1 else None
+        responses = []
+
+        for header, search_body in zip(lines[::2], lines[1::2]):
+            index = header.get("index", default_index)
+            if isinstance(index, list):
+                index = ",".join(index)
+
+            start = time.perf_counter()
+            try:
+                response = self._execute_search(index, search_body, {})
+            except TransportError as e:
+                response = {
+                    "error": {"type": e.error, "reason": str(e.info)},
+                    "status": e.status_code,
+                }
+            else:
+                response["took"] = int((time.perf_counter() - start) * 1000)
+                response["status"] = 200
+
+            responses.append(response)
+
+        return {"took": 0, "responses": responses}
+
+    def _count(self, parts, params, body):
+        index = parts[0] if len(parts) > 1 else None
+        query = (body or {}).get("query", {"match_all": {}})
+        indices = self._resolve_indices(index) if index else list(self.indices)
+
+        return {
+            "count": sum(
+                len(self.indices[index_name]["search"].query(query))
+                for index_name in indices
+            ),
+            "_shards": SHARDS,
+        }
+
+    # Responses
+
+    @staticmethod
+    def _hit(index, doc_id, document):
+        if document is None:
+            return {"_index": index, "_type": "_doc", "_id": doc_id, "found": False}
+
+        hit = {
+            "_index": index,
+            "_type": "_doc",
+            "_id": doc_id,
+            "_version": document["_version"],
+            "_seq_no": document["_seq_no"],
+            "_primary_term": 1,
+            "found": True,
+            "_source": copy.deepcopy(document["_source"]),
+        }
+        if document["_routing"]:
+            hit["_routing"] = document["_routing"]
+        return hit
+
+    @staticmethod
+    def _result(index, doc_id, document, result, status):
+        return {
+            "_index": index,
+            "_type": "_doc",
+            "_id": doc_id,
+            "_version": document["_version"] if document else 1,
+            "result": result,
+            "status": status,
+        }
+
+    @staticmethod
+    def _raise_for_error(result):
+        if "error" not in result:
+            return result
+
+        exception_class = {404: NotFoundError, 409: ConflictError}.get(
+            result["status"], RequestError
+        )
+        raise exception_class(result["status"], result["error"]["type"], result)
+
+    @staticmethod
+    def _error(index, doc_id, status, error_type):
+        return {
+            "_index": index,
+            "_type": "_doc",
+            "_id": doc_id,
+            "status": status,
+            "error": {"type": error_type, "reason": error_type},
+        }
+
+
+def _merge_source(source, partial_source):
+    # Partial updates merge objects recursively and replace any other value
+    for key, value in partial_source.items():
+        if isinstance(value, dict) and isinstance(source.get(key), dict):
+            _merge_source(source[key], value)
+        else:
+            source[key] = value
+
+
+def _filter_source(source, includes, excludes, prefix=""):
+    # Source filtering of the search hits, a field is included if its path
+    # matches an include pattern or it is an object with included fields
+    result = {}
+
+    for key, value in source.items():
+        path = prefix + key
+
+        if any(fnmatch.fnmatchcase(path, pattern) for pattern in excludes):
+            continue
+
+        if not includes or any(
+            fnmatch.fnmatchcase(path, pattern) for pattern in includes
+        ):
+            if isinstance(value, dict):
+                value = _filter_source(value, [], excludes, path + ".")
+            result[key] = value
+        elif isinstance(value, dict) and any(
+            pattern.startswith(path + ".") for pattern in includes
+        ):
+            result[key] = _filter_source(value, includes, excludes, path + ".")
+
+    return result
+
+
+def _percentile(sorted_values, percentile):
+    # Nearest rank percentile
+    rank = math.ceil(percentile / 100 * len(sorted_values))
+    return sorted_values[max(rank - 1, 0)]
+
+
+class LocalElasticsearch(Elasticsearch):
+    """
+    Elasticsearch client backed by a LocalTransport (see local_elasticsearch)
+    """
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault("transport_class", LocalTransport)
+        super().__init__("http://localhost:9200", **kwargs)
+
+
+@contextmanager
+def local_elasticsearch(client=None):
+    """
+    Context manager that replaces settings.ES and the default
+    elasticsearch_dsl connection (used by the EsProduct / EsEntity
+    documents) with an in-process LocalElasticsearch client, restoring
+    them at the end. Yields the client, whose transport holds the
+    documents and the request counters.
+    """
+    from django.conf import settings
+    from elasticsearch_dsl import connections
+
+    client = client or LocalElasticsearch()
+
+    previous_es = getattr(settings, "ES", None)
+    try:
+        previous_connection = connections.get_connection("default")
+    except KeyError:
+        previous_connection = None
+
+    settings.ES = client
+    connections.add_connection("default", client)
+
+    try:
+        yield client
+    finally:
+        settings.ES = previous_es
+        if previous_connection is None:
+            connections.remove_connection("default")
+        else:
+            connections.add_connection("default", previous_connection)
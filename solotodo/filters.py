@@ -10,7 +10,7 @@ from solotodo.filter_querysets import create_store_filter, \
 from solotodo.models import Entity, StoreUpdateLog, \
     Product, EntityHistory, Country, Store, StoreType, Lead, Website, \
     Visit, Rating, ProductPicture, \
-    Brand, StoreSection, EntitySectionPosition
+    Brand, StoreSection, EntitySectionPosition, EntityDailyPrice
 
 
 class UserFilterSet(rest_framework.FilterSet):
@@ -475,7 +475,8 @@ class ProductFilterSet(rest_framework.FilterSet):
 
 class EntityHistoryFilterSet(rest_framework.FilterSet):
     timestamp = IsoDateTimeFromToRangeFilter(
-        field_name='timestamp'
+        field_name='timestamp',
+        method='_timestamp'
     )
     stores = CustomModelMultipleChoiceFilter(
         queryset=create_store_filter(),
@@ -509,11 +510,66 @@ class EntityHistoryFilterSet(rest_framework.FilterSet):
 
         return queryset
 
+    def _timestamp(self, queryset, name, value):
+        if value:
+            return queryset.filter_seen_between(value.start, value.stop)
+
+        return queryset
+
+    def expanded_qs(self, queryset=None):
+        # Expands the compressed registries of the given queryset (by
+        # default self.qs) within the requested timestamp range
+        if queryset is None:
+            queryset = self.qs
+
+        timestamp = self.form.cleaned_data.get('timestamp')
+
+        if timestamp:
+            return list(queryset.expand(timestamp.start, timestamp.stop))
+
+        return list(queryset.expand())
+
     class Meta:
         model = EntityHistory
         fields = []
 
 
+class EntityDailyPriceFilterSet(rest_framework.FilterSet):
+    timestamp = IsoDateTimeFromToRangeFilter(
+        field_name='date',
+        method='_timestamp'
+    )
+    stores = CustomModelMultipleChoiceFilter(
+        queryset=create_store_filter(),
+        field_name='entity__store',
+        label='Stores'
+    )
+    countries = rest_framework.ModelMultipleChoiceFilter(
+        queryset=Country.objects.all(),
+        field_name='entity__store__country',
+        label='Countries'
+    )
+
+    @property
+    def qs(self):
+        qs = super(EntityDailyPriceFilterSet, self).qs
+        if self.request:
+            qs = qs.filter_by_user_perms(self.request.user,
+                                         'view_entity_history')
+
+        return qs
+
+    def _timestamp(self, queryset, name, value):
+        if value:
+            return queryset.filter_by_timestamp_range(value.start, value.stop)
+
+        return queryset
+
+    class Meta:
+        model = EntityDailyPrice
+        fields = []
+
+
 class LeadFilterSet(rest_framework.FilterSet):
     timestamp = IsoDateTimeFromToRangeFilter(
         field_name='timestamp'
@@ -689,7 +745,7 @@ class EntitySectionPositionFilterSet(rest_framework.FilterSet):
         field_name='is_active', method='_is_active', label='Is active?')
 
     timestamp = IsoDateTimeFromToRangeFilter(
-        field_name='entity_history__timestamp'
+        field_name='timestamp'
     )
 
     @property
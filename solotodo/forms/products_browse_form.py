@@ -1,4 +1,6 @@
-from collections import OrderedDict
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
 
 from django import forms
 from django.conf import settings
@@ -6,7 +8,7 @@ from django.core.files.storage import default_storage
 from django.utils.text import slugify
 
 from rest_framework.reverse import reverse
-from elasticsearch_dsl import A, Q
+from elasticsearch_dsl import A, MultiSearch, Q
 
 from solotodo.filters import CategoryFullBrowseEntityFilterSet
 from solotodo.forms.product_specs_form import ProductSpecsForm
@@ -82,10 +84,38 @@ class ProductsBrowseForm(forms.Form):
 
     COLLAPSE_SIZE = 5
 
+    # The entities of every product of the page are returned along with it
+    # (as inner hits of its has_child query) to calculate its prices. If a
+    # product has more matching entities than this its prices are
+    # calculated using a separate aggregation.
+    PRICING_INNER_HITS_SIZE = 100
+    PRICING_FIELDS = [
+        'normal_price_usd_with_coupon',
+        'offer_price_usd_with_coupon',
+        'currency_id',
+        'normal_price_with_coupon',
+        'offer_price_with_coupon',
+    ]
+
     def __init__(self, user, *args, **kwargs):
         self.user = user
+        # Phase name => seconds spent in it by get_category_products
+        self.timings = OrderedDict()
         super(ProductsBrowseForm, self).__init__(*args, **kwargs)
 
+    @contextmanager
+    def timed(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[phase] = time.perf_counter() - start
+
+    def server_timing(self):
+        # Value of the Server-Timing header with the timings of the phases
+        return ', '.join('{};dur={:.1f}'.format(phase, seconds * 1000)
+                         for phase, seconds in self.timings.items())
+
     def clean_stores(self):
         requested_stores = self.cleaned_data['stores']
 
@@ -147,8 +177,68 @@ class ProductsBrowseForm(forms.Form):
 
         return price_filter
 
+    def get_stored_discount_sort_params(self, store_ids):
+        # The discounts kept in the product documents (see
+        # EsProduct.update_discounts) are calculated from every entity of
+        # the product, or from every entity of each country. Returns the
+        # sort by the one that matches the requested entities, or None if
+        # they are filtered any further (e.g. by condition, marketplace,
+        # price or a subset of the stores of a country)
+        if self.cleaned_data['exclude_refurbished'] or \
+                self.cleaned_data['exclude_marketplace'] or \
+                self.get_price_filter() != Q():
+            return None
+
+        store_ids = set(store_ids)
+        stores_by_country = {}
+        for store_id, country_id in Store.objects.values_list('id', 'country'):
+            stores_by_country.setdefault(country_id, set()).add(store_id)
+
+        if store_ids == set().union(*stores_by_country.values()):
+            return {'discount': {'order': 'desc', 'missing': 0}}
+
+        for country_id, country_store_ids in stores_by_country.items():
+            if store_ids == country_store_ids:
+                return {
+                    'country_discounts.{}'.format(country_id): {
+                        'order': 'desc',
+                        'missing': 0,
+                        # Until a product of the country gets its discount
+                        'unmapped_type': 'float',
+                    }
+                }
+
+        return None
+
+    def get_discount_per_product(self, entities_filter, all_specs_filter):
+        # Returns a dict of product id (as a string) => discount calculated
+        # from the entities matching the filters
+        from solotodo.models import EsEntity
+
+        discounts_search = EsEntity.search()\
+            .filter(entities_filter)\
+            .filter('has_parent', parent_type='product',
+                    query=all_specs_filter)
+
+        discounts_search.aggs\
+            .bucket('products', 'terms', field='product_id', size=10000)\
+            .metric('min_price', 'min', field='offer_price_usd')\
+            .metric('min_reference_price', 'min',
+                    field='reference_offer_price_usd')
+
+        with self.timed('discounts'):
+            discount_buckets = \
+                discounts_search[:0].execute().aggs.products.buckets
+
+        return {
+            str(bucket['key']): EsProduct.calculate_discount(
+                bucket['min_price']['value'],
+                bucket['min_reference_price']['value'])
+            for bucket in discount_buckets
+        }
+
     def get_category_products(self, request, category=None):
-        from solotodo.models import EsProduct, EsEntity
+        from solotodo.models import EsProduct
 
         assert self.is_valid()
 
@@ -227,56 +317,48 @@ class ProductsBrowseForm(forms.Form):
             marketplace_filter
         all_specs_filter = specs_form.get_filter()
 
+        # Inner hits with the entities used to calculate the prices of the
+        # products, see PRICING_INNER_HITS_SIZE
+        pricing_inner_hits = {
+            'name': 'pricing_entities',
+            'size': self.PRICING_INNER_HITS_SIZE,
+            '_source': False,
+            'docvalue_fields': self.PRICING_FIELDS,
+            'sort': [{'offer_price_usd_with_coupon': 'asc'}]
+        }
+
         if ordering == 'discount':
-            # Create a second search to determine the discount of each product.
-            # As far as I know we can't do this calculation inside the main
-            # query because it uses aggregations that can't be associated
-            # with a particular product directly.
-
-            discounts_search = EsEntity.search()\
-                .filter(entities_filter)\
-                .filter('has_parent', parent_type='product',
-                        query=all_specs_filter)
-
-            discounts_search.aggs\
-                .bucket('products', 'terms', field='product_id', size=10000)\
-                .metric('min_price', 'min', field='offer_price_usd')\
-                .metric('min_reference_price', 'min',
-                        field='reference_offer_price_usd')\
-                .pipeline('discount', 'bucket_script',
-                          buckets_path={
-                              'min_price': 'min_price',
-                              'min_reference_price': 'min_reference_price'
-                          },
-                          script="""
-                                params.min_reference_price - params.min_price; 
-                            """
-                          )
-
-            discount_per_product_dict = {
-                x['key']: max(x['discount']['value'], 0) for x in
-                discounts_search[:0].execute().aggs.products.buckets
-            }
+            sort_params = self.get_stored_discount_sort_params(store_ids)
+
+            if not sort_params:
+                # The entities are filtered in a way the stored discounts
+                # don't account for, so the discount of each product is
+                # calculated for this request
+                discount_per_product_dict = self.get_discount_per_product(
+                    entities_filter, all_specs_filter)
+
+                search = search.query(
+                    Q('script_score',
+                      query=Q(),
+                      script={
+                          'params': discount_per_product_dict,
+                          'source': """
+                      if (params.containsKey(doc['product_id'].value.toString()))
+                          params.get(doc['product_id'].value.toString());
+                      else
+                          0;
+                      """
+                      }))
+                sort_params = {'_score': 'desc'}
 
-            search = search.query(
-                Q('script_score',
-                  query=Q(),
-                  script={
-                      'params': discount_per_product_dict,
-                      'source': """
-                  if (params.containsKey(doc['product_id'].value.toString())) 
-                      params.get(doc['product_id'].value.toString()); 
-                  else 
-                      0;
-                  """
-                  }))
             search = search.filter('has_child', type='entity',
-                                   query=entities_filter)
-            sort_params = {'_score': 'desc'}
+                                   query=entities_filter,
+                                   inner_hits=pricing_inner_hits)
             keyword_search_type = 'filter'
         elif ordering == 'relevance':
             search = search.filter('has_child', type='entity',
-                                   query=entities_filter)
+                                   query=entities_filter,
+                                   inner_hits=pricing_inner_hits)
             keyword_search_type = 'query'
             sort_params = {'_score': 'desc'}
         elif ordering:
@@ -293,7 +375,8 @@ class ProductsBrowseForm(forms.Form):
                       script_score={'script': script_score},
                       query=Q('bool', filter=entities_filter, must=Q()))
             search = search.query('has_child', type='entity', query=query,
-                                  score_mode=ordering_metadata['score_mode'])
+                                  score_mode=ordering_metadata['score_mode'],
+                                  inner_hits=pricing_inner_hits)
 
             sort_params = {'_score': ordering_metadata['direction']}
             keyword_search_type = 'filter'
@@ -301,7 +384,8 @@ class ProductsBrowseForm(forms.Form):
             sort_params = specs_form.get_ordering()
             assert sort_params
             search = search.filter('has_child', type='entity',
-                                   query=entities_filter)
+                                   query=entities_filter,
+                                   inner_hits=pricing_inner_hits)
             keyword_search_type = 'filter'
 
         keywords = self.cleaned_data['search']
@@ -317,21 +401,23 @@ class ProductsBrowseForm(forms.Form):
             else:
                 raise Exception('Invalid keyword_search_type')
 
-        search = search.sort(sort_params)
-        search = search.post_filter(all_specs_filter)
+        # The hits and the aggregations are requested as two searches of a
+        # single msearch, so ES runs them in parallel. The aggregations
+        # are not affected by the post filter, sorting or collapsing.
+        aggs_search = search[:0]
 
         # Second part of the query. Add the aggregations of the specs
         all_filtered_bucket, active_filters_buckets = \
             specs_form.get_aggregation_buckets()
 
-        filtered_products_bucket = search.aggs.bucket(
+        filtered_products_bucket = aggs_search.aggs.bucket(
             'all_filtered_products', all_filtered_bucket)
         for field_name, bucket in active_filters_buckets.items():
-            search.aggs.bucket(field_name, bucket)
+            aggs_search.aggs.bucket(field_name, bucket)
 
         # Third part of the query. Obtain the stats aggregation for the price
         # results
-        search.aggs.bucket('entity_prices', 'children', type='entity')\
+        aggs_search.aggs.bucket('entity_prices', 'children', type='entity')\
             .metric('offer_price_usd', 'stats', field='offer_price_usd_with_coupon')\
             .metric('normal_price_usd', 'stats', field='normal_price_usd_with_coupon')
 
@@ -341,6 +427,9 @@ class ProductsBrowseForm(forms.Form):
             field=self.cleaned_data['bucket_field']
         )
 
+        search = search.sort(sort_params)
+        search = search.post_filter(all_specs_filter)
+
         # Collapse (group) the search results based on the given bucket field
         # or the default one
         search = search.update_from_dict({
@@ -358,61 +447,45 @@ class ProductsBrowseForm(forms.Form):
         page = self.cleaned_data['page']
         page_size = self.cleaned_data['page_size']
         offset = (page - 1) * page_size
-        search_result = search[offset:offset + page_size].execute().to_dict()
+        search = search[offset:offset + page_size]
 
-        # Obtain the full pricing information of the search results
-        search_result_product_ids = []
-        for hit_1 in search_result['hits']['hits']:
-            for hit_2 in hit_1['inner_hits']['inner_products']['hits']['hits']:
-                search_result_product_ids.append(
-                    hit_2['_source']['product_id'])
+        with self.timed('search'):
+            multi_search = MultiSearch().add(search).add(aggs_search)
+            search_response, aggs_response = multi_search.execute()
 
-        prices_search = EsEntity.search() \
-            .filter(entities_filter).filter(
-            'terms', product_id=search_result_product_ids)
+        search_result = search_response.to_dict()
+        aggregations = aggs_response.to_dict()['aggregations']
 
-        prices_search.aggs \
-            .bucket('per_product', 'terms', field='product_id',
-                    size=self.COLLAPSE_SIZE * page_size) \
-            .metric('normal_price_usd', 'min', field='normal_price_usd_with_coupon') \
-            .metric('offer_price_usd', 'min', field='offer_price_usd_with_coupon') \
-            .bucket('price_per_currency', 'terms', field='currency_id') \
-            .metric('normal_price', 'min', field='normal_price_with_coupon') \
-            .metric('offer_price', 'min', field='offer_price_with_coupon')
-
-        price_results = prices_search[:0].execute().to_dict()
-
-        # Assemble the serialized json
-        product_prices_agg = price_results['aggregations']['per_product'][
-            'buckets']
-        result_count = search_result['aggregations'][
-            'all_filtered_products'].pop('result_count')['value']
+        # Obtain the full pricing information of the search results from
+        # the entities of their inner hits
         product_metadata_dict = {}
+        unpriced_product_ids = []
+
+        with self.timed('pricing'):
+            for hit_1 in search_result['hits']['hits']:
+                for hit_2 in hit_1['inner_hits']['inner_products']['hits'][
+                        'hits']:
+                    product_id = hit_2['_source']['product_id']
+                    entity_hits = hit_2.get('inner_hits', {}).get(
+                        'pricing_entities', {}).get('hits')
+
+                    if entity_hits is None or \
+                            entity_hits['total']['value'] > \
+                            len(entity_hits['hits']):
+                        unpriced_product_ids.append(product_id)
+                        continue
 
-        for product_price_bucket in product_prices_agg:
-            product_pricing_metadata = {
-                'normal_price_usd': str(product_price_bucket[
-                                            'normal_price_usd']['value']),
-                'offer_price_usd': str(product_price_bucket[
-                                           'offer_price_usd']['value'])
-            }
-            prices_per_currency = []
-            for currency_bucket in product_price_bucket[
-                    'price_per_currency']['buckets']:
-                prices_per_currency.append({
-                    'currency': reverse('currency-detail',
-                                        args=[currency_bucket['key']],
-                                        request=request),
-                    'normal_price':
-                        str(currency_bucket['normal_price']['value']),
-                    'offer_price':
-                        str(currency_bucket['offer_price']['value'])
-                })
+                    product_metadata_dict[product_id] = \
+                        self.get_product_pricing_metadata(
+                            request, entity_hits['hits'])
 
-            product_pricing_metadata['prices_per_currency'] = \
-                prices_per_currency
-            product_metadata_dict[product_price_bucket['key']] = \
-                product_pricing_metadata
+            if unpriced_product_ids:
+                product_metadata_dict.update(
+                    self.get_products_pricing_metadata(
+                        request, entities_filter, unpriced_product_ids))
+
+        result_count = aggregations[
+            'all_filtered_products'].pop('result_count')['value']
 
         collapsed_results = []
         for hit in search_result['hits']['hits']:
@@ -444,10 +517,15 @@ class ProductsBrowseForm(forms.Form):
                 product_metadata = product_metadata_dict.get(
                     product['id'], None)
 
+                if ordering == 'discount' and '_score' not in sort_params:
+                    score = inner_hit['sort'][0]
+                else:
+                    score = inner_hit['_score']
+
                 product_entries.append({
                     'product': product,
                     'metadata': {
-                        'score': inner_hit['_score'],
+                        'score': score,
                         'prices_per_currency': product_metadata[
                             'prices_per_currency'],
                         'normal_price_usd': product_metadata[
@@ -463,7 +541,7 @@ class ProductsBrowseForm(forms.Form):
             }
             collapsed_results.append(collapsed_entry)
 
-        price_ranges_agg = search_result['aggregations']['entity_prices']
+        price_ranges_agg = aggregations['entity_prices']
         price_ranges = {}
         for price_type in ['normal_price_usd', 'offer_price_usd']:
             price_range = price_ranges_agg[price_type]
@@ -476,7 +554,7 @@ class ProductsBrowseForm(forms.Form):
                 'avg': price_range['avg']
             }
 
-        aggs = specs_form.flatten_es_aggs(search_result['aggregations'])
+        aggs = specs_form.flatten_es_aggs(aggregations)
 
         result = {
             'count': result_count,
@@ -487,6 +565,95 @@ class ProductsBrowseForm(forms.Form):
 
         return result
 
+    def get_product_pricing_metadata(self, request, entity_hits):
+        # Calculates the pricing metadata of a product from the doc values
+        # of its matching entities, in the same format as
+        # get_products_pricing_metadata
+        def min_value(hits, field):
+            values = [hit['fields'][field][0] for hit in hits
+                      if hit.get('fields', {}).get(field)]
+            return min(values) if values else None
+
+        hits_per_currency = OrderedDict()
+        currency_counts = Counter()
+        for hit in entity_hits:
+            currency_id = hit['fields']['currency_id'][0]
+            hits_per_currency.setdefault(currency_id, []).append(hit)
+            currency_counts[currency_id] += 1
+
+        # Same order as the buckets of a terms aggregation
+        currency_ids = sorted(hits_per_currency,
+                              key=lambda x: (-currency_counts[x], x))
+
+        return {
+            'normal_price_usd': str(min_value(
+                entity_hits, 'normal_price_usd_with_coupon')),
+            'offer_price_usd': str(min_value(
+                entity_hits, 'offer_price_usd_with_coupon')),
+            'prices_per_currency': [{
+                'currency': reverse('currency-detail', args=[currency_id],
+                                    request=request),
+                'normal_price': str(min_value(
+                    hits_per_currency[currency_id],
+                    'normal_price_with_coupon')),
+                'offer_price': str(min_value(
+                    hits_per_currency[currency_id],
+                    'offer_price_with_coupon'))
+            } for currency_id in currency_ids]
+        }
+
+    def get_products_pricing_metadata(self, request, entities_filter,
+                                      product_ids):
+        # Calculates the pricing metadata of the given products using an
+        # aggregation of their matching entities
+        from solotodo.models import EsEntity
+
+        prices_search = EsEntity.search() \
+            .filter(entities_filter).filter(
+            'terms', product_id=product_ids)
+
+        prices_search.aggs \
+            .bucket('per_product', 'terms', field='product_id',
+                    size=len(product_ids)) \
+            .metric('normal_price_usd', 'min', field='normal_price_usd_with_coupon') \
+            .metric('offer_price_usd', 'min', field='offer_price_usd_with_coupon') \
+            .bucket('price_per_currency', 'terms', field='currency_id') \
+            .metric('normal_price', 'min', field='normal_price_with_coupon') \
+            .metric('offer_price', 'min', field='offer_price_with_coupon')
+
+        price_results = prices_search[:0].execute().to_dict()
+
+        product_prices_agg = price_results['aggregations']['per_product'][
+            'buckets']
+        product_metadata_dict = {}
+
+        for product_price_bucket in product_prices_agg:
+            product_pricing_metadata = {
+                'normal_price_usd': str(product_price_bucket[
+                                            'normal_price_usd']['value']),
+                'offer_price_usd': str(product_price_bucket[
+                                           'offer_price_usd']['value'])
+            }
+            prices_per_currency = []
+            for currency_bucket in product_price_bucket[
+                    'price_per_currency']['buckets']:
+                prices_per_currency.append({
+                    'currency': reverse('currency-detail',
+                                        args=[currency_bucket['key']],
+                                        request=request),
+                    'normal_price':
+                        str(currency_bucket['normal_price']['value']),
+                    'offer_price':
+                        str(currency_bucket['offer_price']['value'])
+                })
+
+            product_pricing_metadata['prices_per_currency'] = \
+                prices_per_currency
+            product_metadata_dict[product_price_bucket['key']] = \
+                product_pricing_metadata
+
+        return product_metadata_dict
+
     def get_category_entities(self, category, request):
         """
         Returns the available entities of queried products
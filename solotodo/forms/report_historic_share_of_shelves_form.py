@@ -1,14 +1,15 @@
 import io
+import numpy as np
 import xlsxwriter
 from collections import defaultdict
 from datetime import timedelta
 
 from django import forms
 from django.core.files.base import ContentFile
-from django.db.models.functions import ExtractWeek, ExtractIsoYear
 from django_filters.fields import IsoDateTimeRangeField
 from guardian.shortcuts import get_objects_for_user
 
+from solotodo.history_archive import EntityHistoryArchive
 from solotodo.models import Store, Country, Entity, EntityHistory, EsProduct
 from solotodo.forms.share_of_shelves_form import ShareOfShelvesForm
 from solotodo_core.s3utils import PrivateS3Boto3Storage
@@ -126,21 +127,26 @@ class ReportHistoricShareOfShelvesForm(forms.Form):
         timestamp = self.cleaned_data['timestamp']
         bucketing_field = self.cleaned_data['bucketing_field']
 
-        ehs = EntityHistory.objects.filter(
-            entity__product__isnull=False,
-            entity__category=category,
-            entity__store__in=stores,
-            timestamp__gte=timestamp.start,
-            timestamp__lte=timestamp.stop) \
-            .get_available() \
-            .annotate(week=ExtractWeek('timestamp'),
-                      year=ExtractIsoYear('timestamp'))
+        report_entities = Entity.objects.filter(
+            product__isnull=False,
+            category=category,
+            store__in=stores)
 
         if countries:
-            ehs = ehs.filter(entity__store__country__in=countries)
+            report_entities = report_entities.filter(
+                store__country__in=countries)
 
-        entity_ids = [x['entity'] for x in
-                      ehs.order_by('entity').values('entity').distinct()]
+        ehs = EntityHistory.objects.filter(entity__in=report_entities) \
+            .filter_seen_between(timestamp.start, timestamp.stop) \
+            .get_available()
+        archived_ehs = list(EntityHistoryArchive().scan(
+            report_entities, timestamp.start, timestamp.stop,
+            available_only=True))
+
+        entity_ids = set(x['entity'] for x in
+                         ehs.order_by('entity').values('entity').distinct())
+        for archived_eh in archived_ehs:
+            entity_ids.update(archived_eh['entity_id'].tolist())
 
         entities = Entity.objects.filter(id__in=entity_ids)
         entity_dict = {e.id: e for e in entities}
@@ -158,10 +164,16 @@ class ReportHistoricShareOfShelvesForm(forms.Form):
             es_search)[:len(product_ids)].execute()
 
         # Filter entity history with filtered products
-        es_product_ids = [e.product_id for e in es_results]
+        es_product_ids = set(e.product_id for e in es_results)
         ehs = ehs.filter(entity__product__in=es_product_ids)
-        ehs = ehs.order_by('entity', 'year', 'week') \
-            .values('entity', 'year', 'week').distinct()
+        es_entity_ids = [e.id for e in entities
+                         if e.product_id in es_product_ids]
+        archived_ehs = [
+            archived_eh.filter(np.isin(archived_eh['entity_id'],
+                                       es_entity_ids))
+            for archived_eh in archived_ehs]
+        ehs = ehs.summarize_by_period('week', timestamp.start, timestamp.stop,
+                                      archived=archived_ehs)
 
         # Create product dict
         es_dict = {e.product_id: e.to_dict()
@@ -77,11 +77,11 @@ class StoreHistoricEntityPositionsForm(forms.Form):
             entity_history__entity__category__in=categories,
             entity_history__entity__store=store,
             entity_history__entity__product__isnull=False,
-            entity_history__timestamp__gte=timestamp.start,
-            entity_history__timestamp__lte=timestamp.stop
+            timestamp__gte=timestamp.start,
+            timestamp__lte=timestamp.stop
         ).annotate(
-            week=ExtractWeek('entity_history__timestamp'),
-            year=ExtractIsoYear('entity_history__timestamp')
+            week=ExtractWeek('timestamp'),
+            year=ExtractIsoYear('timestamp')
         )
 
         if position_threshold:
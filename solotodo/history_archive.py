@@ -0,0 +1,502 @@
+import datetime
+import io
+from decimal import Decimal
+
+import numpy as np
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import router, transaction
+from django.utils.module_loading import import_string
+
+from solotodo.models import EntityHistory, EntitySectionPosition
+from solotodo.partitioning import add_months, month_start, referencing_fields
+
+# Sentinel used for the NULL values of the nullable integer columns, as
+# all of them (prices in cents and counts) are non-negative
+NULL_INT = -1
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+HISTORY_COLUMNS = [
+    "id",
+    "entity_id",
+    "timestamp",
+    "last_seen",
+    "stock",
+    "normal_price",
+    "offer_price",
+    "cell_monthly_payment",
+    "picture_count",
+    "video_count",
+    "review_count",
+    "review_avg_score",
+]
+
+POSITION_COLUMNS = [
+    "position_id",
+    "position_entity_history_id",
+    "position_section_id",
+    "position_value",
+    "position_timestamp",
+]
+
+
+def get_archive_storage():
+    return import_string(settings.HISTORY_ARCHIVE_STORAGE)()
+
+
+def _to_datetime64(values):
+    return np.array(
+        [
+            np.datetime64(value.astimezone(datetime.timezone.utc).replace(tzinfo=None))
+            if value
+            else np.datetime64("NaT")
+            for value in values
+        ],
+        dtype="datetime64[us]",
+    )
+
+
+def _to_cents(values):
+    return np.array(
+        [int(value * 100) if value is not None else NULL_INT for value in values],
+        dtype=np.int64,
+    )
+
+
+def _to_nullable_int(values):
+    return np.array(
+        [value if value is not None else NULL_INT for value in values],
+        dtype=np.int64,
+    )
+
+
+def _from_cents(value):
+    return Decimal(int(value)).scaleb(-2) if value != NULL_INT else None
+
+
+def _from_datetime64(value):
+    if np.isnat(value):
+        return None
+    return EPOCH + datetime.timedelta(
+        microseconds=int(value.astype("datetime64[us]").astype(np.int64))
+    )
+
+
+class ArchivedHistory:
+    """
+    Columnar (NumPy) representation of a set of EntityHistory rows and
+    their EntitySectionPositions, as stored in the archive files. Filters
+    are applied to whole columns using boolean masks.
+    """
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+    def __len__(self):
+        return len(self.arrays["id"])
+
+    def __getitem__(self, column):
+        return self.arrays[column]
+
+    @classmethod
+    def empty(cls):
+        return cls.from_rows([], [])
+
+    @classmethod
+    def from_rows(cls, history_rows, position_rows):
+        # history_rows and position_rows are lists of tuples with the
+        # values of HISTORY_COLUMNS and POSITION_COLUMNS respectively
+        history_columns = list(zip(*history_rows)) or [[]] * len(HISTORY_COLUMNS)
+        position_columns = list(zip(*position_rows)) or [[]] * len(POSITION_COLUMNS)
+        h = dict(zip(HISTORY_COLUMNS, history_columns))
+        p = dict(zip(POSITION_COLUMNS, position_columns))
+
+        return cls(
+            {
+                "id": np.array(h["id"], dtype=np.int64),
+                "entity_id": np.array(h["entity_id"], dtype=np.int64),
+                "timestamp": _to_datetime64(h["timestamp"]),
+                "last_seen": _to_datetime64(h["last_seen"]),
+                "stock": np.array(h["stock"], dtype=np.int64),
+                "normal_price": _to_cents(h["normal_price"]),
+                "offer_price": _to_cents(h["offer_price"]),
+                "cell_monthly_payment": _to_cents(h["cell_monthly_payment"]),
+                "picture_count": _to_nullable_int(h["picture_count"]),
+                "video_count": _to_nullable_int(h["video_count"]),
+                "review_count": _to_nullable_int(h["review_count"]),
+                "review_avg_score": np.array(
+                    [x if x is not None else np.nan for x in h["review_avg_score"]],
+                    dtype=np.float64,
+                ),
+                "position_id": np.array(p["position_id"], dtype=np.int64),
+                "position_entity_history_id": np.array(
+                    p["position_entity_history_id"], dtype=np.int64
+                ),
+                "position_section_id": np.array(
+                    p["position_section_id"], dtype=np.int64
+                ),
+                "position_value": np.array(p["position_value"], dtype=np.int64),
+                "position_timestamp": _to_datetime64(p["position_timestamp"]),
+            }
+        )
+
+    @classmethod
+    def load(cls, file):
+        with np.load(file) as data:
+            return cls({column: data[column] for column in data.files})
+
+    def dump(self):
+        output = io.BytesIO()
+        np.savez_compressed(output, **self.arrays)
+        return output.getvalue()
+
+    def concatenate(self, other):
+        return ArchivedHistory(
+            {
+                column: np.concatenate([self.arrays[column], other.arrays[column]])
+                for column in self.arrays
+            }
+        )
+
+    def filter(self, mask):
+        # Keeps the registries selected by the given boolean mask and the
+        # section positions that belong to them
+        arrays = {
+            column: self.arrays[column][mask]
+            for column in HISTORY_COLUMNS
+        }
+        position_mask = np.isin(self.arrays["position_entity_history_id"], arrays["id"])
+        arrays.update(
+            {
+                column: self.arrays[column][position_mask]
+                for column in POSITION_COLUMNS
+            }
+        )
+        return ArchivedHistory(arrays)
+
+    def mask_seen_between(self, start=None, end=None):
+        # Same semantics as EntityHistoryQueryset.filter_seen_between
+        timestamp = self.arrays["timestamp"]
+        last_seen = self.arrays["last_seen"]
+        mask = np.ones(len(self), dtype=bool)
+
+        if end:
+            mask &= timestamp <= _to_datetime64([end])[0]
+        if start:
+            start = _to_datetime64([start])[0]
+            mask &= (timestamp >= start) | (~np.isnat(last_seen) & (last_seen >= start))
+
+        return mask
+
+    def registries(self):
+        # Yields the archived rows as (unsaved) EntityHistory instances
+        a = self.arrays
+        for i in range(len(self)):
+            yield EntityHistory(
+                id=int(a["id"][i]),
+                entity_id=int(a["entity_id"][i]),
+                timestamp=_from_datetime64(a["timestamp"][i]),
+                last_seen=_from_datetime64(a["last_seen"][i]),
+                stock=int(a["stock"][i]),
+                normal_price=_from_cents(a["normal_price"][i]),
+                offer_price=_from_cents(a["offer_price"][i]),
+                cell_monthly_payment=_from_cents(a["cell_monthly_payment"][i]),
+                picture_count=self._nullable_int(a["picture_count"][i]),
+                video_count=self._nullable_int(a["video_count"][i]),
+                review_count=self._nullable_int(a["review_count"][i]),
+                review_avg_score=None
+                if np.isnan(a["review_avg_score"][i])
+                else float(a["review_avg_score"][i]),
+            )
+
+    def period_keys(self, period):
+        # Returns the arrays identifying the period ('date' or 'week') of
+        # each registry, matching EntityHistoryQueryset.summarize_by_period
+        days = self.arrays["timestamp"].astype("datetime64[D]")
+
+        if period == "date":
+            return [days]
+
+        if period == "week":
+            # ISO 8601: the week belongs to the year of its thursday
+            day_numbers = days.astype(np.int64)
+            weekdays = (day_numbers + 3) % 7
+            thursdays = (day_numbers - weekdays + 3).astype("datetime64[D]")
+            iso_years = thursdays.astype("datetime64[Y]")
+            weeks = (thursdays - iso_years.astype("datetime64[D]")).astype(
+                np.int64
+            ) // 7 + 1
+            return [iso_years.astype(np.int64) + 1970, weeks]
+
+        raise ValueError("Invalid period: {}".format(period))
+
+    def summarize_by_period(self, period):
+        """
+        Yields (key, min_normal_price, min_offer_price,
+        min_cell_monthly_payment, max_review_count, review_avg_score_sum,
+        review_avg_score_count) tuples for each (entity, period) of the
+        uncompressed registries, where key is (entity_id, *period). The
+        compressed registries (see EntityHistory.last_seen) are not
+        included, use compressed_registries to expand them.
+        """
+        summarized = self.filter(np.isnat(self.arrays["last_seen"]))
+        if not len(summarized):
+            return
+
+        keys = [summarized["entity_id"]] + summarized.period_keys(period)
+        order = np.lexsort(keys[::-1])
+        keys = [key[order] for key in keys]
+
+        changes = np.zeros(len(order), dtype=bool)
+        changes[0] = True
+        for key in keys:
+            changes[1:] |= key[1:] != key[:-1]
+        starts = np.flatnonzero(changes)
+
+        def reduce(function, column, null_value):
+            values = summarized[column][order]
+            values = np.where(values == NULL_INT, null_value, values)
+            return function.reduceat(values, starts)
+
+        max_int = np.iinfo(np.int64).max
+        min_normal_prices = reduce(np.minimum, "normal_price", max_int)
+        min_offer_prices = reduce(np.minimum, "offer_price", max_int)
+        min_cell_monthly_payments = reduce(np.minimum, "cell_monthly_payment", max_int)
+        max_review_counts = reduce(np.maximum, "review_count", NULL_INT)
+        scores = summarized["review_avg_score"][order]
+        score_sums = np.add.reduceat(np.nan_to_num(scores), starts)
+        score_counts = np.add.reduceat((~np.isnan(scores)).astype(np.int64), starts)
+
+        for i, start in enumerate(starts):
+            key = tuple(
+                k[start].astype(datetime.date)
+                if k.dtype.kind == "M"
+                else int(k[start])
+                for k in keys
+            )
+            yield (
+                key,
+                _from_cents(min_normal_prices[i]),
+                _from_cents(min_offer_prices[i]),
+                None
+                if min_cell_monthly_payments[i] == max_int
+                else _from_cents(min_cell_monthly_payments[i]),
+                None if max_review_counts[i] == NULL_INT else int(max_review_counts[i]),
+                float(score_sums[i]),
+                int(score_counts[i]),
+            )
+
+    def compressed_registries(self):
+        return self.filter(~np.isnat(self.arrays["last_seen"])).registries()
+
+    @staticmethod
+    def _nullable_int(value):
+        return None if value == NULL_INT else int(value)
+
+
+class EntityHistoryArchive:
+    """
+    Cold tier storage for old EntityHistory and EntitySectionPosition rows.
+    Rows are moved out of the database into compressed NumPy (.npz) files,
+    one per store, month and archiving run (existing files are never
+    rewritten), in the storage given by
+    settings.HISTORY_ARCHIVE_STORAGE (local filesystem or S3). Registries
+    still referenced from other tables (e.g. active registries or leads)
+    are never archived, so the archive and the database never overlap and
+    readers can simply combine both.
+    """
+
+    def __init__(self, storage=None):
+        self.storage = storage or get_archive_storage()
+
+    @staticmethod
+    def store_directory(store_id):
+        return "{}/store_{}".format(settings.HISTORY_ARCHIVE_LOCATION, store_id)
+
+    def path(self, store_id, month, first_id):
+        # The files of an archiving run are named after the first registry
+        # they contain, which can't be archived again
+        return "{}/{:%Y-%m}_{}.npz".format(
+            self.store_directory(store_id), month, first_id
+        )
+
+    def _filenames(self, store_id):
+        try:
+            _, filenames = self.storage.listdir(self.store_directory(store_id))
+        except FileNotFoundError:
+            return []
+
+        return sorted(filename for filename in filenames if filename.endswith(".npz"))
+
+    def archived_months(self, store_id):
+        return sorted(
+            {
+                datetime.datetime.strptime(filename[:7], "%Y-%m").replace(
+                    tzinfo=datetime.timezone.utc
+                )
+                for filename in self._filenames(store_id)
+            }
+        )
+
+    def load(self, store_id, month):
+        # Combines the files of every archiving run of the month
+        history = ArchivedHistory.empty()
+        month_prefix = "{:%Y-%m}".format(month)
+
+        for filename in self._filenames(store_id):
+            if filename[:7] != month_prefix:
+                continue
+
+            path = "{}/{}".format(self.store_directory(store_id), filename)
+            with self.storage.open(path, "rb") as f:
+                history = history.concatenate(
+                    ArchivedHistory.load(io.BytesIO(f.read()))
+                )
+
+        return history
+
+    def scan(self, entities, start=None, end=None, available_only=False):
+        """
+        Yields an ArchivedHistory per archive file with the registries of
+        the given entities (queryset) seen between start and end.
+        """
+        entity_ids_by_store = {}
+        for store_id, entity_id in entities.values_list("store", "id"):
+            entity_ids_by_store.setdefault(store_id, []).append(entity_id)
+
+        for store_id, entity_ids in entity_ids_by_store.items():
+            entity_ids = np.array(entity_ids, dtype=np.int64)
+
+            for month in self.archived_months(store_id):
+                if end and month > end:
+                    continue
+                if start and add_months(month, 1) <= month_start(start):
+                    continue
+
+                history = self.load(store_id, month)
+                mask = history.mask_seen_between(start, end) & np.isin(
+                    history["entity_id"], entity_ids
+                )
+                if available_only:
+                    mask &= history["stock"] != 0
+
+                history = history.filter(mask)
+                if len(history):
+                    yield history
+
+    def registries(self, entities, start=None, end=None, available_only=False):
+        for history in self.scan(entities, start, end, available_only):
+            yield from history.registries()
+
+    def archive_month(self, store, month):
+        """
+        Moves the registries of the given store and month (and their
+        section positions) from the database into the archive. Returns the
+        amount of archived registries.
+        """
+        start = month_start(month)
+        end = add_months(start, 1)
+
+        registries = EntityHistory.objects.filter(
+            entity__store=store, timestamp__gte=start, timestamp__lt=end
+        ).order_by("id")
+        referenced_ids = self._referenced_ids(store, start, end)
+
+        history_rows = [
+            row
+            for row in registries.values_list(*HISTORY_COLUMNS).iterator(
+                chunk_size=10000
+            )
+            if row[0] not in referenced_ids
+        ]
+        if not history_rows:
+            return 0
+
+        archived_ids = np.array([row[0] for row in history_rows], dtype=np.int64)
+        position_rows = [
+            row
+            for row in EntitySectionPosition.objects.filter(
+                entity_history__entity__store=store,
+                timestamp__gte=start,
+                timestamp__lt=end,
+            )
+            .order_by("id")
+            .values_list(
+                "id", "entity_history_id", "section_id", "value", "timestamp"
+            )
+            .iterator(chunk_size=10000)
+        ]
+        # Drops the positions of the registries that stay in the database
+        history = ArchivedHistory.from_rows(history_rows, position_rows)
+        history = history.filter(np.isin(history["id"], archived_ids))
+
+        path = self.path(store.id, start, int(archived_ids[0]))
+        using = router.db_for_write(EntityHistory)
+
+        with transaction.atomic(using=using):
+            batch_size = 5000
+            for i in range(0, len(archived_ids), batch_size):
+                batch = archived_ids[i : i + batch_size].tolist()
+                # Raw deletes, so the ORM can never cascade to rows
+                # referencing the registries (see _referenced_ids)
+                EntitySectionPosition.objects.filter(
+                    entity_history__in=batch
+                )._raw_delete(using)
+                EntityHistory.objects.filter(pk__in=batch)._raw_delete(using)
+
+            # The file is written last, so a failure rolls back the deletion.
+            # The files of previous runs are left untouched
+            self.storage.save(path, ContentFile(history.dump()))
+
+        return len(archived_ids)
+
+    @staticmethod
+    def _referenced_ids(store, start, end):
+        # Ids of the registries of the store and period referenced from
+        # other tables (other than EntitySectionPosition), which must stay
+        # in the database
+        referenced_ids = set()
+
+        # Including the hidden relations, e.g. Entity.active_registry and
+        # the many to many through tables
+        for field in referencing_fields(EntityHistory):
+            model = field.model
+
+            if model == EntitySectionPosition:
+                continue
+
+            referenced_ids.update(
+                model._base_manager.filter(
+                    **{
+                        "{}__entity__store".format(field.name): store,
+                        "{}__timestamp__gte".format(field.name): start,
+                        "{}__timestamp__lt".format(field.name): end,
+                    }
+                ).values_list(field.attname, flat=True)
+            )
+
+        return referenced_ids
+
+
+def merge_with_archived_registries(registries, archived_registries, entities_dict):
+    """
+    Combines registries ordered by entity with archived ones, yielding the
+    (older) archived registries of each entity right before its first
+    database registry. entities_dict is used to set the entity of the
+    archived registries.
+    """
+    archived_by_entity = {}
+    for registry in archived_registries:
+        registry.entity = entities_dict[registry.entity_id]
+        archived_by_entity.setdefault(registry.entity_id, []).append(registry)
+
+    for registry_list in archived_by_entity.values():
+        registry_list.sort(key=lambda x: x.timestamp)
+
+    for registry in registries:
+        yield from archived_by_entity.pop(registry.entity_id, [])
+        yield registry
+
+    for registry_list in archived_by_entity.values():
+        yield from registry_list
@@ -0,0 +1,57 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.db.models import Min
+from django.utils import timezone
+
+from solotodo.history_archive import EntityHistoryArchive
+from solotodo.models import Store, EntityHistory
+from solotodo.partitioning import add_months, month_start
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves the EntityHistory / EntitySectionPosition rows of the months "
+        "older than the given amount of days to the cold tier archive"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--stores", nargs="*", type=str)
+        parser.add_argument(
+            "--older_than_days",
+            type=int,
+            default=settings.HISTORY_ARCHIVE_AFTER_DAYS,
+            help="Only whole months older than this are archived",
+        )
+
+    def handle(self, *args, **options):
+        store_names = options["stores"]
+        limit_month = month_start(
+            timezone.now() - timedelta(days=options["older_than_days"])
+        )
+
+        stores = Store.objects.all()
+        if store_names:
+            stores = stores.filter(name__in=store_names)
+
+        archive = EntityHistoryArchive()
+
+        for store in stores:
+            first_timestamp = EntityHistory.objects.filter(
+                entity__store=store, timestamp__lt=limit_month
+            ).aggregate(Min("timestamp"))["timestamp__min"]
+
+            if not first_timestamp:
+                continue
+
+            month = month_start(first_timestamp)
+
+            while month < limit_month:
+                archived_count = archive.archive_month(store, month)
+                print(
+                    "{} {:%Y-%m}: {} registries archived".format(
+                        store, month, archived_count
+                    )
+                )
+                month = add_months(month, 1)
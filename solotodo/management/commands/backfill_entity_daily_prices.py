@@ -0,0 +1,95 @@
+from django.core.management import BaseCommand
+from django.db import transaction
+from django.db.models import Min
+from django.utils import timezone
+
+from solotodo.history_archive import EntityHistoryArchive
+from solotodo.models import Store, EntityHistory, EntityDailyPrice
+from solotodo.partitioning import add_months, month_start
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuilds the EntityDailyPrice rollup of the given stores from their "
+        "EntityHistory, including the archived one. Meant for filling the "
+        "rollup of past months, the current ones are kept up to date as "
+        "the stores are updated."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--stores", nargs="*", type=str)
+        parser.add_argument(
+            "--months",
+            type=int,
+            nargs="?",
+            help="Only rebuild this amount of months (counting the current "
+            "one). By default the whole history is processed.",
+        )
+        parser.add_argument("--batch_size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        store_names = options["stores"]
+        batch_size = options["batch_size"]
+
+        stores = Store.objects.all()
+        if store_names:
+            stores = stores.filter(name__in=store_names)
+
+        current_month = month_start(timezone.now())
+        archive = EntityHistoryArchive()
+
+        for store in stores:
+            if options["months"]:
+                first_month = add_months(current_month, 1 - options["months"])
+            else:
+                first_months = archive.archived_months(store.id)[:1]
+                first_timestamp = EntityHistory.objects.filter(
+                    entity__store=store
+                ).aggregate(Min("timestamp"))["timestamp__min"]
+                if first_timestamp:
+                    first_months.append(month_start(first_timestamp))
+                if not first_months:
+                    continue
+                first_month = min(first_months)
+
+            month = first_month
+            while month <= current_month:
+                count = self.rebuild_month(store, month, archive, batch_size)
+                print("{} {:%Y-%m}: {} registries".format(store, month, count))
+                month = add_months(month, 1)
+
+    @staticmethod
+    def rebuild_month(store, month, archive, batch_size):
+        start = month
+        end = add_months(month, 1)
+
+        registries = (
+            EntityHistory.objects.filter(
+                entity__store=store, timestamp__gte=start, timestamp__lt=end
+            )
+            .order_by()
+            .iterator(chunk_size=batch_size)
+        )
+        archived_registries = archive.load(store.id, month).registries()
+
+        count = 0
+        with transaction.atomic():
+            EntityDailyPrice.objects.filter(
+                entity__store=store, date__gte=start.date(), date__lt=end.date()
+            ).delete()
+
+            batch = []
+            for source in [registries, archived_registries]:
+                for registry in source:
+                    batch.extend(registry.expand())
+                    count += 1
+
+                    if len(batch) >= batch_size:
+                        EntityDailyPrice.objects.register(
+                            batch, use_last_seen=False
+                        )
+                        batch = []
+
+            EntityDailyPrice.objects.register(batch, use_last_seen=False)
+
+        return count
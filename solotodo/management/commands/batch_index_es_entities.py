@@ -1,72 +1,211 @@
-from multiprocessing import cpu_count, Pool, set_start_method
+import time
+from collections import Counter, deque
+from multiprocessing import cpu_count, get_context
+
 import django
 
 django.setup()
-from django.core.management import BaseCommand
-from django.db import models
+from django.core.management import BaseCommand, CommandError
+from elasticsearch.helpers import parallel_bulk
 
-from solotodo.models import Entity, EsEntity
+from solotodo.models import Entity, EsEntity, EsProduct
 
 
-class Epoch(models.expressions.Func):
-    template = "EXTRACT(epoch FROM %(expressions)s)::FLOAT"
-    output_field = models.FloatField()
+def build_entity_actions(entity_ids, index=None):
+    # Top level function used by multiprocessing
+    actions = EsEntity.sync_actions(entity_ids)
 
+    if not index:
+        return actions
 
-class DateTimeFromFloat(models.expressions.Func):
-    template = "To_TIMESTAMP(%(expressions)s)::TIMESTAMP at time zone 'UTC'"
-    output_field = models.DateTimeField()
+    # When building a new index the documents it already has were written
+    # by the live updates (see EsProductEntities.dual_write_actions) and
+    # are at least as recent as these ones
+    return [
+        dict(action, _index=index, _op_type="create")
+        for action in actions
+        if action.get("_op_type") != "delete"
+    ]
 
 
-def index_entity(entity, idx):
-    # Top level function used by multiprocessing
-    print("Entity {} ({})".format(idx, entity.id))
-    EsEntity.from_entity(entity).save()
+def entity_id_chunks(queryset, chunk_size, start_after_id):
+    # Keyset pagination over the ids of the queryset, so no chunk requires
+    # an OFFSET scan and an interrupted run can be resumed from an id
+    last_id = start_after_id
+
+    while True:
+        entity_ids = list(
+            queryset.filter(pk__gt=last_id)
+            .order_by("pk")
+            .values_list("pk", flat=True)[:chunk_size]
+        )
+
+        if not entity_ids:
+            return
+
+        yield entity_ids
+        last_id = entity_ids[-1]
+
+
+def entity_actions(pool, id_chunks, max_pending_chunks, index=None):
+    # Builds the actions of the chunks in the worker processes, keeping at
+    # most max_pending_chunks of them in flight and preserving their order
+    pending = deque()
+
+    for entity_ids in id_chunks:
+        pending.append(pool.apply_async(build_entity_actions, (entity_ids, index)))
+
+        if len(pending) >= max_pending_chunks:
+            yield from pending.popleft().get()
+
+    while pending:
+        yield from pending.popleft().get()
 
 
 class Command(BaseCommand):
+    help = (
+        "Indexes the available and associated entities in Elasticsearch. "
+        "The documents are built by worker processes from chunks of entity "
+        "ids and sent using concurrent bulk requests."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk_size",
+            type=int,
+            default=500,
+            help="Number of entities per worker task and per bulk request",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=max(cpu_count() - 4, 1),
+            help="Number of processes building the documents (by default "
+            "leaves 4 cores for Elasticsearch and other stuff)",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=4,
+            help="Number of concurrent bulk requests",
+        )
+        parser.add_argument(
+            "--start_after_id",
+            type=int,
+            default=0,
+            help="Only index the entities with a greater id, used to resume "
+            "an interrupted run from the last id it reported",
+        )
+        parser.add_argument(
+            "--index",
+            type=str,
+            nargs="?",
+            help="Index being built to write to instead of the live one "
+            "(see reindex_product_entities)",
+        )
+
     def handle(self, *args, **options):
-        # If you need to delete the previous indexed entities run the
-        # following query from Kibana
-        # POST /product_entities/_delete_by_query
-        # {"query": {"bool": {"filter": [{"term":
-        # {"product_relationships": "entity"}}]}}}
-
-        es = (
-            Entity.objects.get_available()
-            .filter(
-                product__isnull=False,
-                active_registry__cell_monthly_payment__isnull=True,
+        # To rebuild the index from scratch (e.g. to remove the previously
+        # indexed entities) use the reindex_product_entities command
+        chunk_size = options["chunk_size"]
+        workers = options["workers"]
+        start_after_id = options["start_after_id"]
+
+        entities = Entity.objects.get_available().filter(
+            product__isnull=False,
+            active_registry__cell_monthly_payment__isnull=True,
+        )
+
+        total = entities.filter(pk__gt=start_after_id).count()
+        print("{} entities will be indexed using {} workers".format(total, workers))
+
+        indexed_count = 0
+        skipped_count = 0
+        errors = Counter()
+        error_samples = []
+        last_entity_id = start_after_id
+        start = time.time()
+
+        pool = get_context("spawn").Pool(processes=workers)
+
+        try:
+            actions = entity_actions(
+                pool,
+                entity_id_chunks(entities, chunk_size, start_after_id),
+                workers * 2,
+                options["index"],
             )
-            .select_related(
-                "active_registry",
-                "currency",
-                "bundle",
-                "product__brand",
-                "store__country",
-                "category",
-                "best_coupon",
+
+            results = parallel_bulk(
+                EsEntity._get_connection(),
+                actions,
+                thread_count=options["concurrency"],
+                chunk_size=chunk_size,
+                raise_on_error=False,
+                raise_on_exception=False,
             )
+
+            for ok, item in results:
+                ((_, info),) = item.items()
+
+                if ok:
+                    indexed_count += 1
+                elif info.get("status") == 409:
+                    # Already written to the index being built
+                    skipped_count += 1
+                else:
+                    error = info.get("error")
+                    errors[
+                        error.get("type") if isinstance(error, dict) else str(error)
+                    ] += 1
+                    if len(error_samples) < 10:
+                        error_samples.append(item)
+
+                # Bulk results arrive in the same order as the actions
+                if "_id" in info:
+                    last_entity_id = int(info["_id"].replace("ENTITY_", ""))
+
+                processed_count = indexed_count + skipped_count + sum(errors.values())
+                if processed_count % chunk_size == 0:
+                    self.print_progress(
+                        processed_count, total, start, last_entity_id, errors
+                    )
+        finally:
+            pool.close()
+            pool.join()
+
+        self.print_progress(
+            indexed_count + skipped_count + sum(errors.values()),
+            total,
+            start,
+            last_entity_id,
+            errors,
         )
 
+        # The discounts of the products depend on their entities
+        print("Updating the discounts of the products")
+        es = EsEntity._get_connection()
+        es.indices.refresh(index=options["index"] or EsEntity._index._name)
+        EsProduct.update_discounts(index=options["index"])
+
+        if errors:
+            for error_sample in error_samples:
+                print(error_sample)
+
+            raise CommandError(
+                "{} documents could not be indexed: {}".format(
+                    sum(errors.values()), dict(errors)
+                )
+            )
+
+    def print_progress(self, processed_count, total, start, last_entity_id, errors):
+        elapsed = time.time() - start
         print(
-            "Before indexing, it is a good idea to limit "
-            "ElasticSearch RAM usage to 8 GB or so by creating a "
-            "config/jvm.options.d/memory.options with the flags -Xms8g "
-            "and -Xmx8g"
-        )
-        print("{} entities will be indexed".format(len(es)))
-        print("Your computer has {} available cores".format(cpu_count()))
-        core_target = int(
-            input(
-                "How many cores do you want to use for "
-                "indexing? (ideally leave 4 or so for "
-                "Elasticsearch and other stuff) "
+            "{}/{} entities ({:.1f} docs/s, {} errors, last entity id {})".format(
+                processed_count,
+                total,
+                processed_count / elapsed if elapsed else 0,
+                sum(errors.values()),
+                last_entity_id,
             )
         )
-        print("Creating pool with {} workers".format(core_target))
-        set_start_method("spawn")
-        pool = Pool(processes=core_target)
-        pool.starmap(index_entity, zip(es, range(len(es))))
-        pool.close()
-        pool.join()
@@ -1,47 +1,98 @@
-import json
-from decimal import Decimal
-from itertools import repeat
+from collections import Counter
+from itertools import islice, repeat
 from multiprocessing import cpu_count, Pool, set_start_method
 import django
 django.setup()
 from django.core.management import BaseCommand
-from metamodel.models import MetaModel, InstanceModel
+from elasticsearch.exceptions import ConflictError
+from metamodel.custom_functions import \
+    additional_elasticsearch_fields_functions
+from metamodel.models import InstanceModel
+from metamodel.snapshot import MetamodelSnapshot
 from solotodo.models import Product, EsProduct
 
-def index_product(product, d):
+# Memory mapped snapshot of each worker process, see init_worker
+snapshot = None
+
+
+def init_worker(snapshot_path):
+    global snapshot
+    snapshot = MetamodelSnapshot(snapshot_path)
+
+
+def index_product(product, index=None):
     # Top level function used by multiprocessing
     print(product)
-    es_document = InstanceModel.elasticsearch_document_from_dict(
-        product.instance_model_id, d)
+    es_document = InstanceModel.elasticsearch_document_from_snapshot(
+        product.instance_model_id, snapshot)
+
+    es_product = EsProduct.from_product(product, es_document)
+
+    if not index:
+        es_product.save()
+        return
+
+    # When building a new index the documents it already has were written
+    # by the live updates and are at least as recent as this one
+    try:
+        es_product.save(index=index, op_type='create')
+    except ConflictError:
+        pass
+
+def index_products(products, index=None):
+    # Top level function used by multiprocessing, returns the time spent in
+    # the additional Elasticsearch fields functions while indexing the
+    # products
+    for product in products:
+        index_product(product, index)
+
+    stats = additional_elasticsearch_fields_functions.stats()
+    additional_elasticsearch_fields_functions.reset_stats()
+    return stats
+
+
+def product_chunks(products, chunk_size):
+    products = iter(products)
+    while True:
+        chunk = list(islice(products, chunk_size))
+        if not chunk:
+            return
+        yield chunk
 
-    EsProduct.from_product(product, es_document).save()
 
 class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('--categories', nargs='*', type=int)
+        parser.add_argument('--workers', type=int, nargs='?')
+        parser.add_argument('--index', type=str, nargs='?',
+                            help='Index being built to write to instead of '
+                                 'the live one (see reindex_product_entities)')
+        parser.add_argument('--snapshot', type=str,
+                            default='metamodel_snapshot',
+                            help='Directory of the metamodel snapshot used '
+                                 'to build the documents')
+        parser.add_argument('--refresh_snapshot', action='store_true',
+                            help='Rebuild the metamodel snapshot even if it '
+                                 'already exists')
 
     def handle(self, *args, **options):
-        filename = 'metamodel_data.json'
-
-        print('Looking for already created metamodel dump')
-
-        try:
-            with open(filename) as f:
-                print('Model found, using it. If you don\'t want to use it '
-                      'then delete {} and run the script again'.format(
-                            filename))
-                d = json.load(f)
-        except FileNotFoundError:
-            print('No dump found, creating one and saving it in {}'.format(
-                filename))
-            d = MetaModel.generate_metamodel_structure()
-            with open(filename, 'w') as f:
-                f.write(json.dumps(d))
-
-        for key, value in d.items():
-            for field, field_value in value.items():
-                if field == 'decimal_value' and field_value is not None:
-                    value[field] = Decimal(field_value)
+        snapshot_path = options['snapshot']
+
+        if options['refresh_snapshot']:
+            print('Creating metamodel snapshot in {}'.format(snapshot_path))
+            MetamodelSnapshot.build(snapshot_path)
+        else:
+            print('Looking for already created metamodel snapshot')
+
+            try:
+                MetamodelSnapshot(snapshot_path)
+                print('Snapshot found, using it. If you don\'t want to use it '
+                      'then use --refresh_snapshot or delete {} and run the '
+                      'script again'.format(snapshot_path))
+            except (FileNotFoundError, ValueError):
+                print('No usable snapshot found, creating one in {}'.format(
+                    snapshot_path))
+                MetamodelSnapshot.build(snapshot_path)
 
         print('Indexing products in ElasticSearch')
 
@@ -56,13 +107,40 @@ class Command(BaseCommand):
               'ElasticSearch RAM usage to 8 GB or so by creating a '
               'config/jvm.options.d/memory.options with the flags -Xms8g '
               'and -Xmx8g')
-        print('Your computer has {} available cores'.format(cpu_count()))
-        core_target = int(input('How many cores do you want to use for '
-                                'indexing? (ideally leave 4 or so for '
-                                'Elasticsearch and other stuff) '))
+        core_target = options['workers']
+        if not core_target:
+            print('Your computer has {} available cores'.format(cpu_count()))
+            core_target = int(input('How many cores do you want to use for '
+                                    'indexing? (ideally leave 4 or so for '
+                                    'Elasticsearch and other stuff) '))
         print('Creating pool with {} workers'.format(core_target))
         set_start_method('spawn')
-        pool = Pool(processes=core_target)
-        pool.starmap(index_product, zip(products, repeat(d)))
+        # The workers share the pages of the memory mapped snapshot
+        pool = Pool(processes=core_target, initializer=init_worker,
+                    initargs=(snapshot_path,))
+        stats = pool.starmap(index_products, zip(
+            product_chunks(products.iterator(), 100),
+            repeat(options['index'])))
         pool.close()
         pool.join()
+
+        call_counts = Counter()
+        call_times = Counter()
+        for worker_stats in stats:
+            for path, (calls, seconds) in worker_stats.items():
+                call_counts[path] += calls
+                call_times[path] += seconds
+
+        if not options['index']:
+            # The new documents don't have the discounts of the products.
+            # When building a new index they are calculated after indexing
+            # the entities (see batch_index_es_entities).
+            print('Updating the discounts of the products')
+            EsProduct._get_connection().indices.refresh(
+                index=EsProduct._index._name)
+            EsProduct.update_discounts()
+
+        print('Time spent in the additional Elasticsearch fields functions')
+        for path, seconds in call_times.most_common():
+            print('{}: {:.2f}s in {} calls'.format(
+                path, seconds, call_counts[path]))
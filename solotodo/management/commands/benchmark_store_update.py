@@ -0,0 +1,422 @@
+import json
+import os
+import random
+import re
+import resource
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager, redirect_stdout
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.management import BaseCommand, CommandError
+from django.db import connections, router, transaction
+from django.utils import timezone
+from storescraper.product import Product as StorescraperProduct
+
+from solotodo.es_stand_in import local_elasticsearch
+from solotodo.models import Category, Entity, EsEntity, Product, Store
+
+
+class SyntheticCatalog:
+    """
+    Generates the successive scrapings of a synthetic store catalog. The
+    first scraping has only new products, then each one changes the price
+    or stock of a "churn" fraction of the products and replaces a
+    "new_ratio" fraction of them with new ones (the replaced products are
+    no longer scraped, so their entities become unavailable). A
+    "section_density" fraction of the products of every scraping has
+    section positions.
+    """
+
+    SECTIONS = ["Home", "Ofertas", "Destacados", "Novedades"]
+
+    def __init__(
+        self,
+        store,
+        category,
+        currency,
+        size,
+        churn,
+        section_density,
+        new_ratio,
+        seed,
+    ):
+        self.store = store
+        self.category = category
+        self.currency = currency
+        self.churn = churn
+        self.section_density = section_density
+        self.new_ratio = new_ratio
+        self.random = random.Random(seed)
+        self.key_prefix = "benchmark-{}-".format(seed)
+        self.next_index = 0
+        self.products = {}
+
+        for _ in range(size):
+            self._add_product()
+
+    def _add_product(self):
+        key = "{}{}".format(self.key_prefix, self.next_index)
+        self.next_index += 1
+
+        normal_price = Decimal(self.random.randrange(5000, 2000000, 10))
+        self.products[key] = {
+            "name": "Synthetic product {}".format(key),
+            "normal_price": normal_price,
+            "offer_price": normal_price,
+            "stock": -1,
+        }
+
+    def advance(self):
+        keys = list(self.products.keys())
+
+        for key in self.random.sample(keys, int(len(keys) * self.churn)):
+            product = self.products[key]
+
+            if self.random.random() < 0.2:
+                product["stock"] = 0 if product["stock"] else -1
+            else:
+                factor = Decimal(self.random.uniform(0.9, 1.1)).quantize(
+                    Decimal("0.01")
+                )
+                product["normal_price"] = (product["normal_price"] * factor).quantize(
+                    Decimal(1)
+                )
+                product["offer_price"] = product["normal_price"]
+
+        replaced_keys = self.random.sample(keys, int(len(keys) * self.new_ratio))
+        for key in replaced_keys:
+            del self.products[key]
+            self._add_product()
+
+    def scraped_products(self):
+        result = []
+
+        for key, product in self.products.items():
+            positions = []
+            if self.random.random() < self.section_density:
+                positions = [
+                    (section, self.random.randint(1, 100))
+                    for section in self.random.sample(
+                        self.SECTIONS, self.random.randint(1, len(self.SECTIONS))
+                    )
+                ]
+
+            url = "https://example.com/{}".format(key)
+
+            result.append(
+                StorescraperProduct(
+                    name=product["name"],
+                    store=self.store.storescraper_class,
+                    category=self.category.storescraper_name,
+                    url=url,
+                    discovery_url=url,
+                    key=key,
+                    stock=product["stock"],
+                    normal_price=product["normal_price"],
+                    offer_price=product["offer_price"],
+                    currency=self.currency.iso_code,
+                    sku=key[-50:],
+                    positions=positions,
+                )
+            )
+
+        return result
+
+
+class QueryCounter:
+    # Database execute wrapper that counts the queries run through it
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class BenchmarkRecorder:
+    """
+    Measures the wall time, query count, rows written (using PostgreSQL's
+    per transaction table statistics, so COPY is included), Elasticsearch
+    requests (and the time the stand-in spent serving them) and documents
+    written and peak RSS of each phase.
+    """
+
+    def __init__(self, connection, es_transport):
+        self.connection = connection
+        self.es_transport = es_transport
+        self.query_counter = QueryCounter()
+        self.results = []
+
+    def rows_written(self):
+        # Rows inserted, updated or deleted in the current transaction by
+        # table, adding up the partitions of the partitioned tables
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT relname, n_tup_ins + n_tup_upd + n_tup_del "
+                "FROM pg_stat_xact_user_tables"
+            )
+            rows = Counter()
+            for table, count in cursor.fetchall():
+                rows[re.sub(r"_(p\d{6}|legacy)$", "", table)] += count
+            return rows
+
+    @contextmanager
+    def phase(self, round_name, phase_name):
+        initial_rows = self.rows_written()
+        initial_queries = self.query_counter.count
+        self.es_transport.reset_stats()
+        start = time.perf_counter()
+
+        with self.connection.execute_wrapper(self.query_counter):
+            yield
+
+        elapsed = time.perf_counter() - start
+        rows = self.rows_written()
+        rows.subtract(initial_rows)
+
+        self.results.append(
+            {
+                "round": round_name,
+                "phase": phase_name,
+                "wall_time": elapsed,
+                # The query that reads the statistics is excluded
+                "queries": self.query_counter.count - initial_queries,
+                "rows_written": sum(rows.values()),
+                "rows_written_by_table": {
+                    table: count for table, count in rows.items() if count
+                },
+                "es_requests": sum(self.es_transport.requests.values()),
+                "es_seconds": sum(
+                    stats["total"]
+                    for stats in self.es_transport.latency_stats().values()
+                ),
+                "es_documents_written": sum(self.es_transport.documents.values()),
+                # ru_maxrss is measured in KB on Linux
+                "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                / 1024,
+            }
+        )
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks the update of a store with synthetic scraped products "
+        "against the configured (local) database and an in-process "
+        "Elasticsearch stand-in. Every change is rolled back at the end "
+        "unless --keep is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--store", type=str, required=True, help="Name of the store to update"
+        )
+        parser.add_argument(
+            "--category",
+            type=int,
+            required=True,
+            help="ID of the category of the synthetic products",
+        )
+        parser.add_argument(
+            "--products",
+            type=int,
+            default=1000,
+            help="Number of products of each scraping",
+        )
+        parser.add_argument(
+            "--rounds",
+            type=int,
+            default=3,
+            help="Number of updates run after the initial one",
+        )
+        parser.add_argument(
+            "--churn",
+            type=float,
+            default=0.1,
+            help="Fraction of the products whose price or stock changes "
+            "between updates",
+        )
+        parser.add_argument(
+            "--section_density",
+            type=float,
+            default=0.1,
+            help="Fraction of the products with section positions",
+        )
+        parser.add_argument(
+            "--new_ratio",
+            type=float,
+            default=0.05,
+            help="Fraction of the products replaced by new ones between updates",
+        )
+        parser.add_argument(
+            "--associated_ratio",
+            type=float,
+            default=0.5,
+            help="Fraction of the entities associated to products of the "
+            "category after the initial update, so they are indexed in "
+            "Elasticsearch",
+        )
+        parser.add_argument(
+            "--batch_size",
+            type=int,
+            nargs="?",
+            help="Passed to Store.update_with_scraped_products, if not given "
+            "the entities are updated one by one",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--keep",
+            action="store_true",
+            help="Commit the generated data instead of rolling it back",
+        )
+        parser.add_argument(
+            "--output", type=str, nargs="?", help="Path of a JSON file for the results"
+        )
+
+    def handle(self, *args, **options):
+        connection = connections[router.db_for_write(Entity)]
+
+        if connection.vendor != "postgresql":
+            raise CommandError("The benchmark requires PostgreSQL")
+
+        try:
+            store = Store.objects.get(name=options["store"])
+        except Store.DoesNotExist:
+            raise CommandError("Store {} not found".format(options["store"]))
+
+        if not store.last_activation:
+            raise CommandError("Only active stores can be updated")
+
+        categories = Category.objects.filter(pk=options["category"])
+        category = categories.first()
+
+        if not category or not category.storescraper_name:
+            raise CommandError("The category must exist and have a scraper name")
+
+        catalog = SyntheticCatalog(
+            store,
+            category,
+            store.country.currency,
+            options["products"],
+            options["churn"],
+            options["section_density"],
+            options["new_ratio"],
+            options["seed"],
+        )
+
+        with local_elasticsearch() as es, transaction.atomic(using=connection.alias):
+            EsEntity._index.create()
+            recorder = BenchmarkRecorder(connection, es.transport)
+
+            for round_index in range(options["rounds"] + 1):
+                if round_index:
+                    round_name = "update_{}".format(round_index)
+                    catalog.advance()
+                else:
+                    round_name = "initial"
+
+                scraped_products = catalog.scraped_products()
+
+                # The output of the per entity update path is discarded
+                with ExitStack() as deferred_sync, open(
+                    os.devnull, "w"
+                ) as devnull, redirect_stdout(devnull):
+                    # Syncing the entities in an outer block allows to
+                    # measure it separately
+                    deferred_sync.enter_context(EsEntity.deferred_sync())
+
+                    with recorder.phase(round_name, "ingest"):
+                        store.update_with_scraped_products(
+                            categories,
+                            scraped_products,
+                            [],
+                            batch_size=options["batch_size"],
+                        )
+
+                    with recorder.phase(round_name, "es_sync"):
+                        deferred_sync.close()
+
+                if not round_index:
+                    self.associate_entities(catalog, options["associated_ratio"])
+
+            if not options["keep"]:
+                transaction.set_rollback(True, using=connection.alias)
+
+        self.print_results(recorder.results)
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(
+                    {"options": options, "results": recorder.results}, f, indent=2
+                )
+
+    def associate_entities(self, catalog, ratio):
+        # Associates the given fraction of the synthetic entities to
+        # random products of the category, bypassing Entity.associate and
+        # its side effects (logs and Elasticsearch updates) but keeping the
+        # association metadata required by Entity.save
+        random_generator = catalog.random
+        product_ids = list(
+            Product.objects.filter(instance_model__model__category=catalog.category)
+            .order_by("-id")
+            .values_list("id", flat=True)[:1000]
+        )
+
+        if not product_ids:
+            print("No products in the category, entities will not be indexed")
+            return
+
+        entities = list(
+            catalog.store.entity_set.filter(
+                key__startswith=catalog.key_prefix
+            ).order_by("id")
+        )
+        entities = random_generator.sample(entities, int(len(entities) * ratio))
+
+        user = get_user_model().get_bot()
+        now = timezone.now()
+
+        for entity in entities:
+            entity.product_id = random_generator.choice(product_ids)
+            entity.last_association = now
+            entity.last_association_user = user
+
+        Entity.objects.bulk_update(
+            entities,
+            ["product", "last_association", "last_association_user"],
+            batch_size=1000,
+        )
+
+    def print_results(self, results):
+        row_template = "{:<10} {:<8} {:>10} {:>9} {:>13} {:>12} {:>9} {:>13}"
+
+        print(
+            row_template.format(
+                "Round",
+                "Phase",
+                "Wall (s)",
+                "Queries",
+                "Rows written",
+                "ES requests",
+                "ES docs",
+                "Peak RSS (MB)",
+            )
+        )
+
+        for result in results:
+            print(
+                row_template.format(
+                    result["round"],
+                    result["phase"],
+                    "{:.2f}".format(result["wall_time"]),
+                    result["queries"],
+                    result["rows_written"],
+                    result["es_requests"],
+                    result["es_documents_written"],
+                    "{:.1f}".format(result["peak_rss_mb"]),
+                )
+            )
+
+            for table, count in sorted(result["rows_written_by_table"].items()):
+                print("    {}: {}".format(table, count))
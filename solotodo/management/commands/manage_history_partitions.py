@@ -0,0 +1,171 @@
+from django.core.management import BaseCommand, CommandError
+from django.db import connections, router, transaction
+from django.utils import timezone
+
+from solotodo.models import EntityHistory, EntitySectionPosition
+from solotodo.partitioning import (
+    PARTITIONED_TABLES,
+    add_months,
+    create_partition,
+    detach_partition,
+    get_partitions,
+    get_referenced_partition_tables,
+    legacy_partition_name,
+    logger,
+    month_start,
+    partition_name,
+)
+
+PARTITIONED_MODELS = {
+    model._meta.db_table: model for model in [EntityHistory, EntitySectionPosition]
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Creates the upcoming monthly partitions of EntityHistory and "
+        "EntitySectionPosition and optionally detaches (or drops) the old "
+        "ones. Meant to be run periodically (e.g. daily, see the "
+        "manage_history_partitions task). Partitions with rows still "
+        "referenced from other tables (e.g. leads or active registries) "
+        "are never detached."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--months_ahead",
+            type=int,
+            default=3,
+            help="Number of future months that must have a partition",
+        )
+        parser.add_argument(
+            "--detach_older_than",
+            type=int,
+            nargs="?",
+            help="If given, the partitions whose data is older than this "
+            "amount of months are detached from their table. Detached "
+            "partitions are regular tables that can be archived (e.g. "
+            "with pg_dump) and dropped afterwards",
+        )
+        parser.add_argument(
+            "--drop",
+            action="store_true",
+            help="Drop the partitions after detaching them",
+        )
+        parser.add_argument(
+            "--dry_run",
+            action="store_true",
+            help="Only print the changes that would be applied",
+        )
+
+    def handle(self, *args, **options):
+        months_ahead = options["months_ahead"]
+        detach_older_than = options["detach_older_than"]
+        drop = options["drop"]
+        dry_run = options["dry_run"]
+
+        if drop and detach_older_than is None:
+            raise CommandError("--drop requires --detach_older_than")
+
+        connection = connections[router.db_for_write(EntityHistory)]
+
+        if connection.vendor != "postgresql":
+            raise CommandError("Table partitioning requires PostgreSQL")
+
+        current_month = month_start(timezone.now())
+
+        with transaction.atomic(using=connection.alias):
+            with connection.cursor() as cursor:
+                for table in PARTITIONED_TABLES:
+                    self.manage_table_partitions(
+                        cursor,
+                        table,
+                        current_month,
+                        months_ahead,
+                        detach_older_than,
+                        drop,
+                        dry_run,
+                    )
+
+    def manage_table_partitions(
+        self,
+        cursor,
+        table,
+        current_month,
+        months_ahead,
+        detach_older_than,
+        drop,
+        dry_run,
+    ):
+        partitions = dict(get_partitions(cursor, table))
+
+        if not partitions:
+            raise CommandError(
+                "{} is not partitioned, apply the solotodo migrations "
+                "first".format(table)
+            )
+
+        # The months before this one are covered by the partition created
+        # from the original table when migrating
+        legacy_upper_bound = partitions.get(legacy_partition_name(table))
+
+        for i in range(months_ahead + 1):
+            month = add_months(current_month, i)
+
+            if legacy_upper_bound and month < legacy_upper_bound:
+                continue
+
+            if partition_name(table, month) in partitions:
+                continue
+
+            if dry_run:
+                print("Would create {} partition for {:%Y-%m}".format(table, month))
+                continue
+
+            moved_rows = create_partition(cursor, table, month)
+            if moved_rows is None:
+                continue
+
+            print("Created {} partition for {:%Y-%m}".format(table, month))
+
+            if moved_rows:
+                logger.error(
+                    "The %s partition for %s was missing, %s rows were "
+                    "inserted into the default partition and moved to the "
+                    "new one. Check that the manage_history_partitions task "
+                    "is running (celery beat)",
+                    table,
+                    "{:%Y-%m}".format(month),
+                    moved_rows,
+                )
+
+        if detach_older_than is None:
+            return
+
+        threshold = add_months(current_month, -detach_older_than)
+
+        for name, upper_bound in partitions.items():
+            if upper_bound is None or upper_bound > threshold:
+                continue
+
+            # The foreign keys to the partitioned tables aren't enforced by
+            # the database, so they are checked here
+            referenced_from = get_referenced_partition_tables(
+                cursor, name, PARTITIONED_MODELS[table], threshold
+            )
+            if referenced_from:
+                print(
+                    "Skipping {}, its rows are referenced from {}. Archive "
+                    "the unreferenced ones instead (see "
+                    "archive_entity_histories)".format(
+                        name, ", ".join(referenced_from)
+                    )
+                )
+                continue
+
+            if dry_run:
+                print("Would {} {}".format("drop" if drop else "detach", name))
+                continue
+
+            detach_partition(cursor, table, name, drop=drop)
+            print("{} {}".format("Dropped" if drop else "Detached", name))
@@ -0,0 +1,224 @@
+import re
+import time
+
+from django.core.management import BaseCommand, CommandError, call_command
+from elasticsearch.exceptions import NotFoundError
+
+from solotodo.models import EsProductEntities
+from solotodo.models.es_product_entities import BUILD_ALIAS, BUILD_ALIAS_CACHE_SECONDS
+
+
+class Command(BaseCommand):
+    help = (
+        "Manages the versioned product_entities_vN indices behind the "
+        "product_entities alias. 'rebuild' creates a new version, indexes "
+        "every product and entity in it while the live updates are also "
+        "written to it, swaps the alias atomically and garbage collects "
+        "the old versions. 'swap', 'gc' and 'abort' run those steps alone "
+        "and 'status' lists the versions."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "action", choices=["status", "rebuild", "swap", "gc", "abort"]
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Worker processes of the product and entity indexers",
+        )
+        parser.add_argument(
+            "--chunk_size", type=int, default=500, help="Entity indexer chunk size"
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=4,
+            help="Concurrent bulk requests of the entity indexer",
+        )
+        parser.add_argument(
+            "--keep_versions",
+            type=int,
+            default=1,
+            help="Number of previous versions kept (for rolling back) when "
+            "garbage collecting",
+        )
+        parser.add_argument(
+            "--min_ratio",
+            type=float,
+            default=0.9,
+            help="Minimum ratio between the documents of the new index and the "
+            "live one required to swap them",
+        )
+        parser.add_argument(
+            "--no_swap",
+            action="store_true",
+            help="Only build the new index when running 'rebuild'",
+        )
+
+    def handle(self, *args, **options):
+        self.es = EsProductEntities._get_connection()
+        self.alias = EsProductEntities._index._name
+
+        getattr(self, "handle_{}".format(options["action"]))(options)
+
+    def versions(self):
+        # Dict of version number => index name of the existing versions
+        try:
+            indices = self.es.indices.get(index="{}_v*".format(self.alias))
+        except NotFoundError:
+            return {}
+
+        versions = {}
+        for index in indices:
+            match = re.match(r"^{}_v(\d+)$".format(re.escape(self.alias)), index)
+            if match:
+                versions[int(match.group(1))] = index
+
+        return versions
+
+    def aliased_indices(self, alias):
+        try:
+            return list(self.es.indices.get_alias(name=alias).keys())
+        except NotFoundError:
+            return []
+
+    def is_legacy_index(self):
+        # The original non versioned index has the name of the alias
+        return not self.aliased_indices(self.alias) and self.es.indices.exists(
+            index=self.alias
+        )
+
+    def document_count(self, index):
+        self.es.indices.refresh(index=index)
+        return self.es.count(index=index)["count"]
+
+    def handle_status(self, options):
+        live_indices = self.aliased_indices(self.alias)
+        build_indices = self.aliased_indices(BUILD_ALIAS)
+
+        if self.is_legacy_index():
+            print(
+                "{} is a legacy index with {} documents".format(
+                    self.alias, self.document_count(self.alias)
+                )
+            )
+
+        for version, index in sorted(self.versions().items()):
+            labels = []
+            if index in live_indices:
+                labels.append("live")
+            if index in build_indices:
+                labels.append("building")
+
+            print(
+                "{} ({} documents) {}".format(
+                    index, self.document_count(index), " ".join(labels)
+                )
+            )
+
+    def handle_rebuild(self, options):
+        if self.aliased_indices(BUILD_ALIAS):
+            raise CommandError(
+                "There is a reindex in progress, finish it with 'swap' or "
+                "'abort' first"
+            )
+
+        new_version = max(self.versions(), default=0) + 1
+        new_index = EsProductEntities.versioned_index_name(new_version)
+
+        print("Creating {}".format(new_index))
+        EsProductEntities._index.clone(name=new_index).create()
+        self.es.indices.put_alias(index=new_index, name=BUILD_ALIAS)
+
+        # Every process must notice the new index before the indexers
+        # start reading, so no live update is lost
+        print("Waiting for the live writes to include {}".format(new_index))
+        time.sleep(BUILD_ALIAS_CACHE_SECONDS + 5)
+
+        print("Indexing products")
+        call_command(
+            "batch_index_es_products",
+            index=new_index,
+            workers=options["workers"],
+            refresh_snapshot=True,
+        )
+
+        print("Indexing entities")
+        call_command(
+            "batch_index_es_entities",
+            index=new_index,
+            workers=options["workers"],
+            chunk_size=options["chunk_size"],
+            concurrency=options["concurrency"],
+        )
+
+        if options["no_swap"]:
+            print(
+                "{} built, run 'swap' to make it live or 'abort' to "
+                "discard it".format(new_index)
+            )
+            return
+
+        self.handle_swap(options)
+        self.handle_gc(options)
+
+    def handle_swap(self, options):
+        build_indices = self.aliased_indices(BUILD_ALIAS)
+
+        if not build_indices:
+            raise CommandError("There is no index being built")
+
+        new_index = build_indices[0]
+        live_indices = self.aliased_indices(self.alias)
+        is_legacy_index = self.is_legacy_index()
+
+        new_count = self.document_count(new_index)
+        live_count = sum(
+            self.document_count(index)
+            for index in (live_indices or ([self.alias] if is_legacy_index else []))
+        )
+        print("{} documents in {}, {} live".format(new_count, new_index, live_count))
+
+        if new_count < live_count * options["min_ratio"]:
+            raise CommandError(
+                "{} has too few documents, not swapping it".format(new_index)
+            )
+
+        actions = [{"add": {"index": new_index, "alias": self.alias}}]
+        actions.extend(
+            {"remove": {"index": index, "alias": self.alias}}
+            for index in live_indices
+        )
+        if is_legacy_index:
+            # An alias can't have the name of an existing index, so the
+            # legacy index is deleted in the same atomic operation
+            actions.append({"remove_index": {"index": self.alias}})
+        actions.append({"remove": {"index": new_index, "alias": BUILD_ALIAS}})
+
+        self.es.indices.update_aliases(body={"actions": actions})
+        print("{} is now live".format(new_index))
+
+    def handle_gc(self, options):
+        protected_indices = set(
+            self.aliased_indices(self.alias) + self.aliased_indices(BUILD_ALIAS)
+        )
+
+        old_indices = [
+            index
+            for version, index in sorted(self.versions().items(), reverse=True)
+            if index not in protected_indices
+        ]
+
+        for index in old_indices[options["keep_versions"] :]:
+            print("Deleting {}".format(index))
+            self.es.indices.delete(index=index)
+
+    def handle_abort(self, options):
+        for index in self.aliased_indices(BUILD_ALIAS):
+            if index in self.aliased_indices(self.alias):
+                raise CommandError("{} is live, not deleting it".format(index))
+
+            print("Deleting {}".format(index))
+            self.es.indices.delete(index=index)
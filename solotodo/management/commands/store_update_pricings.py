@@ -17,10 +17,18 @@ class Command(BaseCommand):
             help="Optional arguments to pass to the parser "
             "(usually username/password) for private sites)",
         )
+        parser.add_argument(
+            "--batch_size",
+            type=int,
+            nargs="?",
+            help="If given, the entities are updated in bulk using chunks "
+            "of this size instead of one by one",
+        )
 
     def handle(self, *args, **options):
         store_names = options["stores"]
         extra_args = options["extra_args"]
+        batch_size = options["batch_size"]
         stores = Store.objects.filter(last_activation__isnull=False)
 
         if store_names:
@@ -29,6 +37,8 @@ class Command(BaseCommand):
         for store in stores:
             try:
                 store.scraper
-                store_update.delay(store.id, extra_args=extra_args)
+                store_update.delay(
+                    store.id, extra_args=extra_args, batch_size=batch_size
+                )
             except AttributeError:
                 pass
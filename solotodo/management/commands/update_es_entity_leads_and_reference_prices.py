@@ -1,22 +1,72 @@
+import time
+from collections import Counter
 from datetime import timedelta
 
-from django.core.management import BaseCommand
+from django.core.management import BaseCommand, CommandError
 from django.db.models import Count, Min
 from django.utils import timezone
+from elasticsearch.helpers import parallel_bulk
 
-from solotodo.models import Lead, EsEntity, Currency, EntityHistory
+from solotodo.models import Lead, EsEntity, EsProduct, Currency, EntityDailyPrice
+
+# Fields of the entity documents updated by this command
+UPDATED_FIELDS = [
+    "leads",
+    "reference_normal_price",
+    "reference_offer_price",
+    "reference_normal_price_usd",
+    "reference_offer_price_usd",
+]
+
+# Fields of the documents read to calculate (and compare) the updated ones
+SOURCE_FIELDS = [
+    "entity_id",
+    "product_id",
+    "currency_id",
+    "normal_price",
+    "offer_price",
+] + UPDATED_FIELDS
+
+# Seconds between progress reports
+PROGRESS_INTERVAL = 10
+
+
+def has_changed(current_value, new_value):
+    # The prices are indexed as scaled floats with two decimals
+    if current_value is None:
+        return True
+    return round(float(current_value), 2) != round(float(new_value), 2)
 
 
 class Command(BaseCommand):
+    help = (
+        "Updates the leads and reference prices of the indexed entities "
+        "using partial updates sent with concurrent bulk requests. The "
+        "documents whose values didn't change are skipped."
+    )
+
     def add_arguments(self, parser):
         parser.add_argument("--leads_days", nargs="?", type=int)
         parser.add_argument("--reference_price_start_hours", nargs="?", type=int)
         parser.add_argument("--reference_price_end_hours", nargs="?", type=int)
+        parser.add_argument(
+            "--chunk_size",
+            type=int,
+            default=1000,
+            help="Number of documents per scroll page and per bulk request",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=2,
+            help="Number of concurrent bulk requests",
+        )
 
     def handle(self, *args, **options):
         days = options["leads_days"] or 3
         start_hours = options["reference_price_start_hours"] or 84
         end_hours = options["reference_price_end_hours"] or 36
+        chunk_size = options["chunk_size"]
 
         leads = (
             Lead.objects.filter(timestamp__gte=timezone.now() - timedelta(days=days))
@@ -30,49 +80,141 @@ class Command(BaseCommand):
             x.id: float(x.exchange_rate) for x in Currency.objects.all()
         }
 
+        # The reference window is rounded to the (UTC) days of the rollup
         reference_prices = (
-            EntityHistory.objects.filter(
-                timestamp__gte=timezone.now() - timedelta(hours=start_hours),
-                timestamp__lte=timezone.now() - timedelta(hours=end_hours),
+            EntityDailyPrice.objects.filter_by_timestamp_range(
+                timezone.now() - timedelta(hours=start_hours),
+                timezone.now() - timedelta(hours=end_hours),
             )
             .order_by("entity")
             .values("entity")
             .annotate(
-                min_normal_price=Min("normal_price"), min_offer_price=Min("offer_price")
+                reference_normal_price=Min("min_normal_price"),
+                reference_offer_price=Min("min_offer_price"),
             )
         )
 
         reference_prices_dict = {
-            x["entity"]: (x["min_normal_price"], x["min_offer_price"])
+            x["entity"]: (x["reference_normal_price"], x["reference_offer_price"])
             for x in reference_prices
         }
 
-        es_results = EsEntity.search()
-        result_count = es_results.count()
+        es_search = EsEntity.search().source(SOURCE_FIELDS).params(size=chunk_size)
+        total = es_search.count()
+        print("Scanning {} entity documents".format(total))
 
-        for idx, es_hit in enumerate(es_results.scan()):
-            print("{} / {}".format(idx + 1, result_count))
-            leads = leads_dict.get(es_hit.entity_id, 0)
+        stats = Counter()
+        changed_product_ids = set()
 
-            reference_normal_price, reference_offer_price = reference_prices_dict.get(
-                es_hit.entity_id, (es_hit.normal_price, es_hit.offer_price)
-            )
-            exchange_rate = currencies_exchange_rates[es_hit.currency_id]
-
-            es_entity = EsEntity(**es_hit.to_dict(), meta=es_hit.meta.to_dict())
-            es_entity.leads = leads
-            es_entity.reference_normal_price = float(reference_normal_price)
-            es_entity.reference_offer_price = float(reference_offer_price)
-            es_entity.reference_normal_price_usd = (
-                es_entity.reference_normal_price / exchange_rate
+        def update_actions():
+            for es_hit in es_search.scan():
+                stats["scanned"] += 1
+
+                reference_normal_price, reference_offer_price = (
+                    reference_prices_dict.get(
+                        es_hit.entity_id, (es_hit.normal_price, es_hit.offer_price)
+                    )
+                )
+                exchange_rate = currencies_exchange_rates[es_hit.currency_id]
+
+                values = {
+                    "leads": leads_dict.get(es_hit.entity_id, 0),
+                    "reference_normal_price": float(reference_normal_price),
+                    "reference_offer_price": float(reference_offer_price),
+                }
+                values["reference_normal_price_usd"] = (
+                    values["reference_normal_price"] / exchange_rate
+                )
+                values["reference_offer_price_usd"] = (
+                    values["reference_offer_price"] / exchange_rate
+                )
+
+                if not any(
+                    has_changed(getattr(es_hit, field, None), value)
+                    for field, value in values.items()
+                ):
+                    stats["unchanged"] += 1
+                    continue
+
+                changed_product_ids.add(es_hit.product_id)
+
+                action = {
+                    "_op_type": "update",
+                    "_index": EsEntity._index._name,
+                    "_id": es_hit.meta.id,
+                    "_routing": "PRODUCT_{}".format(es_hit.product_id),
+                    "doc": values,
+                }
+
+                yield from EsEntity.dual_write_actions([action])
+
+        start = time.time()
+
+        results = parallel_bulk(
+            EsEntity._get_connection(),
+            update_actions(),
+            thread_count=options["concurrency"],
+            chunk_size=chunk_size,
+            raise_on_error=False,
+            raise_on_exception=False,
+        )
+
+        errors = Counter()
+        error_samples = []
+        last_progress = start
+
+        for ok, item in results:
+            ((_, info),) = item.items()
+
+            if ok:
+                stats["updated"] += 1
+            elif info.get("status") == 404:
+                # Removed since it was scanned or not yet written to the
+                # index being built
+                stats["missing"] += 1
+            else:
+                error = info.get("error")
+                errors[
+                    error.get("type") if isinstance(error, dict) else str(error)
+                ] += 1
+                if len(error_samples) < 10:
+                    error_samples.append(item)
+
+            if time.time() - last_progress >= PROGRESS_INTERVAL:
+                self.print_progress(stats, total, start, errors)
+                last_progress = time.time()
+
+        self.print_progress(stats, total, start, errors)
+
+        if changed_product_ids:
+            # The discounts of the products depend on the reference prices
+            print(
+                "Updating the discounts of {} products".format(len(changed_product_ids))
             )
-            es_entity.reference_offer_price_usd = (
-                es_entity.reference_offer_price / exchange_rate
+            EsEntity._get_connection().indices.refresh(index=EsEntity._index._name)
+            EsProduct.update_discounts(changed_product_ids)
+
+        if errors:
+            for error_sample in error_samples:
+                print(error_sample)
+
+            raise CommandError(
+                "{} documents could not be updated: {}".format(
+                    sum(errors.values()), dict(errors)
+                )
             )
-            # print(es_entity.leads)
-            # print(es_entity.reference_normal_price)
-            # print(es_entity.reference_offer_price)
-            # print(es_entity.reference_normal_price_usd)
-            # print(es_entity.reference_offer_price_usd)
 
-            es_entity.save()
+    def print_progress(self, stats, total, start, errors):
+        elapsed = time.time() - start
+        print(
+            "{}/{} scanned ({:.1f} docs/s), {} unchanged, {} updated, "
+            "{} missing, {} errors".format(
+                stats["scanned"],
+                total,
+                stats["scanned"] / elapsed if elapsed else 0,
+                stats["unchanged"],
+                stats["updated"],
+                stats["missing"],
+                sum(errors.values()),
+            )
+        )
@@ -1,3 +1,4 @@
+from metamodel.custom_functions import for_models
 from metamodel.models import MetaModel
 from .utils import pretty_dimensions, format_optional_field
 
@@ -10,6 +11,13 @@ def pretty_video_ports(elastic_search_original):
         return 'No posee'
 
 
+@for_models(
+    'Camera', 'Television', 'ExternalStorageDrive', 'MemoryCard',
+    'OpticalDiskPlayer', 'Oven', 'Refrigerator', 'UsbFlashDrive',
+    'VacuumCleaner', 'WashingMachine', 'AirConditioner', 'WaterHeater',
+    'Stove', 'SpaceHeater', 'VideoGameConsole', 'AllInOne', 'Tablet',
+    'Wearable'
+)
 def additional_es_fields(elastic_search_original, model_name):
     m = model_name
     big_value = 1000 * 1000 * 1000 * 100000
@@ -369,6 +377,10 @@ def additional_es_fields(elastic_search_original, model_name):
     return result
 
 
+@for_models(
+    'LightTube', 'LightProjector', 'Lamp', 'MemoryCardCapacity', 'MemoryCard',
+    'UsbFlashDriveCapacity'
+)
 def unicode_function(im):
     m = MetaModel.get_model_by_id(im.model_id).name
     if m == 'LightTube':
@@ -1,3 +1,7 @@
+from metamodel.custom_functions import for_models
+
+
+@for_models('Groceries')
 def additional_es_fields(elastic_search_result, model_name):
     if model_name != 'Groceries':
         return
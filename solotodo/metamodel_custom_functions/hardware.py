@@ -1,10 +1,12 @@
 # coding=utf-8
+from metamodel.custom_functions import for_models
 from metamodel.models import MetaModel
 
 from solotodo.metamodel_custom_functions.utils import pretty_dimensions, \
     format_optional_field
 
 
+@for_models('VideoCardMemoryQuantity')
 def unicode_function(im):
     m = MetaModel.get_model_by_id(im.model_id).name
     if m == 'VideoCardMemoryQuantity':
@@ -17,6 +19,11 @@ def unicode_function(im):
             return '{} MB'.format(value)
 
 
+@for_models(
+    'VideoCard', 'Processor', 'PowerSupply', 'StorageDrive', 'ComputerCase',
+    'CpuCooler', 'SolidStateDrive', 'Monitor', 'Printer', 'Mouse', 'Ram',
+    'Keyboard', 'CaseFan'
+)
 def additional_es_fields(elastic_search_original, model_name):
     m = model_name
     if m == 'VideoCard':
@@ -1,8 +1,11 @@
 from decimal import Decimal
 
+from metamodel.custom_functions import for_models
+
 from solotodo.metamodel_custom_functions.utils import pretty_dimensions
 
 
+@for_models("NotebookScreen", "NotebookScreenResolution")
 def ordering_value(im):
     m = im.model.name
     if m == "NotebookScreen":
@@ -117,6 +120,7 @@ def get_sugestions_parameters(elastic_search_result):
     return searching_criteria
 
 
+@for_models("Notebook")
 def additional_es_fields(elastic_search_result, model_name):
     if model_name == "Notebook":
         result = {}
@@ -1,5 +1,7 @@
 from decimal import Decimal
 
+from metamodel.custom_functions import for_models
+
 
 def pretty_cell_battery(cell):
     if cell['battery_mah']:
@@ -41,6 +43,7 @@ def cell_plan_main_points(elastic_search_result):
     return result
 
 
+@for_models('Cell', 'CellPlan')
 def additional_es_fields(elastic_search_result, model_name):
     m = model_name
 
@@ -1,3 +1,6 @@
+from solotodo.product_specs_loader import product_specs_scope
+
+
 class CacheControlMiddleware:
     def __init__(self, get_response):
         self.get_response = get_response
@@ -32,3 +35,14 @@ class CrawlerMiddleware:
         response = self.get_response(request)
 
         return response
+
+
+class ProductSpecsLoaderMiddleware:
+    # Batches the Elasticsearch requests of Product.specs made while
+    # handling the request, see solotodo.product_specs_loader
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with product_specs_scope():
+            return self.get_response(request)
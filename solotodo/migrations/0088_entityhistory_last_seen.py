@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("solotodo", "0087_productfieldwatcher"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="entityhistory",
+            name="last_seen",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
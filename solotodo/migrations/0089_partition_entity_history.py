@@ -0,0 +1,107 @@
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+
+from solotodo.partitioning import (
+    PARTITIONED_TABLES,
+    add_months,
+    convert_to_partitioned_table,
+    create_default_partition,
+    create_partition,
+    month_start,
+)
+
+# Partitions created in advance, after that the partitions are maintained
+# using the manage_history_partitions task (scheduled with celery beat).
+# Rows of months without a partition go to the DEFAULT partition until
+# it's created
+MONTHS_AHEAD = 3
+
+
+def fill_section_positions_timestamp(apps, schema_editor):
+    EntityHistory = apps.get_model("solotodo", "EntityHistory")
+    EntitySectionPosition = apps.get_model("solotodo", "EntitySectionPosition")
+
+    EntitySectionPosition.objects.using(schema_editor.connection.alias).update(
+        timestamp=Subquery(
+            EntityHistory.objects.filter(pk=OuterRef("entity_history")).values(
+                "timestamp"
+            )[:1]
+        )
+    )
+
+
+def partition_tables(apps, schema_editor):
+    # Only PostgreSQL supports native partitioning, the tables are kept
+    # as they are on other backends. On big databases create the unique
+    # (id, timestamp) index of each table concurrently before migrating,
+    # otherwise it's built here while the table is locked (see
+    # convert_to_partitioned_table)
+    if schema_editor.connection.vendor != "postgresql":
+        return
+
+    boundary = add_months(month_start(timezone.now()), 1)
+
+    with schema_editor.connection.cursor() as cursor:
+        for table in PARTITIONED_TABLES:
+            convert_to_partitioned_table(cursor, table, boundary)
+
+            for i in range(MONTHS_AHEAD):
+                create_partition(cursor, table, add_months(boundary, i))
+
+            create_default_partition(cursor, table)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("solotodo", "0088_entityhistory_last_seen"),
+        ("alerts", "0013_alter_productpricealerthistory_entries"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="entity",
+            name="active_registry",
+            field=models.OneToOneField(
+                db_constraint=False,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="+",
+                to="solotodo.entityhistory",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="lead",
+            name="entity_history",
+            field=models.ForeignKey(
+                db_constraint=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                to="solotodo.entityhistory",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="entitysectionposition",
+            name="entity_history",
+            field=models.ForeignKey(
+                db_constraint=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                to="solotodo.entityhistory",
+            ),
+        ),
+        migrations.AddField(
+            model_name="entitysectionposition",
+            name="timestamp",
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunPython(
+            fill_section_positions_timestamp, migrations.RunPython.noop
+        ),
+        migrations.AlterField(
+            model_name="entitysectionposition",
+            name="timestamp",
+            field=models.DateTimeField(),
+        ),
+        migrations.RunPython(partition_tables),
+    ]
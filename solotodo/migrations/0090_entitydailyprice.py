@@ -0,0 +1,85 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("solotodo", "0089_partition_entity_history"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="EntityDailyPrice",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField(db_index=True)),
+                (
+                    "min_normal_price",
+                    models.DecimalField(decimal_places=2, max_digits=12),
+                ),
+                (
+                    "max_normal_price",
+                    models.DecimalField(decimal_places=2, max_digits=12),
+                ),
+                (
+                    "min_offer_price",
+                    models.DecimalField(decimal_places=2, max_digits=12),
+                ),
+                (
+                    "max_offer_price",
+                    models.DecimalField(decimal_places=2, max_digits=12),
+                ),
+                (
+                    "min_cell_monthly_payment",
+                    models.DecimalField(
+                        blank=True, decimal_places=2, max_digits=12, null=True
+                    ),
+                ),
+                ("is_available", models.BooleanField()),
+                (
+                    "available_min_normal_price",
+                    models.DecimalField(
+                        blank=True, decimal_places=2, max_digits=12, null=True
+                    ),
+                ),
+                (
+                    "available_min_offer_price",
+                    models.DecimalField(
+                        blank=True, decimal_places=2, max_digits=12, null=True
+                    ),
+                ),
+                (
+                    "available_min_offer_price_timestamp",
+                    models.DateTimeField(blank=True, null=True),
+                ),
+                (
+                    "max_review_count",
+                    models.PositiveIntegerField(blank=True, null=True),
+                ),
+                ("review_avg_score_sum", models.FloatField()),
+                ("review_avg_score_count", models.PositiveIntegerField()),
+                ("registry_count", models.PositiveIntegerField()),
+                ("last_timestamp", models.DateTimeField()),
+                (
+                    "entity",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="solotodo.entity",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ("entity", "date"),
+                "unique_together": {("entity", "date")},
+            },
+        ),
+    ]
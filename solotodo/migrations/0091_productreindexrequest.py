@@ -0,0 +1,33 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("solotodo", "0090_entitydailyprice"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ProductReindexRequest",
+            fields=[
+                (
+                    "product",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        serialize=False,
+                        to="solotodo.product",
+                    ),
+                ),
+                (
+                    "creation_date",
+                    models.DateTimeField(auto_now_add=True, db_index=True),
+                ),
+            ],
+            options={
+                "ordering": ("creation_date",),
+            },
+        ),
+    ]
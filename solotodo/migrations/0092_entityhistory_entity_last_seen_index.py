@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("solotodo", "0091_productreindexrequest"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="entityhistory",
+            index=models.Index(
+                condition=models.Q(("last_seen__isnull", False)),
+                fields=["entity", "last_seen"],
+                name="solotodo_eh_entity_last_seen",
+            ),
+        ),
+    ]
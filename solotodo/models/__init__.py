@@ -34,10 +34,12 @@ from .category import Category
 from .bundle import Bundle
 from .brand import Brand
 from .product import Product
+from .product_reindex_request import ProductReindexRequest
 from .product_picture import ProductPicture
 from .rating import Rating
 from .entity import Entity
 from .entity_history import EntityHistory
+from .entity_daily_price import EntityDailyPrice
 from .entity_log import EntityLog
 from .store_update_log import StoreUpdateLog
 from .lead import Lead
@@ -73,6 +75,8 @@ def create_or_update_product(instance_model, created, creator_id, **kwargs):
     if instance_model.model in category_models:
         try:
             existing_product = Product.objects.get(instance_model=instance_model)
+            # Reuses the instance fields already loaded by the instance model
+            existing_product.instance_model = instance_model
             existing_product.save()
         except Product.DoesNotExist:
             new_product = Product()
@@ -82,19 +86,23 @@ def create_or_update_product(instance_model, created, creator_id, **kwargs):
 
 @receiver(instance_model_saved)
 def update_related_products(instance_model, created, creator_id, **kwargs):
-    from solotodo.tasks import product_save
-
-    for related_product in (
+    related_products = (
         EsProduct.search()
         .filter("term", related_instance_model_ids=instance_model.id)
+        .source(["product_id"])
         .scan()
-    ):
-        product_save.delay(related_product.product_id)
+    )
+
+    ProductReindexRequest.objects.enqueue(
+        related_product.product_id for related_product in related_products
+    )
 
 
 @receiver(product_saved)
 def update_product_in_es(product, es_document, **kwargs):
     EsProduct.from_product(product, es_document).save()
+    # The new document doesn't have the discount of the product
+    EsProduct.schedule_discount_update([product.id])
 
 
 @receiver(post_delete, sender=Product)
@@ -110,6 +118,14 @@ def update_preferred_stores_last_updated(sender, instance, *args, **kwargs):
 
 @receiver(post_save, sender=Entity)
 def update_entity_in_es(sender, instance, **kwargs):
+    # Set by Entity.update_keeping_log when using dirty field tracking and
+    # none of the fields used by the document changed
+    if getattr(instance, "_skip_es_sync", False):
+        return
+
+    if EsEntity.defer_sync(instance.id):
+        return
+
     if EsEntity.should_entity_be_indexed(instance):
         EsEntity.from_entity(instance).save()
     else:
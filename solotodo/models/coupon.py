@@ -34,6 +34,12 @@ class Coupon(models.Model):
         )
 
     def apply(self):
+        from solotodo.models import EsEntity
+
+        with EsEntity.deferred_sync():
+            self._apply()
+
+    def _apply(self):
         from solotodo.models import Entity
 
         es = Entity.objects.get_active().filter(
@@ -73,8 +79,11 @@ class Coupon(models.Model):
 
     @classmethod
     def apply_all_coupons(cls):
-        for coupon in cls.objects.all():
-            coupon.apply()
+        from solotodo.models import EsEntity
+
+        with EsEntity.deferred_sync():
+            for coupon in cls.objects.all():
+                coupon.apply()
 
     class Meta:
         app_label = 'solotodo'
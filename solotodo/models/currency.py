@@ -48,6 +48,8 @@ class Currency(models.Model):
 
     @classmethod
     def update_exchange_rates(cls):
+        from solotodo.tasks import update_es_entity_usd_prices
+
         currencies = cls.objects.exclude(iso_code='USD')
 
         currency_codes = ','.join([c.iso_code for c in currencies])
@@ -58,11 +60,19 @@ class Currency(models.Model):
 
         for currency in currencies:
             xr_key = 'USD' + currency.iso_code
+            previous_exchange_rate = currency.exchange_rate
             exchange_rate = xr_data[xr_key]
             currency.exchange_rate = exchange_rate
             currency.exchange_rate_last_updated = timezone.now()
             currency.save()
 
+            # Compare the rate as stored, with two decimals
+            currency.refresh_from_db(fields=['exchange_rate'])
+            if currency.exchange_rate != previous_exchange_rate:
+                # The USD prices of the indexed entities are updated in
+                # place instead of waiting for their next save
+                update_es_entity_usd_prices.delay(currency.id)
+
     class Meta:
         app_label = 'solotodo'
         ordering = ['name']
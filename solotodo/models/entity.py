@@ -10,8 +10,9 @@ from PIL import Image
 from django.core.validators import validate_comma_separated_integer_list
 from pyzbar.pyzbar import decode
 from django.contrib.auth import get_user_model
-from django.db import models, IntegrityError
+from django.db import models, IntegrityError, router
 from django.db.models import Q, Count
+from django.db.models.signals import post_save
 from django.utils import timezone
 from solotodo.utils import iterable_to_dict, fetch_sec_fields
 from .product import Product
@@ -75,15 +76,30 @@ class EntityQueryset(models.QuerySet):
         raise Exception('Queryset level update is disabled on Entity as it '
                         'does not emit pre_save / post_save signals')
 
+    def bulk_update(self, objs, fields, batch_size=None):
+        # bulk_update works over model instances, so unlike update() we can
+        # still emit post_save for each of them once they are written.
+        # auto_now fields are not touched by bulk_update, so callers must
+        # set "last_updated" themselves if they want it refreshed.
+        db = self._db or router.db_for_write(self.model)
+        result = models.QuerySet(self.model, using=db).bulk_update(
+            objs, fields, batch_size=batch_size)
+
+        for obj in objs:
+            post_save.send(sender=self.model, instance=obj, created=False,
+                           update_fields=frozenset(fields), raw=False,
+                           using=db)
+
+        return result
+
     def estimated_sales(self, start_date=None, end_date=None,
                         sorting='normal_price_sum'):
         from solotodo.models import EntityHistory
 
-        ehs = EntityHistory.objects.filter(entity__in=self, stock__gt=0)
-        if start_date:
-            ehs = ehs.filter(timestamp__gte=start_date)
-        if end_date:
-            ehs = ehs.filter(timestamp__lte=end_date)
+        # Compressed registries don't need to be expanded as their
+        # repetitions wouldn't represent any stock movement
+        ehs = EntityHistory.objects.filter(entity__in=self, stock__gt=0) \
+            .filter_seen_between(start_date, end_date)
 
         ehs = ehs.order_by('entity', 'timestamp').select_related('entity')
 
@@ -199,6 +215,19 @@ class Entity(models.Model):
     ]
     CONDITION_CHOICES_DICT = dict(CONDITION_CHOICES)
 
+    # Fields that change on every scraping without representing an actual
+    # change of the entity data, so on their own they don't bump
+    # last_updated when saving with dirty field tracking
+    PRICING_BOOKKEEPING_FIELDS = {'active_registry', 'last_pricing_update'}
+
+    # Fields read by EsEntity.from_entity and
+    # EsEntity.should_entity_be_indexed
+    ES_DOCUMENT_FIELDS = {
+        'store', 'seller', 'category', 'currency', 'condition', 'product',
+        'bundle', 'best_coupon', 'name', 'part_number', 'sku', 'key', 'url',
+        'active_registry', 'last_updated',
+    }
+
     store = models.ForeignKey(Store, on_delete=models.CASCADE)
     category = models.ForeignKey(Category, on_delete=models.CASCADE)
     scraped_category = models.ForeignKey(Category, on_delete=models.CASCADE,
@@ -213,10 +242,13 @@ class Entity(models.Model):
     best_coupon = models.ForeignKey(Coupon, on_delete=models.SET_NULL,
                                     null=True, blank=True,
                                     related_name='entities_with_coupon')
+    # EntityHistory is partitioned by month, so references to it can't be
+    # enforced by the database (see solotodo.partitioning)
     active_registry = models.OneToOneField('EntityHistory',
                                            on_delete=models.CASCADE,
                                            related_name='+',
-                                           null=True)
+                                           null=True,
+                                           db_constraint=False)
     name = models.CharField(max_length=256, db_index=True)
     cell_plan_name = models.CharField(max_length=60, null=True,
                                       blank=True, db_index=True)
@@ -291,7 +323,7 @@ class Entity(models.Model):
     def update_with_scraped_product(self, scraped_product, sections_dict={},
                                     category=None, currency=None):
         from solotodo.models import EntityHistory, StoreSection, \
-            EntitySectionPosition
+            EntitySectionPosition, EntityDailyPrice
 
         assert scraped_product is None or self.key == scraped_product.key
 
@@ -300,9 +332,7 @@ class Entity(models.Model):
         if not self.active_registry_id and not scraped_product:
             return
 
-        updated_data = {
-            'last_pricing_update': timezone.now(),
-        }
+        new_active_registry = None
 
         if scraped_product:
             if category is None:
@@ -313,18 +343,17 @@ class Entity(models.Model):
                 currency = Currency.objects.get(
                     iso_code=scraped_product.currency)
 
-            new_active_registry = EntityHistory.objects.create(
-                entity=self,
-                stock=scraped_product.stock,
-                normal_price=scraped_product.normal_price,
-                offer_price=scraped_product.offer_price,
-                cell_monthly_payment=scraped_product.cell_monthly_payment,
-                timestamp=scraped_product.timestamp,
-                picture_count=scraped_product.picture_urls_count(),
-                video_count=scraped_product.video_urls_count(),
-                review_count=scraped_product.review_count,
-                review_avg_score=scraped_product.review_avg_score
-            )
+            new_active_registry = self.extensible_registry(scraped_product)
+
+            if new_active_registry:
+                new_active_registry.last_seen = scraped_product.timestamp
+                new_active_registry.save(update_fields=['last_seen'])
+            else:
+                new_active_registry = EntityHistory.from_scraped_product(
+                    self, scraped_product)
+                new_active_registry.save()
+
+            EntityDailyPrice.objects.register([new_active_registry])
 
             for section_name, position_value in scraped_product.positions:
                 store_section = sections_dict.get(section_name)
@@ -338,9 +367,38 @@ class Entity(models.Model):
                 EntitySectionPosition.objects.create(
                     section=store_section,
                     entity_history=new_active_registry,
-                    value=position_value
+                    value=position_value,
+                    timestamp=new_active_registry.timestamp
                 )
 
+        updated_data = self.scraped_product_updated_data(
+            scraped_product, category, currency, new_active_registry)
+
+        self.update_keeping_log(updated_data, track_dirty_fields=True)
+
+    def extensible_registry(self, scraped_product):
+        # If the compressed history mode is enabled and the given scraping
+        # didn't change the entity, returns its active registry so that it
+        # can be extended instead of creating a new one
+        from django.conf import settings
+
+        if settings.ENTITY_HISTORY_COMPRESSION and self.active_registry_id \
+                and self.active_registry.can_be_extended_with(
+                    scraped_product):
+            return self.active_registry
+
+        return None
+
+    def scraped_product_updated_data(self, scraped_product, category,
+                                     currency, new_active_registry):
+        # Returns the dictionary of fields that should be updated in this
+        # entity given the (possibly None) scraped product and its already
+        # created EntityHistory
+        updated_data = {
+            'last_pricing_update': timezone.now(),
+        }
+
+        if scraped_product:
             updated_data.update({
                 'name': scraped_product.name,
                 'scraped_category': category,
@@ -372,15 +430,12 @@ class Entity(models.Model):
                 'active_registry': None
             })
 
-        self.update_keeping_log(updated_data)
+        return updated_data
 
     @classmethod
-    def create_from_scraped_product(cls, scraped_product, store, category,
-                                    currency, sections_dict):
-        from solotodo.models import EntityHistory, StoreSection, \
-            EntitySectionPosition
-
-        new_entity = cls.objects.create(
+    def from_scraped_product(cls, scraped_product, store, category, currency):
+        # Returns a new (unsaved) entity based on the given scraped product
+        return cls(
             store=store,
             category=category,
             scraped_category=category,
@@ -407,18 +462,20 @@ class Entity(models.Model):
             last_pricing_update=timezone.now(),
         )
 
-        new_entity_history = EntityHistory.objects.create(
-            entity=new_entity,
-            stock=scraped_product.stock,
-            normal_price=scraped_product.normal_price,
-            offer_price=scraped_product.offer_price,
-            cell_monthly_payment=scraped_product.cell_monthly_payment,
-            timestamp=scraped_product.timestamp,
-            picture_count=scraped_product.picture_urls_count(),
-            video_count=scraped_product.video_urls_count(),
-            review_count=scraped_product.review_count,
-            review_avg_score=scraped_product.review_avg_score
-        )
+    @classmethod
+    def create_from_scraped_product(cls, scraped_product, store, category,
+                                    currency, sections_dict):
+        from solotodo.models import EntityHistory, StoreSection, \
+            EntitySectionPosition, EntityDailyPrice
+
+        new_entity = cls.from_scraped_product(scraped_product, store,
+                                              category, currency)
+        new_entity.save()
+
+        new_entity_history = EntityHistory.from_scraped_product(
+            new_entity, scraped_product)
+        new_entity_history.save()
+        EntityDailyPrice.objects.register([new_entity_history])
 
         new_entity.active_registry = new_entity_history
         new_entity.save()
@@ -435,10 +492,92 @@ class Entity(models.Model):
             EntitySectionPosition.objects.create(
                 section=store_section,
                 entity_history=new_entity_history,
-                value=position_value
+                value=position_value,
+                timestamp=new_entity_history.timestamp
             )
 
-    def update_keeping_log(self, updated_data, user=None):
+    def update_keeping_log(self, updated_data, user=None,
+                           track_dirty_fields=False):
+        # If track_dirty_fields is True only the fields that actually
+        # changed are saved, and the Elasticsearch document of the entity
+        # is left alone if none of the fields it uses changed
+        if track_dirty_fields:
+            update_fields = self.dirty_fields_for_update(updated_data)
+        else:
+            update_fields = None
+
+        entity_log = self.apply_updated_data(updated_data, user)
+
+        if update_fields is None:
+            self.save()
+        else:
+            try:
+                if update_fields:
+                    self.save(update_fields=update_fields)
+            finally:
+                self._skip_es_sync = False
+
+        if entity_log:
+            entity_log.save()
+
+    def changed_fields(self, updated_data):
+        changed_fields = []
+
+        for field_name, new_value in updated_data.items():
+            field = self._meta.get_field(field_name)
+
+            if field.is_relation:
+                old_value = getattr(self, field.attname)
+                new_value = new_value.pk if new_value is not None else None
+            else:
+                old_value = getattr(self, field_name)
+
+            if old_value != new_value:
+                changed_fields.append(field_name)
+
+        return changed_fields
+
+    def dirty_fields_for_update(self, updated_data):
+        # Returns the fields that should be passed as update_fields to save()
+        # in order to persist updated_data (must be called before applying
+        # it). Also flags the entity so that its Elasticsearch document is
+        # not updated if none of the fields it reads changed.
+        changed_fields = set(self.changed_fields(updated_data))
+
+        es_document_changed = False
+        for field in changed_fields & self.ES_DOCUMENT_FIELDS:
+            if field != 'active_registry' or \
+                    self._registry_es_signature(self.active_registry) != \
+                    self._registry_es_signature(
+                        updated_data['active_registry']):
+                es_document_changed = True
+                break
+
+        if changed_fields - self.PRICING_BOOKKEEPING_FIELDS or \
+                es_document_changed:
+            changed_fields.add('last_updated')
+            # The document includes last_updated, so it has to be synced
+            # even if only fields it doesn't otherwise read changed
+            es_document_changed = True
+
+        self._skip_es_sync = not es_document_changed
+
+        return sorted(changed_fields)
+
+    @staticmethod
+    def _registry_es_signature(entity_history):
+        # The values of an EntityHistory used by the EsEntity document
+        if entity_history is None:
+            return None
+
+        return (entity_history.stock != 0, entity_history.normal_price,
+                entity_history.offer_price,
+                entity_history.cell_monthly_payment)
+
+    def apply_updated_data(self, updated_data, user=None):
+        # Sets the values of updated_data in this entity without saving it.
+        # Returns the (unsaved) EntityLog that records the change, or None
+        # if none of the logged fields changed.
         from solotodo.models import EntityLog
 
         if not user:
@@ -460,15 +599,16 @@ class Entity(models.Model):
 
             setattr(self, field, new_value)
 
-        self.save()
+        if not save_log:
+            return None
 
-        if save_log:
-            # Fill the remaining fields
-            for field in EntityLog.DATA_FIELDS:
-                if field not in updated_data:
-                    entity_value = getattr(self, field)
-                    setattr(entity_log, field, entity_value)
-            entity_log.save()
+        # Fill the remaining fields
+        for field in EntityLog.DATA_FIELDS:
+            if field not in updated_data:
+                entity_value = getattr(self, field)
+                setattr(entity_log, field, entity_value)
+
+        return entity_log
 
     def save(self, *args, **kwargs):
         is_associated = bool(self.product_id or self.cell_plan_id or
@@ -0,0 +1,345 @@
+import datetime
+
+from django.db import models, connections, transaction
+from django.db.models import Min, Max, Sum
+from django.db.models.functions import ExtractIsoYear, ExtractWeek
+
+from .entity import Entity
+from .store import Store
+from .category import Category
+
+
+def _least(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
+
+
+def _greatest(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return max(a, b)
+
+
+class EntityDailyPriceQuerySet(models.QuerySet):
+    # Columns of the rollup and how two partial rollups of the same entity
+    # and date are merged, both here (_merge) and in the upsert query
+    MERGED_FIELDS = [
+        ('min_normal_price', 'LEAST'),
+        ('max_normal_price', 'GREATEST'),
+        ('min_offer_price', 'LEAST'),
+        ('max_offer_price', 'GREATEST'),
+        ('min_cell_monthly_payment', 'LEAST'),
+        ('is_available', 'OR'),
+        ('available_min_normal_price', 'LEAST'),
+        ('available_min_offer_price', 'LEAST'),
+        ('available_min_offer_price_timestamp', None),
+        ('max_review_count', 'GREATEST'),
+        ('review_avg_score_sum', 'SUM'),
+        ('review_avg_score_count', 'SUM'),
+        ('registry_count', 'SUM'),
+        ('last_timestamp', 'GREATEST'),
+    ]
+
+    def register(self, registries, use_last_seen=True):
+        """
+        Updates the rollup with the given EntityHistory registries. Each
+        registry is accounted as observed at its last_seen timestamp if
+        set (extended by the compressed history mode) or else at its
+        timestamp. If use_last_seen is False only the timestamp is used
+        (e.g. for registries expanded with EntityHistory.expand). Uses an
+        INSERT ... ON CONFLICT upsert on PostgreSQL.
+        """
+        rollups = {}
+        for registry in registries:
+            rollup = self._rollup_from_registry(registry, use_last_seen)
+            key = (rollup['entity_id'], rollup['date'])
+            rollups[key] = self._merge(rollups[key], rollup) \
+                if key in rollups else rollup
+
+        if not rollups:
+            return
+
+        self._for_write = True
+        connection = connections[self.db]
+
+        if connection.vendor == 'postgresql':
+            self._upsert(connection, list(rollups.values()))
+            return
+
+        with transaction.atomic(using=self.db):
+            for rollup in rollups.values():
+                daily_price = self.select_for_update().filter(
+                    entity_id=rollup['entity_id'],
+                    date=rollup['date']).first()
+
+                if daily_price:
+                    rollup = self._merge(
+                        {field: getattr(daily_price, field)
+                         for field, _ in self.MERGED_FIELDS},
+                        rollup)
+                    for field, _ in self.MERGED_FIELDS:
+                        setattr(daily_price, field, rollup[field])
+                    daily_price.save()
+                else:
+                    self.create(**rollup)
+
+    def filter_by_timestamp_range(self, start=None, end=None):
+        # Rollups of the (UTC) days touched by the given timestamp range
+        qs = self
+        if start:
+            qs = qs.filter(
+                date__gte=start.astimezone(datetime.timezone.utc).date())
+        if end:
+            qs = qs.filter(
+                date__lte=end.astimezone(datetime.timezone.utc).date())
+        return qs
+
+    def daily_summary(self, available_only=False):
+        """
+        Returns a list of dicts with the same format as
+        EntityHistoryQueryset.summarize_by_period('date'). If
+        available_only is True only the prices of the entities while
+        available are considered.
+        """
+        qs = self
+        normal_price_field = 'min_normal_price'
+        offer_price_field = 'min_offer_price'
+
+        if available_only:
+            qs = qs.filter(is_available=True)
+            normal_price_field = 'available_min_normal_price'
+            offer_price_field = 'available_min_offer_price'
+
+        return [
+            {
+                'entity': x['entity'],
+                'date': x['date'],
+                'min_normal_price': x[normal_price_field],
+                'min_offer_price': x[offer_price_field],
+                'min_cell_monthly_payment': x['min_cell_monthly_payment'],
+                'review_count': x['max_review_count'],
+                'review_avg_score':
+                    x['review_avg_score_sum'] / x['review_avg_score_count']
+                    if x['review_avg_score_count'] else None
+            }
+            for x in qs.order_by('entity', 'date').values(
+                'entity', 'date', normal_price_field, offer_price_field,
+                'min_cell_monthly_payment', 'max_review_count',
+                'review_avg_score_sum', 'review_avg_score_count')
+        ]
+
+    def weekly_summary(self):
+        """
+        Returns a list of dicts with the same format as
+        EntityHistoryQueryset.summarize_by_period('week').
+        """
+        summaries = self.annotate(
+            year=ExtractIsoYear('date'),
+            week=ExtractWeek('date')
+        ).order_by('entity', 'year', 'week').values(
+            'entity', 'year', 'week'
+        ).annotate(
+            week_min_normal_price=Min('min_normal_price'),
+            week_min_offer_price=Min('min_offer_price'),
+            week_min_cell_monthly_payment=Min('min_cell_monthly_payment'),
+            week_max_review_count=Max('max_review_count'),
+            week_review_avg_score_sum=Sum('review_avg_score_sum'),
+            week_review_avg_score_count=Sum('review_avg_score_count')
+        )
+
+        return [
+            {
+                'entity': x['entity'],
+                'year': x['year'],
+                'week': x['week'],
+                'min_normal_price': x['week_min_normal_price'],
+                'min_offer_price': x['week_min_offer_price'],
+                'min_cell_monthly_payment':
+                    x['week_min_cell_monthly_payment'],
+                'review_count': x['week_max_review_count'],
+                'review_avg_score':
+                    x['week_review_avg_score_sum'] /
+                    x['week_review_avg_score_count']
+                    if x['week_review_avg_score_count'] else None
+            }
+            for x in summaries
+        ]
+
+    def filter_by_user_perms(self, user, permission):
+        synth_permissions = {
+            'view_entity_history': {
+                'store': 'view_store',
+                'category': 'view_category',
+            }
+        }
+
+        assert permission in synth_permissions
+
+        permissions = synth_permissions[permission]
+
+        stores_with_permissions = Store.objects.filter_by_user_perms(
+            user, permissions['store'])
+        categories_with_permissions = Category.objects.filter_by_user_perms(
+            user, permissions['category'])
+
+        return self.filter(
+            entity__store__in=stores_with_permissions,
+            entity__category__in=categories_with_permissions,
+        )
+
+    @staticmethod
+    def _rollup_from_registry(registry, use_last_seen):
+        timestamp = registry.timestamp
+        if use_last_seen and registry.last_seen:
+            timestamp = registry.last_seen
+        is_available = registry.stock != 0
+
+        return {
+            'entity_id': registry.entity_id,
+            # Days are UTC days, like Cast('timestamp', DateField())
+            'date': timestamp.astimezone(datetime.timezone.utc).date(),
+            'min_normal_price': registry.normal_price,
+            'max_normal_price': registry.normal_price,
+            'min_offer_price': registry.offer_price,
+            'max_offer_price': registry.offer_price,
+            'min_cell_monthly_payment': registry.cell_monthly_payment,
+            'is_available': is_available,
+            'available_min_normal_price':
+                registry.normal_price if is_available else None,
+            'available_min_offer_price':
+                registry.offer_price if is_available else None,
+            'available_min_offer_price_timestamp':
+                timestamp if is_available else None,
+            'max_review_count': registry.review_count,
+            'review_avg_score_sum': registry.review_avg_score or 0,
+            'review_avg_score_count':
+                0 if registry.review_avg_score is None else 1,
+            'registry_count': 1,
+            'last_timestamp': timestamp,
+        }
+
+    @classmethod
+    def _merge(cls, old, new):
+        merged = dict(new)
+
+        for field, operation in cls.MERGED_FIELDS:
+            if operation == 'LEAST':
+                merged[field] = _least(old[field], new[field])
+            elif operation == 'GREATEST':
+                merged[field] = _greatest(old[field], new[field])
+            elif operation == 'OR':
+                merged[field] = old[field] or new[field]
+            elif operation == 'SUM':
+                merged[field] = old[field] + new[field]
+
+        # The latest moment the (available) minimum offer price was seen
+        old_price = old['available_min_offer_price']
+        new_price = new['available_min_offer_price']
+        if new_price is None or \
+                (old_price is not None and old_price < new_price):
+            merged['available_min_offer_price_timestamp'] = \
+                old['available_min_offer_price_timestamp']
+        elif old_price == new_price:
+            merged['available_min_offer_price_timestamp'] = _greatest(
+                old['available_min_offer_price_timestamp'],
+                new['available_min_offer_price_timestamp'])
+
+        return merged
+
+    def _upsert(self, connection, rollups, batch_size=1000):
+        opts = self.model._meta
+        table = connection.ops.quote_name(opts.db_table)
+        fields = ['entity_id', 'date'] + [f for f, _ in self.MERGED_FIELDS]
+        columns = [connection.ops.quote_name(opts.get_field(f).column)
+                   for f in fields]
+        column_for_field = dict(zip(fields, columns))
+
+        assignments = []
+        for field, operation in self.MERGED_FIELDS:
+            column = column_for_field[field]
+            if operation in ['LEAST', 'GREATEST']:
+                expression = '{op}({table}.{col}, EXCLUDED.{col})'
+            elif operation == 'OR':
+                expression = '{table}.{col} OR EXCLUDED.{col}'
+            elif operation == 'SUM':
+                expression = '{table}.{col} + EXCLUDED.{col}'
+            else:
+                # available_min_offer_price_timestamp, evaluated against
+                # the previous values of the row
+                price_column = column_for_field['available_min_offer_price']
+                expression = (
+                    'CASE WHEN EXCLUDED.{price} IS NULL OR '
+                    '{table}.{price} < EXCLUDED.{price} THEN {table}.{col} '
+                    'WHEN {table}.{price} = EXCLUDED.{price} '
+                    'THEN GREATEST({table}.{col}, EXCLUDED.{col}) '
+                    'ELSE EXCLUDED.{col} END'
+                ).replace('{price}', price_column)
+            assignments.append('{} = {}'.format(column, expression.format(
+                op=operation, table=table, col=column)))
+
+        with connection.cursor() as cursor:
+            for i in range(0, len(rollups), batch_size):
+                batch = rollups[i:i + batch_size]
+                placeholders = ', '.join(
+                    ['({})'.format(', '.join(['%s'] * len(fields)))] *
+                    len(batch))
+                cursor.execute(
+                    'INSERT INTO {} ({}) VALUES {} '
+                    'ON CONFLICT ({}, {}) DO UPDATE SET {}'.format(
+                        table, ', '.join(columns), placeholders,
+                        column_for_field['entity_id'],
+                        column_for_field['date'],
+                        ', '.join(assignments)),
+                    [rollup[field] for rollup in batch for field in fields])
+
+
+class EntityDailyPrice(models.Model):
+    """
+    Daily rollup of the EntityHistory of each entity, kept up to date as
+    registries are written (see EntityDailyPriceQuerySet.register) and
+    filled for the existing history with the
+    backfill_entity_daily_prices command. Dates are UTC dates.
+    """
+    entity = models.ForeignKey(Entity, on_delete=models.CASCADE)
+    date = models.DateField(db_index=True)
+    min_normal_price = models.DecimalField(decimal_places=2, max_digits=12)
+    max_normal_price = models.DecimalField(decimal_places=2, max_digits=12)
+    min_offer_price = models.DecimalField(decimal_places=2, max_digits=12)
+    max_offer_price = models.DecimalField(decimal_places=2, max_digits=12)
+    min_cell_monthly_payment = models.DecimalField(
+        decimal_places=2, max_digits=12, null=True, blank=True)
+    # Whether the entity was available at some point of the day, and its
+    # minimum prices while available
+    is_available = models.BooleanField()
+    available_min_normal_price = models.DecimalField(
+        decimal_places=2, max_digits=12, null=True, blank=True)
+    available_min_offer_price = models.DecimalField(
+        decimal_places=2, max_digits=12, null=True, blank=True)
+    available_min_offer_price_timestamp = models.DateTimeField(
+        null=True, blank=True)
+    max_review_count = models.PositiveIntegerField(null=True, blank=True)
+    review_avg_score_sum = models.FloatField()
+    review_avg_score_count = models.PositiveIntegerField()
+    registry_count = models.PositiveIntegerField()
+    last_timestamp = models.DateTimeField()
+
+    objects = EntityDailyPriceQuerySet.as_manager()
+
+    @property
+    def review_avg_score(self):
+        if not self.review_avg_score_count:
+            return None
+        return self.review_avg_score_sum / self.review_avg_score_count
+
+    def __str__(self):
+        return '{} - {}'.format(self.entity, self.date)
+
+    class Meta:
+        app_label = 'solotodo'
+        ordering = ('entity', 'date')
+        unique_together = ('entity', 'date')
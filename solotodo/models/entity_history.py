@@ -1,12 +1,227 @@
-from django.db import models
+import copy
+import io
+from datetime import timedelta
+from itertools import chain
+
+from django.conf import settings
+from django.db import models, connections, transaction
+from django.db.models import Min, Max, Sum, Count, Q, DateField
+from django.db.models.functions import Cast, ExtractWeek, ExtractIsoYear
 
 from solotodo.models.entity import Entity
+from solotodo.partitioning import month_start
+
+
+def _copy_text_value(value):
+    # Serializes a python value using the PostgreSQL COPY text format
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t') \
+        .replace('\n', '\\n').replace('\r', '\\r')
 
 
 class EntityHistoryQueryset(models.QuerySet):
     def get_available(self):
         return self.exclude(stock=0)
 
+    def copy_create(self, objs):
+        """
+        Alternative to bulk_create for large amounts of registries that
+        uses PostgreSQL's COPY FROM STDIN. The ids of the new rows are
+        reserved from the table sequence beforehand and assigned to the
+        given objects, so they can be referenced afterwards (e.g. by
+        Entity.active_registry or EntitySectionPosition). Falls back to
+        bulk_create on other database backends.
+        """
+        objs = list(objs)
+
+        if not objs:
+            return objs
+
+        self._for_write = True
+        connection = connections[self.db]
+
+        if connection.vendor != 'postgresql':
+            return self.bulk_create(objs)
+
+        opts = self.model._meta
+        fields = opts.concrete_fields
+
+        with transaction.atomic(using=self.db, savepoint=False):
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'SELECT nextval(pg_get_serial_sequence(%s, %s)) '
+                    'FROM generate_series(1, %s)',
+                    [opts.db_table, opts.pk.column, len(objs)])
+                new_ids = [row[0] for row in cursor.fetchall()]
+
+                data = io.StringIO()
+                for obj, new_id in zip(objs, new_ids):
+                    obj._prepare_related_fields_for_save(
+                        operation_name='copy_create')
+                    obj.pk = new_id
+                    data.write('\t'.join(
+                        _copy_text_value(field.get_db_prep_save(
+                            field.pre_save(obj, True), connection))
+                        for field in fields))
+                    data.write('\n')
+                data.seek(0)
+
+                cursor.copy_expert(
+                    'COPY {} ({}) FROM STDIN'.format(
+                        connection.ops.quote_name(opts.db_table),
+                        ', '.join(connection.ops.quote_name(field.column)
+                                  for field in fields)),
+                    data)
+
+        for obj in objs:
+            obj._state.adding = False
+            obj._state.db = self.db
+
+        return objs
+
+    def filter_seen_between(self, start=None, end=None):
+        # Registries whose validity interval (from timestamp to last_seen)
+        # overlaps the given range, taking into account the registries
+        # extended by the compressed history mode. As registries are never
+        # extended past their month, the lower bound on timestamp allows
+        # PostgreSQL to prune the older partitions. Without compression
+        # last_seen is never set, so the plain timestamp range is used.
+        qs = self
+        if end:
+            qs = qs.filter(timestamp__lte=end)
+        if start:
+            if settings.ENTITY_HISTORY_COMPRESSION:
+                qs = qs.filter(
+                    Q(timestamp__gte=start) | Q(last_seen__gte=start),
+                    timestamp__gte=month_start(start))
+            else:
+                qs = qs.filter(timestamp__gte=start)
+        return qs
+
+    def expand(self, start=None, end=None, step=timedelta(days=1)):
+        # Iterates over the registries of the queryset replacing each
+        # compressed registry by one copy every step (by default daily)
+        # along its validity interval. See EntityHistory.expand
+        for entity_history in self:
+            yield from entity_history.expand(start, end, step)
+
+    def summarize_by_period(self, period, start=None, end=None,
+                            archived=None):
+        """
+        Returns the minimum prices and the review stats of each entity
+        grouped by period, which can be 'date' or 'week' (ISO year and
+        week). The result is a list of dicts ordered by entity and period,
+        equivalent to using values(...).annotate(...) over the
+        uncompressed history. Plain registries are aggregated in the
+        database and the compressed ones are expanded and merged here.
+        archived may be an iterable of ArchivedHistory (see
+        solotodo.history_archive) to include in the summary.
+        """
+        if period == 'date':
+            period_fields = ['date']
+            period_annotations = {'date': Cast('timestamp', DateField())}
+
+            def period_key(timestamp):
+                return timestamp.date(),
+        elif period == 'week':
+            period_fields = ['year', 'week']
+            period_annotations = {
+                'year': ExtractIsoYear('timestamp'),
+                'week': ExtractWeek('timestamp')
+            }
+
+            def period_key(timestamp):
+                return tuple(timestamp.isocalendar()[:2])
+        else:
+            raise ValueError('Invalid period: {}'.format(period))
+
+        summaries = {}
+
+        def merge(key, normal_price, offer_price, cell_monthly_payment,
+                  review_count, review_avg_score_sum,
+                  review_avg_score_count):
+            summary = summaries.get(key)
+            if summary is None:
+                summaries[key] = [normal_price, offer_price,
+                                  cell_monthly_payment, review_count,
+                                  review_avg_score_sum,
+                                  review_avg_score_count]
+                return
+
+            for idx, value, function in [
+                    (0, normal_price, min),
+                    (1, offer_price, min),
+                    (2, cell_monthly_payment, min),
+                    (3, review_count, max)]:
+                if value is not None:
+                    summary[idx] = value if summary[idx] is None else \
+                        function(summary[idx], value)
+
+            if review_avg_score_count:
+                summary[4] = (summary[4] or 0) + review_avg_score_sum
+                summary[5] += review_avg_score_count
+
+        plain_summaries = self.filter(last_seen__isnull=True) \
+            .annotate(**period_annotations) \
+            .values('entity', *period_fields) \
+            .annotate(
+                min_normal_price=Min('normal_price'),
+                min_offer_price=Min('offer_price'),
+                min_cell_monthly_payment=Min('cell_monthly_payment'),
+                max_review_count=Max('review_count'),
+                review_avg_score_sum=Sum('review_avg_score'),
+                review_avg_score_count=Count('review_avg_score')
+            ).order_by()
+
+        for x in plain_summaries:
+            merge((x['entity'],) + tuple(x[f] for f in period_fields),
+                  x['min_normal_price'], x['min_offer_price'],
+                  x['min_cell_monthly_payment'], x['max_review_count'],
+                  x['review_avg_score_sum'], x['review_avg_score_count'])
+
+        compressed_registries = self.filter(last_seen__isnull=False) \
+            .select_related(None).order_by()
+
+        compressed_registries = compressed_registries.expand(start, end)
+
+        for archived_history in archived or []:
+            for archived_summary in archived_history.summarize_by_period(
+                    period):
+                merge(*archived_summary)
+
+            compressed_registries = chain(
+                compressed_registries,
+                (expanded_registry
+                 for registry in archived_history.compressed_registries()
+                 for expanded_registry in registry.expand(start, end)))
+
+        for eh in compressed_registries:
+            merge((eh.entity_id,) + period_key(eh.timestamp),
+                  eh.normal_price, eh.offer_price, eh.cell_monthly_payment,
+                  eh.review_count, eh.review_avg_score or 0,
+                  0 if eh.review_avg_score is None else 1)
+
+        result = []
+        for key in sorted(summaries.keys()):
+            summary = summaries[key]
+            entry = {'entity': key[0]}
+            entry.update(zip(period_fields, key[1:]))
+            entry.update({
+                'min_normal_price': summary[0],
+                'min_offer_price': summary[1],
+                'min_cell_monthly_payment': summary[2],
+                'review_count': summary[3],
+                'review_avg_score': summary[4] / summary[5]
+                if summary[5] else None
+            })
+            result.append(entry)
+
+        return result
+
     def filter_by_user_perms(self, user, permission):
         from solotodo.models import Category, Store
 
@@ -47,14 +262,89 @@ class EntityHistory(models.Model):
     video_count = models.PositiveIntegerField(null=True, blank=True)
     review_count = models.PositiveIntegerField(null=True, blank=True)
     review_avg_score = models.FloatField(blank=True, null=True)
+    # Only used by the compressed history mode
+    # (settings.ENTITY_HISTORY_COMPRESSION). If set, the registry also
+    # represents every (unchanged) scraping of the entity up to this
+    # moment. Use EntityHistoryQueryset.filter_seen_between and expand to
+    # query the history taking this into account.
+    last_seen = models.DateTimeField(null=True, blank=True)
 
     objects = EntityHistoryQueryset.as_manager()
 
     is_available = property(lambda self: self.stock != 0)
 
+    # Fields compared to decide if a scraping can extend an existing registry
+    COMPRESSION_FIELDS = ['stock', 'normal_price', 'offer_price',
+                          'cell_monthly_payment', 'picture_count',
+                          'video_count', 'review_count', 'review_avg_score']
+
     def __str__(self):
         return u'{} - {}'.format(self.entity, self.timestamp)
 
+    @classmethod
+    def from_scraped_product(cls, entity, scraped_product):
+        # Returns a new (unsaved) registry for the entity based on the given
+        # scraped product
+        return cls(
+            entity=entity,
+            stock=scraped_product.stock,
+            normal_price=scraped_product.normal_price,
+            offer_price=scraped_product.offer_price,
+            cell_monthly_payment=scraped_product.cell_monthly_payment,
+            timestamp=scraped_product.timestamp,
+            picture_count=scraped_product.picture_urls_count(),
+            video_count=scraped_product.video_urls_count(),
+            review_count=scraped_product.review_count,
+            review_avg_score=scraped_product.review_avg_score
+        )
+
+    def is_equivalent_to(self, other):
+        return all(getattr(self, field) == getattr(other, field)
+                   for field in self.COMPRESSION_FIELDS)
+
+    def can_be_extended_with(self, scraped_product):
+        # Whether the compressed history mode can represent the given
+        # scraping by extending this registry. Section positions are
+        # snapshots bound to their registry, so scrapings that report
+        # them always generate a new one. Registries are not extended
+        # past their (partition) month.
+        return not scraped_product.positions and \
+            month_start(self.timestamp) == \
+            month_start(scraped_product.timestamp) and \
+            self.is_equivalent_to(
+                self.from_scraped_product(None, scraped_product))
+
+    def expand(self, start=None, end=None, step=timedelta(days=1)):
+        # Yields this registry followed by (unsaved) copies of it every
+        # step up to its last_seen timestamp, so that compressed registries
+        # can be consumed as if the history was stored uncompressed. Only
+        # the copies within [start, end] are returned.
+        last_seen = self.last_seen or self.timestamp
+        timestamp = self.timestamp
+
+        while True:
+            if (start is None or timestamp >= start) and \
+                    (end is None or timestamp <= end):
+                if timestamp == self.timestamp:
+                    yield self
+                else:
+                    expanded_registry = copy.copy(self)
+                    expanded_registry.timestamp = timestamp
+                    expanded_registry.last_seen = None
+                    yield expanded_registry
+
+            if timestamp >= last_seen or (end and timestamp > end):
+                break
+
+            timestamp = min(timestamp + step, last_seen)
+
     class Meta:
         app_label = 'solotodo'
         ordering = ['entity', 'timestamp']
+        indexes = [
+            # Used by filter_seen_between in the compressed history mode,
+            # only the extended registries are indexed
+            models.Index(fields=['entity', 'last_seen'],
+                         condition=Q(last_seen__isnull=False),
+                         name='solotodo_eh_entity_last_seen'),
+        ]
@@ -39,9 +39,14 @@ class EntitySectionPositionQuerySet(models.QuerySet):
 
 
 class EntitySectionPosition(models.Model):
-    entity_history = models.ForeignKey(EntityHistory, on_delete=models.CASCADE)
+    entity_history = models.ForeignKey(EntityHistory, on_delete=models.CASCADE,
+                                       db_constraint=False)
     section = models.ForeignKey(StoreSection, on_delete=models.CASCADE)
     value = models.IntegerField()
+    # Copy of entity_history.timestamp, used as the partition key of the
+    # table. Filter by it instead of entity_history__timestamp so that
+    # PostgreSQL can prune the partitions outside of the queried range.
+    timestamp = models.DateTimeField()
 
     objects = EntitySectionPositionQuerySet.as_manager()
 
@@ -1,12 +1,44 @@
+import threading
+import time
+from contextlib import contextmanager
 from datetime import timedelta
 from decimal import Decimal
 
 from django.db.models import Min
 from elasticsearch.exceptions import NotFoundError
+from elasticsearch.helpers import BulkIndexError, bulk
 from elasticsearch_dsl import Keyword, Integer, Date, ScaledFloat
+from .es_product import EsProduct
 from .es_product_entities import EsProductEntities
 from solotodo.models import Lead
 
+# Fields in the currency of the entity => the fields derived from them
+# dividing by the exchange rate of the currency (see update_usd_prices)
+USD_PRICE_FIELDS = {
+    "normal_price": "normal_price_usd",
+    "offer_price": "offer_price_usd",
+    "reference_normal_price": "reference_normal_price_usd",
+    "reference_offer_price": "reference_offer_price_usd",
+    "normal_price_per_unit": "normal_price_usd_per_unit",
+    "offer_price_per_unit": "offer_price_usd_per_unit",
+    "normal_price_with_coupon": "normal_price_usd_with_coupon",
+    "offer_price_with_coupon": "offer_price_usd_with_coupon",
+}
+
+USD_PRICES_SCRIPT = """
+for (entry in params.fields.entrySet()) {
+    def value = ctx._source[entry.getKey()];
+    if (value != null) {
+        ctx._source[entry.getValue()] =
+            ((Number) value).doubleValue() / params.exchange_rate;
+    }
+}
+"""
+
+# Holds the ids of the entities saved while a deferred sync is active in the
+# current thread (see EsEntity.deferred_sync)
+_deferred_sync_state = threading.local()
+
 
 class EsEntity(EsProductEntities):
     entity_id = Integer()
@@ -77,16 +109,21 @@ class EsEntity(EsProductEntities):
         )
 
     @classmethod
-    def from_entity(cls, entity):
+    def from_entity(cls, entity, existing_entry=None, fetch_existing_entry=True):
+        # The reference prices and leads of the entity are carried over from
+        # its current document. Callers that already fetched it (e.g. using
+        # mget) can pass it as existing_entry and set fetch_existing_entry
+        # to False to avoid the extra request.
         from django.conf import settings
 
         assert cls.should_entity_be_indexed(entity)
         active_registry = entity.active_registry
 
-        try:
-            existing_entry = cls.get_by_entity_id(entity.id)
-        except NotFoundError:
-            existing_entry = None
+        if fetch_existing_entry:
+            try:
+                existing_entry = cls.get_by_entity_id(entity.id)
+            except NotFoundError:
+                existing_entry = None
 
         if existing_entry:
             reference_normal_price = Decimal(existing_entry.reference_normal_price)
@@ -200,9 +237,210 @@ class EsEntity(EsProductEntities):
         )
 
     @classmethod
-    def get_by_entity_id(cls, entity_id):
-        return cls.get("ENTITY_{}".format(entity_id))
+    @contextmanager
+    def deferred_sync(cls):
+        """
+        Context manager that collects the ids of the entities saved inside
+        of it instead of synchronizing them one by one, and then updates
+        all of them at the end using EsEntity.sync_entities.
+        Nested blocks are merged into the outermost one.
+        """
+        pending_entity_ids = getattr(_deferred_sync_state, "entity_ids", None)
+
+        if pending_entity_ids is not None:
+            yield
+            return
+
+        _deferred_sync_state.entity_ids = set()
+
+        try:
+            yield
+        finally:
+            pending_entity_ids = _deferred_sync_state.entity_ids
+            _deferred_sync_state.entity_ids = None
+            cls.sync_entities(pending_entity_ids)
+
+    @classmethod
+    def defer_sync(cls, entity_id):
+        # Registers the entity for synchronization at the end of the
+        # current deferred sync block. Returns False if there is no such
+        # block, in which case the caller should sync the entity right away.
+        pending_entity_ids = getattr(_deferred_sync_state, "entity_ids", None)
+
+        if pending_entity_ids is None:
+            return False
+
+        pending_entity_ids.add(entity_id)
+        return True
+
+    @classmethod
+    def sync_entities(cls, entity_ids, chunk_size=500):
+        """
+        Indexes or deletes the documents of the given entities using one
+        mget and one bulk request per chunk. The changes are also applied
+        to the index being built by a reindex, if any.
+        """
+        entity_ids = list(entity_ids)
+
+        for i in range(0, len(entity_ids), chunk_size):
+            actions = cls.sync_actions(entity_ids[i : i + chunk_size])
+
+            if not actions:
+                continue
+
+            _, errors = bulk(
+                cls._get_connection(),
+                cls.dual_write_actions(actions),
+                raise_on_error=False,
+            )
+
+            # The index being built may not have the deleted documents yet
+            errors = [
+                error
+                for error in errors
+                if not (
+                    "delete" in error and error["delete"].get("status") == 404
+                )
+            ]
+
+            if errors:
+                raise BulkIndexError(
+                    "{} document(s) failed to sync".format(len(errors)), errors
+                )
+
+            EsProduct.schedule_discount_update(
+                int(action["_routing"].replace("PRODUCT_", "")) for action in actions
+            )
+
+    @classmethod
+    def update_usd_prices(cls, currency_id, exchange_rate, index=None):
+        """
+        Recalculates the USD prices of the documents of the entities in the
+        given currency using the given exchange rate, with a throttled
+        update_by_query per index (the live one and the one being built, if
+        any, unless an index is given) whose progress is printed until it
+        finishes. Returns the number of updated documents.
+
+        The USD prices per unit are calculated from the prices per unit, for
+        the groceries this differs from from_entity (which converts the
+        prices before applying the conversion factor) by less than the
+        rounding of the local prices per unit.
+        """
+        from django.conf import settings
+
+        es = cls._get_connection()
+        query = cls.search().filter("term", currency_id=currency_id).to_dict()
+        indices = [index] if index else [cls._index._name, cls.build_index_name()]
+        updated_count = 0
+
+        for index in filter(None, indices):
+            response = es.update_by_query(
+                index=index,
+                body={
+                    "query": query["query"],
+                    "script": {
+                        "source": USD_PRICES_SCRIPT,
+                        "lang": "painless",
+                        "params": {
+                            "fields": USD_PRICE_FIELDS,
+                            "exchange_rate": float(exchange_rate),
+                        },
+                    },
+                },
+                # Documents written meanwhile already have the new prices
+                conflicts="proceed",
+                refresh=True,
+                requests_per_second=settings.ES_USD_PRICES_UPDATE_REQUESTS_PER_SECOND,
+                wait_for_completion=False,
+            )
+
+            while True:
+                task = es.tasks.get(task_id=response["task"])
+                status = task["task"]["status"]
+                print(
+                    "{}: {}/{} documents of currency {} updated".format(
+                        index, status["updated"], status["total"], currency_id
+                    )
+                )
+
+                if task["completed"]:
+                    break
+
+                time.sleep(settings.ES_USD_PRICES_UPDATE_POLL_INTERVAL)
+
+            failures = task.get("response", {}).get("failures", [])
+            if "error" in task:
+                failures.append(task["error"])
+
+            if failures:
+                raise BulkIndexError(
+                    "{} USD price update(s) failed".format(len(failures)), failures
+                )
+
+            updated_count += status["updated"]
+
+        return updated_count
+
+    @classmethod
+    def sync_actions(cls, entity_ids):
+        """
+        Returns the bulk actions (index or delete) that synchronize the
+        documents of the given entities, fetching their current documents
+        with a single mget.
+        """
+        from solotodo.models import Entity
+
+        entities_dict = {
+            e.id: e
+            for e in Entity.objects.filter(pk__in=entity_ids).select_related(
+                "active_registry",
+                "currency",
+                "bundle",
+                "product__brand",
+                "product__instance_model",
+                "store__country",
+                "category",
+                "best_coupon",
+            )
+        }
+
+        existing_entries = cls.mget(
+            ["ENTITY_{}".format(entity_id) for entity_id in entity_ids],
+            missing="none",
+        )
+
+        actions = []
+
+        for entity_id, existing_entry in zip(entity_ids, existing_entries):
+            entity = entities_dict.get(entity_id)
+
+            if entity and cls.should_entity_be_indexed(entity):
+                es_entity = cls.from_entity(
+                    entity,
+                    existing_entry=existing_entry,
+                    fetch_existing_entry=False,
+                )
+                es_entity.meta.routing = "PRODUCT_{}".format(entity.product_id)
+                actions.append(es_entity.to_dict(include_meta=True))
+            elif existing_entry:
+                actions.append(
+                    {
+                        "_op_type": "delete",
+                        "_index": cls._index._name,
+                        "_id": existing_entry.meta.id,
+                        "_routing": "PRODUCT_{}".format(existing_entry.product_id),
+                    }
+                )
+
+        return actions
 
     def save(self, **kwargs):
         self.meta.routing = "PRODUCT_{}".format(self.product_id)
-        return super(EsEntity, self).save(**kwargs)
+        result = super(EsEntity, self).save(**kwargs)
+        EsProduct.schedule_discount_update([self.product_id])
+        return result
+
+    def delete(self, **kwargs):
+        result = super(EsEntity, self).delete(**kwargs)
+        EsProduct.schedule_discount_update([self.product_id])
+        return result
@@ -1,11 +1,71 @@
-from elasticsearch_dsl import Text, Keyword, Object, Integer, Date
-from .es_product_entities import EsProductEntities
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from elasticsearch.helpers import BulkIndexError, bulk
+from elasticsearch.exceptions import NotFoundError
+from elasticsearch_dsl import (
+    Q,
+    Text,
+    Keyword,
+    Object,
+    Integer,
+    Date,
+    ScaledFloat,
+    analyzer,
+    token_filter,
+)
+from .es_product_entities import EsProductEntities, BUILD_ALIAS_CACHE_SECONDS
+
+# Lengths of the n-grams of the "substring" subfields of the analyzed text
+# fields. Search terms outside of this range fall back to wildcard queries.
+# The difference between them is capped by index.max_ngram_diff (see
+# EsProductEntities.Index)
+SUBSTRING_MIN_GRAM = 2
+SUBSTRING_MAX_GRAM = 15
+
+# Indexes every substring of every token of the field, so the substring
+# searches of the products (see EsProduct.substring_query) are term lookups
+# instead of wildcard queries scanning the whole terms dictionary
+substring_analyzer = analyzer(
+    "substring",
+    tokenizer="standard",
+    filter=[
+        "lowercase",
+        token_filter(
+            "substring_ngram",
+            "ngram",
+            min_gram=SUBSTRING_MIN_GRAM,
+            max_gram=SUBSTRING_MAX_GRAM,
+        ),
+    ],
+)
+
+# The search terms are already split and lowercased, so they are looked up
+# as they are
+substring_search_analyzer = analyzer(
+    "substring_search", tokenizer="keyword", filter=["lowercase"]
+)
+
+_substring_fields_cache = {"available": None, "expiration": 0}
+
+
+def substring_text():
+    return Text(
+        fields={
+            "substring": Text(
+                analyzer=substring_analyzer,
+                search_analyzer=substring_search_analyzer,
+            )
+        }
+    )
 
 
 class EsProduct(EsProductEntities):
     product_id = Integer()
     name = Keyword()
-    name_analyzed = Text()
+    name_analyzed = substring_text()
     category_id = Integer()
     category_name = Keyword()
     brand_id = Integer()
@@ -14,9 +74,15 @@ class EsProduct(EsProductEntities):
     instance_model_id = Integer()
     creation_date = Date()
     last_updated = Date()
-    keywords = Text()
+    keywords = substring_text()
     specs = Object(dynamic=True)
     related_instance_model_ids = Integer(multi=True)
+    # Difference between the minimum reference offer price and the minimum
+    # offer price (in USD) of the entities of the product, kept up to date
+    # by update_discounts
+    discount = ScaledFloat(scaling_factor=100)
+    # Same, using only the entities of each country, keyed by country id
+    country_discounts = Object(dynamic=True)
 
     @classmethod
     def search(cls, **kwargs):
@@ -60,3 +126,228 @@ class EsProduct(EsProductEntities):
             product_relationships="product",
             meta={"id": "PRODUCT_{}".format(product.id)},
         )
+
+    @classmethod
+    def has_substring_fields(cls):
+        """
+        Returns whether the live index has the "substring" subfields. The
+        indices created before them have to be rebuilt (see the
+        reindex_product_entities command), meanwhile substring_query falls
+        back to wildcard queries.
+        """
+        now = time.monotonic()
+
+        if _substring_fields_cache["expiration"] < now:
+            try:
+                mappings = cls._get_connection().indices.get_field_mapping(
+                    fields="keywords.substring", index=cls._index._name
+                )
+                available = bool(mappings) and all(
+                    index_mappings["mappings"] for index_mappings in mappings.values()
+                )
+            except NotFoundError:
+                available = False
+
+            _substring_fields_cache["available"] = available
+            _substring_fields_cache["expiration"] = now + BUILD_ALIAS_CACHE_SECONDS
+
+        return _substring_fields_cache["available"]
+
+    @classmethod
+    def substring_query(cls, field, term, boost=1.0):
+        """
+        Query for the documents with a token of the given text field (one
+        defined with substring_text) containing the given lowercase term.
+        Equivalent to a "*term*" wildcard query, including its constant
+        score, but resolved with the n-grams of the field.
+        """
+        if (
+            SUBSTRING_MIN_GRAM <= len(term) <= SUBSTRING_MAX_GRAM
+            and cls.has_substring_fields()
+        ):
+            return Q(
+                "constant_score",
+                filter=Q("term", **{field + ".substring": term}),
+                boost=boost,
+            )
+
+        return Q("wildcard", **{field: {"value": "*{}*".format(term), "boost": boost}})
+
+    @classmethod
+    def schedule_discount_update(cls, product_ids):
+        """
+        Schedules the update of the discount of the given products, usually
+        because the documents of their entities changed. The updates of a
+        product are debounced for ES_PRODUCT_DISCOUNT_UPDATE_DELAY seconds.
+        """
+        from solotodo.tasks import update_es_product_discounts
+
+        delay = settings.ES_PRODUCT_DISCOUNT_UPDATE_DELAY
+
+        product_ids = [
+            product_id
+            for product_id in set(product_ids)
+            if cache.add(
+                "es_product_discount_update_{}".format(product_id), True, delay
+            )
+        ]
+
+        if product_ids:
+            # The extra seconds give ES time to refresh the index so the
+            # task sees the changes made until the cache keys expire
+            transaction.on_commit(
+                lambda: update_es_product_discounts.apply_async(
+                    args=[product_ids], countdown=delay + 2
+                )
+            )
+
+    @staticmethod
+    def calculate_discount(min_price, min_reference_price):
+        if min_price is None or min_reference_price is None:
+            return 0.0
+        return float(max(min_reference_price - min_price, 0))
+
+    @classmethod
+    def discounts(cls, product_ids=None, index=None, page_size=1000):
+        """
+        Yields (product_id, discount, country_discounts) tuples calculated
+        from the entities of the given products (all of them by default)
+        using a composite aggregation by product and country.
+        country_discounts is a dict of country id (as a string, like in the
+        documents) => discount. Products without entities are omitted.
+        """
+        from solotodo.models import EsEntity
+
+        search = EsEntity.search()
+
+        if index:
+            search = search.index().index(index)
+
+        if product_ids is not None:
+            search = search.filter("terms", product_id=list(product_ids))
+
+        def product_discounts(product_id, country_prices):
+            # country_prices: country id => (min price, min reference price)
+            min_prices = [x[0] for x in country_prices.values() if x[0] is not None]
+            min_reference_prices = [
+                x[1] for x in country_prices.values() if x[1] is not None
+            ]
+            discount = cls.calculate_discount(
+                min(min_prices, default=None), min(min_reference_prices, default=None)
+            )
+            country_discounts = {
+                str(country_id): cls.calculate_discount(*prices)
+                for country_id, prices in country_prices.items()
+            }
+            return product_id, discount, country_discounts
+
+        after_key = None
+        # The buckets are sorted by product, the ones of a product may span
+        # several pages
+        current_product_id = None
+        country_prices = {}
+
+        while True:
+            paged_search = search[:0]
+            composite_params = {
+                "sources": [
+                    {"product_id": {"terms": {"field": "product_id"}}},
+                    {"country_id": {"terms": {"field": "country_id"}}},
+                ],
+                "size": page_size,
+            }
+            if after_key:
+                composite_params["after"] = after_key
+
+            paged_search.aggs.bucket(
+                "products", "composite", **composite_params
+            ).metric("min_price", "min", field="offer_price_usd").metric(
+                "min_reference_price", "min", field="reference_offer_price_usd"
+            )
+
+            products_agg = paged_search.execute().aggs.products.to_dict()
+
+            for bucket in products_agg["buckets"]:
+                product_id = bucket["key"]["product_id"]
+
+                if product_id != current_product_id:
+                    if country_prices:
+                        yield product_discounts(current_product_id, country_prices)
+                    current_product_id = product_id
+                    country_prices = {}
+
+                country_prices[bucket["key"]["country_id"]] = (
+                    bucket["min_price"]["value"],
+                    bucket["min_reference_price"]["value"],
+                )
+
+            after_key = products_agg.get("after_key")
+            if not after_key or not products_agg["buckets"]:
+                break
+
+        if country_prices:
+            yield product_discounts(current_product_id, country_prices)
+
+    @classmethod
+    def update_discounts(cls, product_ids=None, index=None, chunk_size=500):
+        """
+        Updates the discount field of the given products (all of them by
+        default) with partial updates. The given products without entities
+        get a zero discount. Unless an index is given the live index and
+        the one being built, if any, are updated.
+        """
+        from solotodo.models import Country
+
+        discounts = {
+            product_id: (discount, country_discounts)
+            for product_id, discount, country_discounts in cls.discounts(
+                product_ids, index
+            )
+        }
+
+        if product_ids is not None:
+            for product_id in product_ids:
+                discounts.setdefault(product_id, (0.0, {}))
+
+        # Partial updates merge the country_discounts objects, so every
+        # country is written to reset the ones the product no longer has
+        country_ids = [
+            str(country_id)
+            for country_id in Country.objects.values_list("id", flat=True)
+        ]
+        items = list(discounts.items())
+
+        for i in range(0, len(items), chunk_size):
+            actions = [
+                {
+                    "_op_type": "update",
+                    "_index": index or cls._index._name,
+                    "_id": "PRODUCT_{}".format(product_id),
+                    "doc": {
+                        "discount": discount,
+                        "country_discounts": dict(
+                            dict.fromkeys(country_ids, 0.0), **country_discounts
+                        ),
+                    },
+                }
+                for product_id, (discount, country_discounts) in items[
+                    i : i + chunk_size
+                ]
+            ]
+
+            if not index:
+                actions = cls.dual_write_actions(actions)
+
+            _, errors = bulk(cls._get_connection(), actions, raise_on_error=False)
+
+            # Products removed or not indexed yet
+            errors = [
+                error
+                for error in errors
+                if not ("update" in error and error["update"].get("status") == 404)
+            ]
+
+            if errors:
+                raise BulkIndexError(
+                    "{} discount(s) failed to update".format(len(errors)), errors
+                )
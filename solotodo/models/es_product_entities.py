@@ -1,5 +1,19 @@
+import time
+
+from elasticsearch.exceptions import NotFoundError
 from elasticsearch_dsl import Document, Join, MetaField
 
+# Alias of the index currently being built by the reindex_product_entities
+# command. While it exists every write to the live index is also applied
+# to the index behind it, so the new index doesn't miss the updates made
+# during the build.
+BUILD_ALIAS = 'product_entities_build'
+
+# Seconds a process keeps using its last lookup of BUILD_ALIAS
+BUILD_ALIAS_CACHE_SECONDS = 30
+
+_build_index_cache = {'index': None, 'expiration': 0}
+
 
 class EsProductEntities(Document):
     product_relationships = Join(relations={'product': 'entity'})
@@ -10,6 +24,79 @@ class EsProductEntities(Document):
         # gets used for deserialization
         return False
 
+    @classmethod
+    def versioned_index_name(cls, version):
+        return '{}_v{}'.format(cls._index._name, version)
+
+    @classmethod
+    def build_index_name(cls):
+        """
+        Returns the name of the index being built (see BUILD_ALIAS) or None
+        if there is no reindex in progress.
+        """
+        now = time.monotonic()
+
+        if _build_index_cache['expiration'] < now:
+            try:
+                aliases = cls._get_connection().indices.get_alias(
+                    name=BUILD_ALIAS)
+                build_index = next(iter(aliases))
+            except NotFoundError:
+                build_index = None
+
+            _build_index_cache['index'] = build_index
+            _build_index_cache['expiration'] = \
+                now + BUILD_ALIAS_CACHE_SECONDS
+
+        return _build_index_cache['index']
+
+    @classmethod
+    def dual_write_actions(cls, actions):
+        # Bulk actions for the live index plus their copies for the index
+        # being built, if any
+        actions = list(actions)
+        build_index = cls.build_index_name()
+
+        if not build_index:
+            return actions
+
+        return actions + [dict(action, _index=build_index)
+                          for action in actions]
+
+    def save(self, index=None, **kwargs):
+        # Unless an index is given the document is written through the
+        # alias (not the index of the hit it may come from, which may have
+        # been replaced) and to the index being built
+        if index:
+            return super(EsProductEntities, self).save(index=index, **kwargs)
+
+        result = super(EsProductEntities, self).save(
+            index=self._index._name, **kwargs)
+
+        build_index = self.build_index_name()
+        if build_index:
+            super(EsProductEntities, self).save(index=build_index, **kwargs)
+
+        return result
+
+    def delete(self, index=None, **kwargs):
+        if index:
+            return super(EsProductEntities, self).delete(
+                index=index, **kwargs)
+
+        result = super(EsProductEntities, self).delete(
+            index=self._index._name, **kwargs)
+
+        build_index = self.build_index_name()
+        if build_index:
+            try:
+                super(EsProductEntities, self).delete(
+                    index=build_index, **kwargs)
+            except NotFoundError:
+                pass
+
+        return result
+
     class Meta:
         dynamic = MetaField('strict')
         dynamic_templates = MetaField([
@@ -34,10 +121,14 @@ class EsProductEntities(Document):
         ])
 
     class Index:
+        # Alias of the live product_entities_vN index, see the
+        # reindex_product_entities command
         name = 'product_entities'
         settings = {
             'index.mapping.total_fields.limit': 10000,
             'index.max_result_window': 200000,
             # Update this value if solotodo grows to more than 1000000 products
-            'index.max_terms_count': 1000000
+            'index.max_terms_count': 1000000,
+            # Range of the substring n-grams of EsProduct
+            'index.max_ngram_diff': 13,
         }
@@ -10,13 +10,20 @@ from django.core.validators import validate_comma_separated_integer_list
 from django.db import models, IntegrityError
 from django.db.models import Q
 from django.db.models.deletion import Collector
+from django.utils import timezone
 from django.utils.text import slugify
+from elasticsearch.helpers import bulk
 from sklearn.neighbors import NearestNeighbors
 
 from metamodel.models import InstanceModel
 from .es_product import EsProduct
 from solotodo.signals import product_saved
 from solotodo.models.utils import solotodo_com_site
+from solotodo.product_specs_loader import (
+    load_entries,
+    load_product_entry,
+    register_product,
+)
 
 from .category import Category
 from .brand import Brand
@@ -48,26 +55,26 @@ class ProductQuerySet(models.QuerySet):
 
         return self.filter(query).distinct()
 
+    @staticmethod
+    def _es_matching_product_ids(es_search):
+        # Scrolls through every match fetching only their ids, a single page
+        # sized after the queryset may exceed index.max_result_window
+        return [hit.product_id for hit in es_search.source(["product_id"]).scan()]
+
     def filter_by_search_string(self, search):
         es_search = EsProduct.search()
         # es_search = es_search.filter('terms', product_id=[p.id for p in self])
         q = Product.query_es_by_search_string(search, mode="AND")
         es_search = es_search.filter(q)
 
-        matching_product_ids = [
-            r.product_id for r in es_search[: self.count()].execute()
-        ]
-        return self.filter(pk__in=matching_product_ids)
+        return self.filter(pk__in=self._es_matching_product_ids(es_search))
 
     def filter_by_name(self, search):
         es_search = EsProduct.search()
         q = Product.query_es_by_name(search, mode="AND")
         es_search = es_search.filter(q)
 
-        matching_product_ids = [
-            r.product_id for r in es_search[: self.count()].execute()
-        ]
-        return self.filter(pk__in=matching_product_ids)
+        return self.filter(pk__in=self._es_matching_product_ids(es_search))
 
     def filter_by_user_perms(self, user, permission):
         synth_permissions = {"view_product": "view_category"}
@@ -78,6 +85,48 @@ class ProductQuerySet(models.QuerySet):
             Category.objects.filter_by_user_perms(user, synth_permissions[permission])
         )
 
+    def reindex(self, chunk_size=100):
+        """
+        Batch alternative to calling save() on every product of the
+        queryset. Recomputes their Elasticsearch documents, saves the
+        fields derived from them using bulk_update and indexes the
+        documents with one bulk request per chunk.
+        """
+        product_ids = list(self.order_by("pk").values_list("pk", flat=True))
+
+        for i in range(0, len(product_ids), chunk_size):
+            products = list(
+                Product.objects.filter(
+                    pk__in=product_ids[i : i + chunk_size]
+                ).select_related("instance_model__model__category", "brand")
+            )
+
+            # Builds the documents of the whole chunk with one query per
+            # level of the relations of their instance models
+            es_documents = InstanceModel.elasticsearch_documents(
+                [product.instance_model for product in products]
+            )
+
+            now = timezone.now()
+            actions = []
+
+            for product, es_document in zip(products, es_documents):
+                product.apply_es_document(es_document)
+                product.last_updated = now
+                actions.append(
+                    EsProduct.from_product(product, es_document).to_dict(
+                        include_meta=True
+                    )
+                )
+
+            # bulk_update relies on the disabled queryset level update
+            models.QuerySet(Product, using=self.db).bulk_update(
+                products, ["brand", "part_number", "sec_qr_codes", "last_updated"]
+            )
+            bulk(EsProduct._get_connection(), EsProduct.dual_write_actions(actions))
+            # The new documents don't have the discounts of the products
+            EsProduct.schedule_discount_update(product.id for product in products)
+
     def update(self, *args, **kwargs):
         raise Exception(
             "Queryset level update is disabled on Product as it "
@@ -116,6 +165,11 @@ class Product(models.Model):
         self._es_entry = None
         super(Product, self).__init__(*args, **kwargs)
 
+        if self.pk:
+            # So its document is fetched along with the ones of the other
+            # products of the request or task (see product_specs_loader)
+            register_product(self)
+
     @property
     def category(self):
         return self.instance_model.model.category
@@ -123,18 +177,13 @@ class Product(models.Model):
     @property
     def specs(self):
         if not self._es_entry:
-            self._es_entry = EsProduct.get("PRODUCT_" + str(self.id)).to_dict()
+            self._es_entry = load_product_entry(self)
         return self._es_entry["specs"]
 
     @property
     def keywords(self):
         if not self._es_entry:
-            self._es_entry = (
-                EsProduct.search()
-                .filter("term", product_id=self.id)
-                .execute()[0]
-                .to_dict()
-            )
+            self._es_entry = load_product_entry(self)
         return self._es_entry["keywords"]
 
     @property
@@ -152,18 +201,7 @@ class Product(models.Model):
 
     @classmethod
     def prefetch_specs(cls, products):
-        product_ids = [p.id for p in products]
-
-        search = EsProduct.search().filter("terms", product_id=product_ids)[
-            : len(product_ids)
-        ]
-        response = search.execute().to_dict()
-        es_dict = {
-            e["_source"]["product_id"]: e["_source"] for e in response["hits"]["hits"]
-        }
-
-        for product in products:
-            product._es_entry = es_dict[product.id]
+        load_entries(products)
 
     def user_has_staff_perms(self, user):
         return user.has_perm("is_category_staff", self.category)
@@ -183,7 +221,18 @@ class Product(models.Model):
             )
 
         es_document = self.instance_model.elasticsearch_document()
+        self.apply_es_document(es_document)
 
+        if creator_id:
+            self.creator_id = creator_id
+
+        super(Product, self).save(*args, **kwargs)
+
+        product_saved.send(sender=self.__class__, product=self, es_document=es_document)
+
+    def apply_es_document(self, es_document):
+        # Updates the fields of the product derived from the Elasticsearch
+        # document of its instance model
         self.brand = Brand.objects.get_or_create(name=es_document[0]["brand_unicode"])[
             0
         ]
@@ -201,13 +250,6 @@ class Product(models.Model):
         else:
             self.sec_qr_codes = None
 
-        if creator_id:
-            self.creator_id = creator_id
-
-        super(Product, self).save(*args, **kwargs)
-
-        product_saved.send(sender=self.__class__, product=self, es_document=es_document)
-
     def delete(self, *args, **kwargs):
         raise Exception(
             "Delete should not be called on product instances, "
@@ -250,22 +292,24 @@ class Product(models.Model):
 
         return bucket_products
 
+    @staticmethod
+    def query_es_search_terms(search):
+        return [term.lower() for term in re.split(r"\W+", search.strip()) if term]
+
     @staticmethod
     def query_es_by_search_string(search, mode="OR"):
         from elasticsearch_dsl import Q
 
-        search = search.strip()
+        search_terms = Product.query_es_search_terms(search)
 
-        if not search:
+        if not search_terms:
             return Q()
 
-        search_terms = [term.lower() for term in re.split(r"\W+", search)]
         search_query = None
         for search_term in search_terms:
-            keywords_term_query = Q("wildcard", keywords="*{}*".format(search_term))
-            name_term_query = Q(
-                "wildcard",
-                name_analyzed={"value": "*{}*".format(search_term), "boost": 3.0},
+            keywords_term_query = EsProduct.substring_query("keywords", search_term)
+            name_term_query = EsProduct.substring_query(
+                "name_analyzed", search_term, boost=3.0
             )
 
             if search_query:
@@ -285,15 +329,14 @@ class Product(models.Model):
     def query_es_by_name(search, mode="OR"):
         from elasticsearch_dsl import Q
 
-        search = search.strip()
+        search_terms = Product.query_es_search_terms(search)
 
-        if not search:
+        if not search_terms:
             return Q()
 
-        search_terms = [term.lower() for term in re.split(r"\W+", search)]
         search_query = None
         for search_term in search_terms:
-            name_term_query = Q("wildcard", name_analyzed="*{}*".format(search_term))
+            name_term_query = EsProduct.substring_query("name_analyzed", search_term)
 
             if search_query:
                 if mode == "OR":
@@ -498,10 +541,15 @@ class Product(models.Model):
         )[0]
 
     def fuse(self, target_product):
-        from .entity import Entity
+        from .es_entity import EsEntity
 
         # Transfers all related objects that point to this product to the
         # target, then deletes self
+        with EsEntity.deferred_sync():
+            self._fuse(target_product)
+
+    def _fuse(self, target_product):
+        from .entity import Entity
 
         self.productpricealert_set.update(product=target_product)
         self.product_1.update(product_1=target_product)
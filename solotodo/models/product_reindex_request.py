@@ -0,0 +1,91 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models, transaction
+
+from .product import Product
+
+# Cache key set while a run of the process_product_reindex_requests task is
+# scheduled, used to debounce the task
+REINDEX_SCHEDULED_CACHE_KEY = "product_reindex_scheduled"
+
+
+class ProductReindexRequestQuerySet(models.QuerySet):
+    def enqueue(self, product_ids):
+        """
+        Registers the given products for reindexing and schedules the
+        process_product_reindex_requests task to run once the debounce
+        window (settings.PRODUCT_REINDEX_DEBOUNCE_SECONDS) ends, unless
+        it is already scheduled. Products that are already pending are
+        not duplicated.
+        """
+        from solotodo.tasks import process_product_reindex_requests
+
+        product_ids = set(product_ids)
+
+        if not product_ids:
+            return
+
+        self.bulk_create(
+            [self.model(product_id=product_id) for product_id in product_ids],
+            ignore_conflicts=True,
+        )
+
+        debounce_seconds = settings.PRODUCT_REINDEX_DEBOUNCE_SECONDS
+
+        if cache.add(REINDEX_SCHEDULED_CACHE_KEY, True, timeout=debounce_seconds):
+            transaction.on_commit(
+                lambda: process_product_reindex_requests.apply_async(
+                    countdown=debounce_seconds
+                ),
+                using=self.db,
+            )
+
+    def process(self, chunk_size=100):
+        """
+        Reindexes the pending products in chunks (see
+        ProductQuerySet.reindex) until there are no more requests.
+        """
+        # Any product enqueued from now on schedules a new run
+        cache.delete(REINDEX_SCHEDULED_CACHE_KEY)
+
+        while True:
+            # The requests are claimed (deleted) before reindexing, so
+            # the products edited meanwhile are enqueued again
+            with transaction.atomic(using=self.db):
+                product_ids = list(
+                    self.select_for_update(skip_locked=True)
+                    .order_by("creation_date")
+                    .values_list("product_id", flat=True)[:chunk_size]
+                )
+                self.filter(product_id__in=product_ids).delete()
+
+            if not product_ids:
+                return
+
+            try:
+                Product.objects.filter(pk__in=product_ids).reindex(chunk_size)
+            except Exception:
+                self.enqueue(product_ids)
+                raise
+
+
+class ProductReindexRequest(models.Model):
+    """
+    Product pending to be reindexed in Elasticsearch because one of the
+    instance models its document depends on changed (see the
+    update_related_products receiver).
+    """
+
+    product = models.OneToOneField(
+        Product, on_delete=models.CASCADE, primary_key=True
+    )
+    creation_date = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    objects = ProductReindexRequestQuerySet.as_manager()
+
+    def __str__(self):
+        return str(self.product_id)
+
+    class Meta:
+        app_label = "solotodo"
+        ordering = ("creation_date",)
@@ -1,11 +1,14 @@
 import json
 import io
 import base64
+import shutil
+import tempfile
 import traceback
 
 import xlsxwriter
 from django.contrib.auth.models import Group
 from django.core.cache import cache
+from django.core.files import File
 from django.core.files.base import ContentFile
 from django.db import models
 from django.db.models import Q
@@ -63,6 +66,60 @@ class StoreQuerySet(models.QuerySet):
         return self.filter(pk__in=store_ids)
 
 
+class ScrapingRecord:
+    """
+    Keeps the availability counters and the JSON record of the products of
+    a store update while they are being consumed, so the full list of
+    scraped products never needs to be kept in memory.
+    """
+
+    def __init__(self, categories, discovery_urls_without_products):
+        self.categories = categories
+        self.discovery_urls_without_products = discovery_urls_without_products
+        self.available_products_count = 0
+        self.unavailable_products_count = 0
+        self.products_file = tempfile.TemporaryFile()
+        self.products_written = 0
+
+    def track(self, scraped_products, write_products=True):
+        for scraped_product in scraped_products:
+            if scraped_product.is_available():
+                self.available_products_count += 1
+            else:
+                self.unavailable_products_count += 1
+
+            if write_products:
+                if self.products_written:
+                    self.products_file.write(b",\n")
+                self.products_file.write(
+                    json.dumps(scraped_product.serialize(), indent=4).encode("utf-8")
+                )
+                self.products_written += 1
+
+            yield scraped_product
+
+    def file(self):
+        # Returns the full scraping record in the same format used by
+        # Store.update_pricing_from_json
+        self.products_file.seek(0)
+
+        header = {
+            "categories": [c.storescraper_name for c in self.categories],
+            "discovery_urls_without_products": self.discovery_urls_without_products,
+        }
+        serialized_header = json.dumps(header, indent=4)
+
+        output = tempfile.TemporaryFile()
+        output.write(serialized_header[:-2].encode("utf-8"))
+        output.write(b',\n    "products": [\n')
+        shutil.copyfileobj(self.products_file, output)
+        output.write(b"\n    ]\n}")
+        output.seek(0)
+        self.products_file.close()
+
+        return File(output)
+
+
 class Store(models.Model):
     name = models.CharField(max_length=255, db_index=True, unique=True)
     country = models.ForeignKey(Country, on_delete=models.CASCADE)
@@ -108,6 +165,7 @@ class Store(models.Model):
         use_async=None,
         update_log=None,
         extra_args=None,
+        batch_size=None,
     ):
         assert self.last_activation is not None
 
@@ -167,25 +225,27 @@ class Store(models.Model):
             scraped_products_data["products"],
             scraped_products_data["discovery_urls_without_products"],
             update_log=update_log,
+            batch_size=batch_size,
         )
 
-    def update_pricing_from_json(self, json_data, update_log=None):
+    def update_pricing_from_json(self, json_data, update_log=None, batch_size=None):
         assert self.last_activation is not None
 
         categories = Category.objects.filter(
             storescraper_name__in=json_data["categories"]
         )
 
-        products = [
+        products = (
             StorescraperProduct.deserialize(product)
             for product in json_data["products"]
-        ]
+        )
 
         self.update_with_scraped_products(
             categories,
             products,
             json_data["discovery_urls_without_products"],
             update_log=update_log,
+            batch_size=batch_size,
         )
 
     def update_with_scraped_products(
@@ -194,11 +254,66 @@ class Store(models.Model):
         scraped_products,
         discovery_urls_without_products,
         update_log=None,
+        batch_size=None,
     ):
-        from solotodo.models import Currency, Entity
+        # If batch_size is given the scraped products are consumed in chunks
+        # by the bulk ScrapedProductsIngestor, otherwise the entities are
+        # updated one by one. In both cases the Elasticsearch documents of
+        # the updated entities are synchronized in bulk at the end.
+        # scraped_products may be a lazy iterable (e.g. a generator), it is
+        # only consumed once.
+        from solotodo.models import EsEntity
 
         assert self.last_activation is not None
 
+        scraping_record = ScrapingRecord(categories, discovery_urls_without_products)
+        scraped_products = scraping_record.track(
+            scraped_products, write_products=bool(update_log)
+        )
+
+        with EsEntity.deferred_sync():
+            if batch_size:
+                from solotodo.scraped_products_ingestor import (
+                    ScrapedProductsIngestor,
+                )
+
+                ingestor = ScrapedProductsIngestor(
+                    self, categories, batch_size=batch_size
+                )
+                ingestor.ingest_all(scraped_products)
+            else:
+                self._update_with_scraped_products_one_by_one(
+                    categories, scraped_products
+                )
+
+        print("Done")
+
+        if update_log:
+            update_log.status = update_log.SUCCESS
+            update_log.available_products_count = (
+                scraping_record.available_products_count
+            )
+            update_log.unavailable_products_count = (
+                scraping_record.unavailable_products_count
+            )
+            update_log.discovery_urls_without_products_count = len(
+                discovery_urls_without_products
+            )
+
+            storage = PrivateS3Boto3Storage()
+
+            desired_filename = "logs/scrapings/{}_{}.json".format(
+                self,
+                timezone.localtime(update_log.creation_date).strftime("%Y-%m-%d_%X"),
+            )
+            real_filename = storage.save(desired_filename, scraping_record.file())
+            update_log.registry_file = real_filename
+
+            update_log.save()
+
+    def _update_with_scraped_products_one_by_one(self, categories, scraped_products):
+        from solotodo.models import Currency, Entity
+
         print("1")
         scraped_products_dict = iterable_to_dict(scraped_products, "key")
         print("2")
@@ -242,40 +357,6 @@ class Store(models.Model):
                 sections_dict,
             )
 
-        print("Done")
-
-        if update_log:
-            update_log.status = update_log.SUCCESS
-            update_log.available_products_count = len(
-                list(filter(lambda x: x.is_available(), scraped_products))
-            )
-            update_log.unavailable_products_count = len(
-                list(filter(lambda x: not x.is_available(), scraped_products))
-            )
-            update_log.discovery_urls_without_products_count = len(
-                discovery_urls_without_products
-            )
-
-            serialized_scraping_info = {
-                "categories": [c.storescraper_name for c in categories],
-                "discovery_urls_without_products": discovery_urls_without_products,
-                "products": [p.serialize() for p in scraped_products],
-            }
-
-            storage = PrivateS3Boto3Storage()
-            scraping_record_file = ContentFile(
-                json.dumps(serialized_scraping_info, indent=4).encode("utf-8")
-            )
-
-            desired_filename = "logs/scrapings/{}_{}.json".format(
-                self,
-                timezone.localtime(update_log.creation_date).strftime("%Y-%m-%d_%X"),
-            )
-            real_filename = storage.save(desired_filename, scraping_record_file)
-            update_log.registry_file = real_filename
-
-            update_log.save()
-
     def scraper_categories(self):
         return Category.objects.filter(storescraper_name__in=self.scraper.categories())
 
@@ -309,7 +390,13 @@ class Store(models.Model):
         return sanitized_categories
 
     def check_and_fill_active_registries(self):
-        from solotodo.models import Entity, EntityHistory, StoreUpdateLog
+        from solotodo.models import (
+            Entity,
+            EntityDailyPrice,
+            EntityHistory,
+            EsEntity,
+            StoreUpdateLog,
+        )
 
         success = 3
         today = timezone.now().date()
@@ -321,26 +408,44 @@ class Store(models.Model):
         if logs:
             return
 
-        entities = Entity.objects.filter(store=self, active_registry__isnull=False)
+        entities = list(
+            Entity.objects.filter(
+                store=self, active_registry__isnull=False
+            ).select_related("active_registry")
+        )
+
+        new_registries = []
 
         for entity in entities:
             current_eh = entity.active_registry
 
-            new_eh = EntityHistory.objects.create(
-                entity=entity,
-                timestamp=timezone.now(),
-                stock=current_eh.stock,
-                normal_price=current_eh.normal_price,
-                offer_price=current_eh.offer_price,
-                cell_monthly_payment=current_eh.cell_monthly_payment,
-                picture_count=current_eh.picture_count,
-                video_count=current_eh.video_count,
-                review_count=current_eh.review_count,
-                review_avg_score=current_eh.review_avg_score,
+            new_registries.append(
+                EntityHistory(
+                    entity=entity,
+                    timestamp=timezone.now(),
+                    stock=current_eh.stock,
+                    normal_price=current_eh.normal_price,
+                    offer_price=current_eh.offer_price,
+                    cell_monthly_payment=current_eh.cell_monthly_payment,
+                    picture_count=current_eh.picture_count,
+                    video_count=current_eh.video_count,
+                    review_count=current_eh.review_count,
+                    review_avg_score=current_eh.review_avg_score,
+                )
             )
 
+        EntityHistory.objects.copy_create(new_registries)
+        EntityDailyPrice.objects.register(new_registries)
+
+        now = timezone.now()
+        for entity, new_eh in zip(entities, new_registries):
             entity.active_registry = new_eh
-            entity.save()
+            entity.last_updated = now
+
+        with EsEntity.deferred_sync():
+            Entity.objects.bulk_update(
+                entities, ["active_registry", "last_updated"], batch_size=1000
+            )
 
     def update_banners(self):
         from banners.models import (
@@ -0,0 +1,399 @@
+import datetime
+import logging
+import re
+
+from django.utils import timezone
+
+# Errors are mailed to the admins (see LOGGING), as the inserts into the
+# partitioned tables depend on their partitions being created in time
+logger = logging.getLogger(__name__)
+
+# Tables partitioned by month using PostgreSQL native range partitioning
+# over their "timestamp" column (see migration 0089)
+PARTITIONED_TABLES = [
+    "solotodo_entityhistory",
+    "solotodo_entitysectionposition",
+]
+
+PARTITION_KEY = "timestamp"
+
+
+def month_start(value):
+    """
+    Returns the start of the (UTC) month of the given date or datetime.
+    Partition boundaries are always the first instant of a UTC month.
+    """
+    if isinstance(value, datetime.datetime):
+        if timezone.is_aware(value):
+            value = value.astimezone(datetime.timezone.utc)
+        return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+    return value.replace(day=1)
+
+
+def add_months(value, months):
+    month_index = value.month - 1 + months
+    return value.replace(
+        year=value.year + month_index // 12, month=month_index % 12 + 1, day=1
+    )
+
+
+def partition_name(table, month):
+    return "{}_p{:04d}{:02d}".format(table, month.year, month.month)
+
+
+def legacy_partition_name(table):
+    return "{}_legacy".format(table)
+
+
+def default_partition_name(table):
+    return "{}_default".format(table)
+
+
+def partition_key_index_name(table):
+    # Unique (id, timestamp) index of the original table, attached to the
+    # primary key of the partitioned table when converting it. It can be
+    # created beforehand with CREATE UNIQUE INDEX CONCURRENTLY (see
+    # convert_to_partitioned_table)
+    return "{}_id_timestamp_uniq".format(table)
+
+
+def referencing_fields(model):
+    """
+    Returns the foreign keys (model fields) pointing to the given model.
+    Unlike Options.related_objects this includes the hidden relations
+    (related_name="+", e.g. Entity.active_registry) and the foreign keys
+    of the many to many through tables, which are the ones the deletion
+    collector follows too.
+    """
+    return [
+        relation.field
+        for relation in model._meta.get_fields(include_hidden=True)
+        if relation.auto_created
+        and not relation.concrete
+        and not relation.many_to_many
+    ]
+
+
+def referencing_columns(model):
+    # (table, column) pairs of the foreign keys pointing to the given model
+    return [
+        (field.model._meta.db_table, field.column)
+        for field in referencing_fields(model)
+    ]
+
+
+def get_referenced_partition_tables(cursor, name, model, kept_from):
+    """
+    Returns the tables with rows pointing to the rows of the given
+    partition of the table of model. Rows of partitioned tables older than
+    kept_from are ignored, as their partitions are removed along with this
+    one (their timestamp is the one of the row they point to).
+    """
+    referenced_from = []
+
+    for table, column in referencing_columns(model):
+        query = "SELECT EXISTS (SELECT 1 FROM {} ref JOIN {} p ON ref.{} = p.id".format(
+            _quote(table), _quote(name), _quote(column)
+        )
+        params = []
+
+        if table in PARTITIONED_TABLES:
+            query += " WHERE ref.{} >= %s".format(_quote(PARTITION_KEY))
+            params.append(kept_from)
+
+        cursor.execute(query + ")", params)
+        if cursor.fetchone()[0]:
+            referenced_from.append(table)
+
+    return referenced_from
+
+
+def get_partitions(cursor, table):
+    """
+    Returns a list of (partition_name, upper_bound) tuples of the given
+    partitioned table. upper_bound is a UTC datetime or None for the
+    partitions bounded by MAXVALUE and the DEFAULT partition.
+    """
+    cursor.execute(
+        "SELECT child.relname, pg_get_expr(child.relpartbound, child.oid) "
+        "FROM pg_inherits "
+        "JOIN pg_class parent ON pg_inherits.inhparent = parent.oid "
+        "JOIN pg_class child ON pg_inherits.inhrelid = child.oid "
+        "WHERE parent.relname = %s ORDER BY child.relname",
+        [table],
+    )
+
+    partitions = []
+    for name, bound in cursor.fetchall():
+        match = re.search(r"TO \('([^']+)'\)", bound)
+        if match:
+            # PostgreSQL renders UTC offsets as +00, without minutes
+            upper_bound = datetime.datetime.fromisoformat(
+                re.sub(r"([+-]\d\d)$", r"\1:00", match.group(1))
+            )
+            if timezone.is_naive(upper_bound):
+                upper_bound = upper_bound.replace(tzinfo=datetime.timezone.utc)
+        else:
+            upper_bound = None
+        partitions.append((name, upper_bound))
+
+    return partitions
+
+
+def create_default_partition(cursor, table):
+    """
+    Creates the DEFAULT partition of the given table if it doesn't exist
+    yet, holding the rows without a monthly partition so that the inserts
+    don't fail if the upcoming partitions weren't created in time. Its
+    rows are moved to the partition of their month when it's created
+    (see create_partition). Returns True if it was created.
+    """
+    name = default_partition_name(table)
+    cursor.execute("SELECT to_regclass(%s)", [name])
+    if cursor.fetchone()[0]:
+        return False
+
+    cursor.execute(
+        "CREATE TABLE {} PARTITION OF {} DEFAULT".format(_quote(name), _quote(table))
+    )
+    return True
+
+
+def create_partition(cursor, table, month):
+    """
+    Creates the partition of the given month if it doesn't exist yet.
+    Returns None if it already existed, otherwise the number of rows of
+    the month moved into it from the DEFAULT partition, which are the ones
+    inserted while the partition was missing.
+    """
+    name = partition_name(table, month)
+    cursor.execute("SELECT to_regclass(%s)", [name])
+    if cursor.fetchone()[0]:
+        return None
+
+    bounds = [month, add_months(month, 1)]
+    default_name = default_partition_name(table)
+    cursor.execute("SELECT to_regclass(%s)", [default_name])
+    has_default = bool(cursor.fetchone()[0])
+    moved_rows = 0
+
+    if has_default:
+        cursor.execute(
+            "SELECT EXISTS (SELECT 1 FROM {} WHERE {key} >= %s AND {key} < %s)".format(
+                _quote(default_name), key=_quote(PARTITION_KEY)
+            ),
+            bounds,
+        )
+        has_default = cursor.fetchone()[0]
+
+    if has_default:
+        # PostgreSQL refuses to create a partition while the DEFAULT one
+        # holds rows of its range, so the DEFAULT partition is detached
+        # until they are moved
+        cursor.execute(
+            "ALTER TABLE {} DETACH PARTITION {}".format(
+                _quote(table), _quote(default_name)
+            )
+        )
+
+    cursor.execute(
+        "CREATE TABLE {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s)".format(
+            _quote(name), _quote(table)
+        ),
+        bounds,
+    )
+
+    if has_default:
+        cursor.execute(
+            "WITH moved AS (DELETE FROM {default} WHERE {key} >= %s AND "
+            "{key} < %s RETURNING *) INSERT INTO {name} SELECT * FROM moved".format(
+                default=_quote(default_name),
+                name=_quote(name),
+                key=_quote(PARTITION_KEY),
+            ),
+            bounds,
+        )
+        moved_rows = cursor.rowcount
+        cursor.execute(
+            "ALTER TABLE {} ATTACH PARTITION {} DEFAULT".format(
+                _quote(table), _quote(default_name)
+            )
+        )
+
+    return moved_rows
+
+
+def detach_partition(cursor, table, name, drop=False):
+    cursor.execute(
+        "ALTER TABLE {} DETACH PARTITION {}".format(_quote(table), _quote(name))
+    )
+
+    if drop:
+        cursor.execute("DROP TABLE {}".format(_quote(name)))
+
+
+def convert_to_partitioned_table(cursor, table, boundary):
+    """
+    Converts the given regular table into a table partitioned by month.
+    The existing table is renamed and attached as its "legacy" partition,
+    holding every row before boundary (which must be the start of a
+    month), so no data is copied. Indexes, checks and outgoing foreign
+    keys are recreated on the partitioned table, reusing the ones of the
+    legacy partition. Foreign keys pointing to the table must be dropped
+    beforehand, as PostgreSQL can't enforce them against a partitioned
+    table whose primary key is (id, timestamp).
+
+    Attaching the legacy partition requires a unique (id, timestamp) index
+    on it for the primary key. If it doesn't exist it's built here, over
+    the whole table and while holding its lock, so on big tables create
+    it beforehand (outside of the migration) with:
+
+        CREATE UNIQUE INDEX CONCURRENTLY <partition_key_index_name(table)>
+        ON <table> (id, "timestamp");
+
+    The range CHECK constraint that lets the attach skip its own scan is
+    also validated with a full (but read only) scan of the table.
+    """
+    legacy_table = legacy_partition_name(table)
+    key_index_name = partition_key_index_name(table)
+
+    cursor.execute(
+        "SELECT conrelid::regclass::text FROM pg_constraint "
+        "WHERE contype = 'f' AND confrelid = %s::regclass",
+        [table],
+    )
+    referencing_tables = [row[0] for row in cursor.fetchall()]
+    if referencing_tables:
+        raise RuntimeError(
+            "Foreign keys to {} must be dropped before partitioning it "
+            "(referenced from {})".format(table, ", ".join(referencing_tables))
+        )
+
+    cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+    sequence = cursor.fetchone()[0]
+    if not sequence:
+        raise RuntimeError(
+            "{}.id is expected to be a serial column backed by a "
+            "sequence".format(table)
+        )
+
+    cursor.execute(
+        "SELECT index_class.relname, pg_get_indexdef(index_class.oid) "
+        "FROM pg_index "
+        "JOIN pg_class index_class ON pg_index.indexrelid = index_class.oid "
+        "WHERE pg_index.indrelid = %s::regclass AND NOT pg_index.indisprimary",
+        [table],
+    )
+    indexes = []
+    has_key_index = False
+    for index_name, definition in cursor.fetchall():
+        if index_name == key_index_name:
+            has_key_index = True
+        else:
+            indexes.append((index_name, definition))
+
+    cursor.execute(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE contype = 'f' AND conrelid = %s::regclass",
+        [table],
+    )
+    foreign_keys = cursor.fetchall()
+
+    cursor.execute(
+        "SELECT conname FROM pg_constraint "
+        "WHERE contype = 'p' AND conrelid = %s::regclass",
+        [table],
+    )
+    primary_key_name = cursor.fetchone()[0]
+
+    # Index names are unique per schema, so the ones of the legacy table
+    # are renamed to allow the partitioned table to keep the original names
+    cursor.execute(
+        "ALTER TABLE {} RENAME TO {}".format(_quote(table), _quote(legacy_table))
+    )
+    cursor.execute(
+        "ALTER TABLE {} RENAME CONSTRAINT {} TO {}".format(
+            _quote(legacy_table),
+            _quote(primary_key_name),
+            _quote(_legacy_name(primary_key_name)),
+        )
+    )
+    for index_name, _ in indexes:
+        cursor.execute(
+            "ALTER INDEX {} RENAME TO {}".format(
+                _quote(index_name), _quote(_legacy_name(index_name))
+            )
+        )
+
+    cursor.execute(
+        "CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+        "PARTITION BY RANGE ({})".format(
+            _quote(table), _quote(legacy_table), _quote(PARTITION_KEY)
+        )
+    )
+    cursor.execute(
+        "ALTER SEQUENCE {} OWNED BY {}.id".format(sequence, _quote(table))
+    )
+    cursor.execute(
+        "ALTER TABLE {} ADD CONSTRAINT {} PRIMARY KEY (id, {})".format(
+            _quote(table), _quote(primary_key_name), _quote(PARTITION_KEY)
+        )
+    )
+    for constraint_name, definition in foreign_keys:
+        cursor.execute(
+            "ALTER TABLE {} ADD CONSTRAINT {} {}".format(
+                _quote(table), _quote(constraint_name), definition
+            )
+        )
+
+    # Otherwise ATTACH PARTITION builds it implicitly
+    if not has_key_index:
+        cursor.execute(
+            "CREATE UNIQUE INDEX {} ON {} (id, {})".format(
+                _quote(key_index_name), _quote(legacy_table), _quote(PARTITION_KEY)
+            )
+        )
+
+    # A validated check constraint avoids the full scan of the legacy
+    # table when attaching it
+    cursor.execute(
+        "ALTER TABLE {table} ADD CONSTRAINT {constraint} "
+        "CHECK ({key} IS NOT NULL AND {key} < %s) NOT VALID".format(
+            table=_quote(legacy_table),
+            constraint=_quote("{}_range_check".format(legacy_table)),
+            key=_quote(PARTITION_KEY),
+        ),
+        [boundary],
+    )
+    cursor.execute(
+        "ALTER TABLE {} VALIDATE CONSTRAINT {}".format(
+            _quote(legacy_table), _quote("{}_range_check".format(legacy_table))
+        )
+    )
+    cursor.execute(
+        "ALTER TABLE {} ATTACH PARTITION {} "
+        "FOR VALUES FROM (MINVALUE) TO (%s)".format(
+            _quote(table), _quote(legacy_table)
+        ),
+        [boundary],
+    )
+
+    # Creating the indexes on the partitioned table attaches the equivalent
+    # existing indexes of the legacy partition instead of building them
+    for index_name, definition in indexes:
+        match = re.search(r"USING .*$", definition)
+        cursor.execute(
+            "CREATE INDEX {} ON {} {}".format(
+                _quote(index_name), _quote(table), match.group(0)
+            )
+        )
+
+
+def _legacy_name(name):
+    # Keeps the name within PostgreSQL's 63 characters limit
+    return "{}_legacy".format(name[:56])
+
+
+def _quote(name):
+    return '"{}"'.format(name)
@@ -0,0 +1,208 @@
+import threading
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from celery.signals import task_postrun, task_prerun
+from dateutil.parser import isoparse
+from django.conf import settings
+from elasticsearch.exceptions import NotFoundError
+
+# Fields of the EsProduct documents used by Product.specs and
+# Product.keywords, last_updated is their version
+SOURCE_FIELDS = ["specs", "keywords", "last_updated"]
+
+
+class ProductSpecsCache:
+    """
+    Per process LRU cache of the Elasticsearch documents of the products.
+    A cached document is only used while its last_updated matches the one
+    of the product, which changes every time the document is rewritten
+    (see Product.save and ProductQuerySet.reindex).
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, product):
+        if not product.last_updated:
+            return None
+
+        with self.lock:
+            try:
+                version, entry = self.entries[product.id]
+            except KeyError:
+                return None
+
+            if version != product.last_updated:
+                del self.entries[product.id]
+                return None
+
+            self.entries.move_to_end(product.id)
+            return entry
+
+    def set(self, product_id, entry):
+        try:
+            version = isoparse(entry["last_updated"])
+        except (KeyError, TypeError, ValueError):
+            return
+
+        with self.lock:
+            self.entries[product_id] = (version, entry)
+            self.entries.move_to_end(product_id)
+
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+cache = ProductSpecsCache(settings.PRODUCT_SPECS_CACHE_SIZE)
+
+
+def fetch_entries(product_ids):
+    """
+    Returns a dict of product id => Elasticsearch document (SOURCE_FIELDS
+    only) of the given products using one mget request. Products without
+    a document are omitted.
+    """
+    from solotodo.models import EsProduct
+
+    if not product_ids:
+        return {}
+
+    response = EsProduct._get_connection().mget(
+        index=EsProduct._index._name,
+        body={"ids": ["PRODUCT_{}".format(product_id) for product_id in product_ids]},
+        _source_includes=SOURCE_FIELDS,
+    )
+
+    result = {}
+    for product_id, doc in zip(product_ids, response["docs"]):
+        if doc.get("found"):
+            result[product_id] = doc["_source"]
+            cache.set(product_id, doc["_source"])
+
+    return result
+
+
+def load_entries(products):
+    """
+    Sets the Elasticsearch document of the given products (see
+    Product.specs) using the cache and one mget for the rest of them.
+    """
+    missing_products = {}
+
+    for product in products:
+        entry = cache.get(product)
+        if entry:
+            product._es_entry = entry
+        else:
+            missing_products.setdefault(product.id, []).append(product)
+
+    entries = fetch_entries(list(missing_products))
+
+    for product_id, entry in entries.items():
+        for product in missing_products[product_id]:
+            product._es_entry = entry
+
+
+class ProductSpecsLoader:
+    """
+    Request or task scoped loader of the Elasticsearch documents of the
+    products. Keeps track of the products instantiated in its scope, so
+    when the specs of one of them are read those of the other pending
+    ones (e.g. the rest of the products being serialized) are fetched
+    with the same mget.
+    """
+
+    BATCH_SIZE = 500
+
+    def __init__(self):
+        # Product id => weak references to the instances whose document
+        # hasn't been loaded, in registration order. Weak so that the
+        # scope doesn't keep alive every product instantiated in it
+        self.pending = OrderedDict()
+
+    def register(self, product):
+        product_refs = [
+            product_ref
+            for product_ref in self.pending.pop(product.id, [])
+            if product_ref() is not None
+        ]
+        product_refs.append(weakref.ref(product))
+        self.pending[product.id] = product_refs
+
+        # A load only takes BATCH_SIZE products, so only the most recently
+        # registered ones are kept. Otherwise scopes that instantiate many
+        # products without reading their specs (e.g. reindexing the whole
+        # catalog in a task) would accumulate them
+        while len(self.pending) > self.BATCH_SIZE:
+            self.pending.popitem(last=False)
+
+    def load(self, product):
+        batch = [product]
+        self.pending.pop(product.id, None)
+
+        while self.pending and len(batch) < self.BATCH_SIZE:
+            _, product_refs = self.pending.popitem(last=False)
+            for product_ref in product_refs:
+                pending_product = product_ref()
+                if pending_product is not None and pending_product._es_entry is None:
+                    batch.append(pending_product)
+
+        load_entries(batch)
+
+        if product._es_entry is None:
+            raise NotFoundError(
+                404, "PRODUCT_{} not found in Elasticsearch".format(product.id)
+            )
+
+        return product._es_entry
+
+
+_current_loader = ContextVar("product_specs_loader", default=None)
+
+
+def register_product(product):
+    loader = _current_loader.get()
+    if loader:
+        loader.register(product)
+
+
+def load_product_entry(product):
+    loader = _current_loader.get() or ProductSpecsLoader()
+    return loader.load(product)
+
+
+@contextmanager
+def product_specs_scope():
+    token = _current_loader.set(ProductSpecsLoader())
+    try:
+        yield
+    finally:
+        _current_loader.reset(token)
+
+
+_task_tokens = {}
+
+
+@task_prerun.connect
+def enter_task_scope(task_id=None, **kwargs):
+    _task_tokens[task_id] = _current_loader.set(ProductSpecsLoader())
+
+
+@task_postrun.connect
+def exit_task_scope(task_id=None, **kwargs):
+    token = _task_tokens.pop(task_id, None)
+    if token:
+        try:
+            _current_loader.reset(token)
+        except ValueError:
+            # The task ran in a different context
+            _current_loader.set(None)
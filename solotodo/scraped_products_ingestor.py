@@ -0,0 +1,242 @@
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+
+from solotodo.models import (
+    Category,
+    Currency,
+    Entity,
+    EntityDailyPrice,
+    EntityHistory,
+    EntityLog,
+    EntitySectionPosition,
+    StoreSection,
+)
+from solotodo.utils import iterable_to_dict
+
+
+class ScrapedProductsIngestor:
+    """
+    Batched alternative to calling Entity.update_with_scraped_product and
+    Entity.create_from_scraped_product once per scraped product.
+
+    The scraped products are deduplicated by key and then ingested in
+    chunks (see ingest). Each chunk is diffed in memory against the
+    matching store entities and the resulting histories, section
+    positions, entity updates and logs are written using bulk_create /
+    bulk_update. Once every chunk has been
+    ingested, finish deactivates the entities of the updated categories
+    that were not part of the scraping. The resulting data is the same as
+    the one generated by the per-entity methods.
+    """
+
+    DEFAULT_BATCH_SIZE = 1000
+
+    def __init__(self, store, categories, batch_size=None):
+        self.store = store
+        self.categories = categories
+        self.batch_size = batch_size or self.DEFAULT_BATCH_SIZE
+
+        self.categories_dict = iterable_to_dict(Category, "storescraper_name")
+        self.currencies_dict = iterable_to_dict(Currency, "iso_code")
+        self.sections_dict = iterable_to_dict(store.sections.all(), "name")
+        self.user = get_user_model().get_bot()
+
+        self.seen_entity_ids = set()
+
+    def ingest_all(self, scraped_products):
+        # Consumes the (possibly lazy) iterable of scraped products, ingests
+        # them in chunks of batch_size and then runs the final sweep. As
+        # with the per-entity methods the last occurrence of a duplicated key
+        # wins, so the whole scraping is deduplicated before writing anything
+        # to have a single registry per entity regardless of the batch size.
+        scraped_products = list(iterable_to_dict(scraped_products, "key").values())
+
+        for i in range(0, len(scraped_products), self.batch_size):
+            self.ingest(scraped_products[i : i + self.batch_size])
+
+        self.finish()
+
+    def ingest(self, scraped_products):
+        # Upserts the entities of the given chunk of scraped products. The
+        # last occurrence of a duplicated key within the chunk wins, the
+        # chunks are expected not to share keys (see ingest_all).
+        scraped_products_dict = iterable_to_dict(scraped_products, "key")
+
+        if not scraped_products_dict:
+            return
+
+        self._create_missing_sections(scraped_products_dict.values())
+
+        entities_to_be_updated = self.store.entity_set.filter(
+            key__in=scraped_products_dict.keys()
+        ).select_related()
+
+        entities_with_scraped_products = []
+        for entity in entities_to_be_updated:
+            entities_with_scraped_products.append(
+                (entity, scraped_products_dict.pop(entity.key))
+            )
+
+        if entities_with_scraped_products:
+            self.update_entities(entities_with_scraped_products)
+
+        if scraped_products_dict:
+            self.create_entities(list(scraped_products_dict.values()))
+
+    def finish(self):
+        # Deactivates the active entities of the updated categories that
+        # were not found in any of the ingested chunks
+        candidate_entity_ids = self.store.entity_set.filter(
+            category__in=self.categories, active_registry__isnull=False
+        ).values_list("id", flat=True)
+
+        unseen_entity_ids = [
+            entity_id
+            for entity_id in candidate_entity_ids
+            if entity_id not in self.seen_entity_ids
+        ]
+
+        for i in range(0, len(unseen_entity_ids), self.batch_size):
+            entities = Entity.objects.filter(
+                pk__in=unseen_entity_ids[i : i + self.batch_size]
+            ).select_related()
+            self.update_entities([(entity, None) for entity in entities])
+
+    def update_entities(self, entities_with_scraped_products):
+        # Receives a list of (entity, scraped_product) pairs, scraped_product
+        # may be None if the entity was not found in the scraping
+        new_registries = {}
+        extended_registries = []
+
+        for entity, scraped_product in entities_with_scraped_products:
+            if not scraped_product:
+                continue
+
+            extensible_registry = entity.extensible_registry(scraped_product)
+
+            if extensible_registry:
+                extensible_registry.last_seen = scraped_product.timestamp
+                extended_registries.append(extensible_registry)
+                new_registries[entity.id] = extensible_registry
+            else:
+                new_registries[entity.id] = EntityHistory.from_scraped_product(
+                    entity, scraped_product
+                )
+
+        EntityHistory.objects.copy_create(
+            registry
+            for registry in new_registries.values()
+            if registry.last_seen is None
+        )
+        EntityHistory.objects.bulk_update(extended_registries, ["last_seen"])
+        EntityDailyPrice.objects.register(new_registries.values())
+
+        section_positions = []
+        entity_logs = []
+        entities_by_update_fields = {}
+        now = timezone.now()
+
+        for entity, scraped_product in entities_with_scraped_products:
+            self.seen_entity_ids.add(entity.id)
+            new_active_registry = new_registries.get(entity.id)
+
+            if scraped_product:
+                category = self.categories_dict[scraped_product.category]
+                currency = self.currencies_dict[scraped_product.currency]
+                section_positions.extend(
+                    self._section_positions(scraped_product, new_active_registry)
+                )
+            else:
+                category = None
+                currency = None
+
+            updated_data = entity.scraped_product_updated_data(
+                scraped_product, category, currency, new_active_registry
+            )
+            update_fields = entity.dirty_fields_for_update(updated_data)
+
+            entity_log = entity.apply_updated_data(updated_data, self.user)
+            if entity_log:
+                entity_logs.append(entity_log)
+
+            if not update_fields:
+                entity._skip_es_sync = False
+                continue
+
+            if "last_updated" in update_fields:
+                # bulk_update does not refresh auto_now fields
+                entity.last_updated = now
+
+            entities_by_update_fields.setdefault(tuple(update_fields), []).append(
+                entity
+            )
+
+        EntitySectionPosition.objects.bulk_create(section_positions)
+
+        # Entities are grouped by their changed fields so that each UPDATE
+        # only writes the columns that actually changed
+        for update_fields, entities in entities_by_update_fields.items():
+            try:
+                Entity.objects.bulk_update(entities, update_fields)
+            finally:
+                for entity in entities:
+                    entity._skip_es_sync = False
+
+        EntityLog.objects.bulk_create(entity_logs)
+
+    def create_entities(self, scraped_products):
+        new_entities = []
+
+        for scraped_product in scraped_products:
+            new_entities.append(
+                Entity.from_scraped_product(
+                    scraped_product,
+                    self.store,
+                    self.categories_dict[scraped_product.category],
+                    self.currencies_dict[scraped_product.currency],
+                )
+            )
+
+        Entity.objects.bulk_create(new_entities)
+        self.seen_entity_ids.update(entity.id for entity in new_entities)
+
+        new_registries = [
+            EntityHistory.from_scraped_product(entity, scraped_product)
+            for entity, scraped_product in zip(new_entities, scraped_products)
+        ]
+
+        EntityHistory.objects.copy_create(new_registries)
+        EntityDailyPrice.objects.register(new_registries)
+
+        section_positions = []
+        for entity, registry, scraped_product in zip(
+            new_entities, new_registries, scraped_products
+        ):
+            entity.active_registry = registry
+            section_positions.extend(
+                self._section_positions(scraped_product, registry)
+            )
+
+        Entity.objects.bulk_update(new_entities, ["active_registry"])
+        EntitySectionPosition.objects.bulk_create(section_positions)
+
+    def _create_missing_sections(self, scraped_products):
+        for scraped_product in scraped_products:
+            for section_name, _ in scraped_product.positions:
+                if section_name not in self.sections_dict:
+                    self.sections_dict[section_name] = (
+                        StoreSection.objects.get_or_create(
+                            store=self.store, name=section_name
+                        )[0]
+                    )
+
+    def _section_positions(self, scraped_product, entity_history):
+        return [
+            EntitySectionPosition(
+                section=self.sections_dict[section_name],
+                entity_history=entity_history,
+                value=position_value,
+                timestamp=entity_history.timestamp,
+            )
+            for section_name, position_value in scraped_product.positions
+        ]
@@ -20,6 +20,7 @@ def store_update(
     use_async=None,
     update_log_id=None,
     extra_args=None,
+    batch_size=None,
 ):
     store = Store.objects.get(pk=store_id)
 
@@ -64,11 +65,12 @@ def store_update(
         use_async=use_async,
         update_log=update_log,
         extra_args=extra_args,
+        batch_size=batch_size,
     )
 
 
 @shared_task(queue="store_update")
-def store_update_pricing_from_json(store_id, json_data):
+def store_update_pricing_from_json(store_id, json_data, batch_size=None):
     store = Store.objects.get(pk=store_id)
 
     update_log = StoreUpdateLog.objects.create(store=store)
@@ -77,7 +79,9 @@ def store_update_pricing_from_json(store_id, json_data):
         Category.objects.filter(storescraper_name__in=json_data["categories"])
     )
 
-    store.update_pricing_from_json(json_data, update_log=update_log)
+    store.update_pricing_from_json(
+        json_data, update_log=update_log, batch_size=batch_size
+    )
 
 
 @shared_task(queue="general", ignore_result=True)
@@ -85,29 +89,65 @@ def product_save(product_id):
     Product.objects.get(pk=product_id).save()
 
 
+@shared_task(queue="general", ignore_result=True)
+def process_product_reindex_requests():
+    from solotodo.models import ProductReindexRequest
+
+    ProductReindexRequest.objects.process()
+
+
+@shared_task(queue="general", ignore_result=True)
+def update_es_product_discounts(product_ids):
+    from solotodo.models import EsProduct
+
+    EsProduct.update_discounts(product_ids)
+
+
+@shared_task(queue="general", ignore_result=True)
+def update_es_entity_usd_prices(currency_id):
+    from solotodo.models import Currency, EsEntity, EsProduct
+
+    # The exchange rate is read when the task runs, so if it changed again
+    # meanwhile the latest one is used
+    currency = Currency.objects.get(pk=currency_id)
+    EsEntity.update_usd_prices(currency.id, currency.exchange_rate)
+
+    # The discounts of the products are in USD
+    product_ids = set(
+        Entity.objects.filter(currency=currency, product__isnull=False)
+        .values_list("product", flat=True)
+        .distinct()
+    )
+    EsProduct.update_discounts(product_ids)
+
+
 @shared_task(queue="general", ignore_result=True)
 def entity_save(entity_id):
     Entity.objects.get(pk=entity_id).save()
 
 
 @shared_task(queue="general", ignore_result=True)
-def es_leads_index():
-    from solotodo.models import Lead
-    from solotodo.es_models.es_lead import EsLead
+def manage_history_partitions():
+    # Scheduled by CELERY_BEAT_SCHEDULE to keep the upcoming monthly
+    # partitions created, detaching the old ones is left to be done by hand.
+    # Until the partitions are created the new rows end up in the DEFAULT
+    # partitions, so failures are reported to the admins.
+    from django.core.management import call_command
 
-    bucket_count = Lead.objects.count() // 5000
+    from solotodo.partitioning import logger
 
-    for i in range(bucket_count):
-        offset = i * 5000
-        print("{} de {}".format(i, bucket_count))
+    try:
+        call_command("manage_history_partitions")
+    except Exception:
+        logger.exception("The history partitions could not be created")
+        raise
 
-        lead_ids = [
-            x["id"] for x in Lead.objects.all()[offset : offset + 5000].values("id")
-        ]
 
-        leads = Lead.objects.filter(pk__in=lead_ids)
+@shared_task(queue="general", ignore_result=True)
+def es_leads_index(start_after_id=0):
+    from solotodo.es_models.es_lead import EsLead
 
-        EsLead.create_from_db_leads(leads)
+    EsLead.backfill(start_after_id=start_after_id)
 
 
 @shared_task(queue="general", ignore_result=True)
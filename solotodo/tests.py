@@ -0,0 +1,212 @@
+from django.test import SimpleTestCase
+from elasticsearch.helpers import bulk
+from elasticsearch_dsl import MultiSearch, Q
+
+from solotodo.es_stand_in import local_elasticsearch
+from solotodo.models import EsEntity, EsProduct
+
+# product id => (default bucket, brand)
+PRODUCTS = {
+    1: (10, "Lenovo"),
+    2: (10, "HP"),
+    3: (30, "Lenovo"),
+    4: (40, "Asus"),
+}
+
+# (entity id, product id, store id, country id, offer price, reference
+# offer price), the USD prices are the same as the local ones
+ENTITIES = [
+    (101, 1, 1, 1, 500, 600),
+    (102, 1, 2, 1, 450, 450),
+    (103, 1, 3, 2, 300, 400),
+    (201, 2, 1, 1, 400, 420),
+    (301, 3, 2, 1, 700, 700),
+    (302, 3, 3, 2, 650, 900),
+    (401, 4, 3, 2, 100, 150),
+]
+
+
+class LocalElasticsearchTestCase(SimpleTestCase):
+    """
+    Regression tests of the product browsing and indexing queries, run
+    against the in-process Elasticsearch stand-in (see
+    solotodo.es_stand_in).
+    """
+
+    def setUp(self):
+        self.es = self.enterContext(local_elasticsearch())
+        EsEntity._index.create()
+
+        # Indexed with bulk actions, like the batch indexers do, as saving
+        # the entities schedules the update of the discounts
+        documents = [
+            EsProduct(
+                product_id=product_id,
+                name="Product {}".format(product_id),
+                name_analyzed="Product {}".format(product_id),
+                keywords="Notebook {}".format(brand),
+                specs={"default_bucket": bucket, "brand_unicode": brand},
+                product_relationships="product",
+                meta={"id": "PRODUCT_{}".format(product_id)},
+            )
+            for product_id, (bucket, brand) in PRODUCTS.items()
+        ]
+
+        for (
+            entity_id,
+            product_id,
+            store_id,
+            country_id,
+            offer_price,
+            reference_offer_price,
+        ) in ENTITIES:
+            documents.append(
+                EsEntity(
+                    entity_id=entity_id,
+                    product_id=product_id,
+                    store_id=store_id,
+                    country_id=country_id,
+                    currency_id=country_id,
+                    offer_price=offer_price,
+                    offer_price_usd=offer_price,
+                    offer_price_usd_with_coupon=offer_price,
+                    reference_offer_price=reference_offer_price,
+                    reference_offer_price_usd=reference_offer_price,
+                    product_relationships={
+                        "name": "entity",
+                        "parent": "PRODUCT_{}".format(product_id),
+                    },
+                    meta={
+                        "id": "ENTITY_{}".format(entity_id),
+                        "routing": "PRODUCT_{}".format(product_id),
+                    },
+                )
+            )
+
+        bulk(
+            self.es,
+            [
+                dict(document.to_dict(include_meta=True), _index=EsEntity._index._name)
+                for document in documents
+            ],
+            refresh=True,
+        )
+
+    def browse_search(self, store_ids):
+        # Products with entities in the given stores, sorted by the
+        # minimum offer price of those entities (see ProductsBrowseForm)
+        entities_filter = Q("terms", store_id=store_ids)
+        query = Q(
+            "function_score",
+            script_score={"script": "doc['offer_price_usd_with_coupon'].value"},
+            query=Q("bool", filter=entities_filter, must=Q()),
+        )
+
+        return (
+            EsProduct.search()
+            .query(
+                "has_child",
+                type="entity",
+                query=query,
+                score_mode="min",
+                inner_hits={
+                    "name": "pricing_entities",
+                    "size": 100,
+                    "_source": False,
+                    "docvalue_fields": ["offer_price_usd_with_coupon"],
+                    "sort": [{"offer_price_usd_with_coupon": "asc"}],
+                },
+            )
+            .sort({"_score": "asc"})
+        )
+
+    def test_browse(self):
+        response = self.browse_search([1, 2])[:10].execute()
+
+        self.assertEqual(
+            [(hit.product_id, hit.meta.score) for hit in response],
+            [(2, 400), (1, 450), (3, 700)],
+        )
+        self.assertEqual(response.hits.total.value, 3)
+
+    def test_has_child_inner_hits(self):
+        response = self.browse_search([1, 2, 3])[:10].execute().to_dict()
+        product_1_hit = next(
+            hit for hit in response["hits"]["hits"] if hit["_id"] == "PRODUCT_1"
+        )
+        entity_hits = product_1_hit["inner_hits"]["pricing_entities"]["hits"]
+
+        self.assertEqual(entity_hits["total"]["value"], 3)
+        self.assertEqual(
+            [hit["_id"] for hit in entity_hits["hits"]],
+            ["ENTITY_103", "ENTITY_102", "ENTITY_101"],
+        )
+        self.assertEqual(
+            entity_hits["hits"][0]["fields"]["offer_price_usd_with_coupon"], [300]
+        )
+
+    def test_collapse(self):
+        search = self.browse_search([1, 2, 3]).update_from_dict(
+            {
+                "collapse": {
+                    "field": "specs.default_bucket",
+                    "inner_hits": {
+                        "name": "inner_products",
+                        "size": 5,
+                        "sort": {"_score": "asc"},
+                    },
+                }
+            }
+        )
+        response = search[:10].execute().to_dict()
+
+        self.assertEqual(
+            [
+                (
+                    hit["fields"]["specs.default_bucket"],
+                    [
+                        inner_hit["_source"]["product_id"]
+                        for inner_hit in hit["inner_hits"]["inner_products"][
+                            "hits"
+                        ]["hits"]
+                    ],
+                )
+                for hit in response["hits"]["hits"]
+            ],
+            [([40], [4]), ([10], [1, 2]), ([30], [3])],
+        )
+
+    def test_aggregations(self):
+        search = self.browse_search([1, 2, 3])[:0]
+        search.aggs.bucket("entity_prices", "children", type="entity").metric(
+            "offer_price_usd", "stats", field="offer_price_usd_with_coupon"
+        )
+        search.aggs.bucket("brands", "terms", field="specs.brand_unicode").metric(
+            "result_count", "cardinality", field="specs.default_bucket"
+        )
+
+        (response,) = MultiSearch().add(search).execute()
+        aggregations = response.to_dict()["aggregations"]
+
+        entity_prices = aggregations["entity_prices"]["offer_price_usd"]
+        self.assertEqual(entity_prices["count"], 7)
+        self.assertEqual(entity_prices["min"], 100)
+        self.assertEqual(entity_prices["max"], 700)
+        self.assertEqual(
+            {
+                bucket["key"]: (bucket["doc_count"], bucket["result_count"]["value"])
+                for bucket in aggregations["brands"]["buckets"]
+            },
+            {"Lenovo": (2, 2), "HP": (1, 1), "Asus": (1, 1)},
+        )
+
+    def test_discounts(self):
+        self.assertEqual(
+            list(EsProduct.discounts(page_size=2)),
+            [
+                (1, 100.0, {"1": 0.0, "2": 100.0}),
+                (2, 20.0, {"1": 20.0}),
+                (3, 50.0, {"1": 0.0, "2": 250.0}),
+                (4, 50.0, {"2": 50.0}),
+            ],
+        )
@@ -43,6 +43,7 @@ from solotodo.filters import (
     ProductFilterSet,
     UserFilterSet,
     EntityHistoryFilterSet,
+    EntityDailyPriceFilterSet,
     StoreFilterSet,
     LeadFilterSet,
     EntityEstimatedSalesFilterSet,
@@ -97,6 +98,7 @@ from solotodo.models import (
     Website,
     Lead,
     EntityHistory,
+    EntityDailyPrice,
     Visit,
     Rating,
     ProductPicture,
@@ -421,7 +423,9 @@ class CategoryViewSet(PermissionReadOnlyModelViewSet):
 
         result = form.get_category_products(request, category)
 
-        return Response(result)
+        response = Response(result)
+        response["Server-Timing"] = form.server_timing()
+        return response
 
     @action(detail=True)
     def full_browse(self, request, pk, *args, **kwargs):
@@ -1053,7 +1057,7 @@ class EntityViewSet(viewsets.ReadOnlyModelViewSet):
             request=request,
         )
         serializer = serializer_klass(
-            filterset.qs, many=True, context={"request": request}
+            filterset.expanded_qs(), many=True, context={"request": request}
         )
         return Response(serializer.data)
 
@@ -1076,7 +1080,7 @@ class EntityViewSet(viewsets.ReadOnlyModelViewSet):
             request=request,
         )
         serializer = serializer_klass(
-            filterset.qs, many=True, context={"request": request}
+            filterset.expanded_qs(), many=True, context={"request": request}
         )
         return Response(serializer.data)
 
@@ -1293,7 +1297,10 @@ class ProductViewSet(LoggingMixin, viewsets.ReadOnlyModelViewSet):
             return Response(form.errors, status=status.HTTP_400_BAD_REQUEST)
 
         result = form.get_category_products(request)
-        return Response(result)
+
+        response = Response(result)
+        response["Server-Timing"] = form.server_timing()
+        return response
 
     @action(detail=True)
     def entities(self, request, pk):
@@ -1332,28 +1339,38 @@ class ProductViewSet(LoggingMixin, viewsets.ReadOnlyModelViewSet):
     @action(detail=True)
     def min_history_price(self, request, pk):
         product = self.get_object()
-        entity_histories = EntityHistory.objects.filter(
+        daily_prices = EntityDailyPrice.objects.filter(
             entity__product=product,
             entity__condition="https://schema.org/NewCondition",
-            cell_monthly_payment__isnull=True,
-        ).exclude(stock=0)
+            min_cell_monthly_payment__isnull=True,
+            is_available=True,
+        )
 
-        filterset = EntityHistoryFilterSet(
-            request.query_params, entity_histories, request=request
+        filterset = EntityDailyPriceFilterSet(
+            request.query_params, daily_prices, request=request
         )
 
-        min_price = filterset.qs.aggregate(Min("offer_price"))["offer_price__min"]
+        min_price = filterset.qs.aggregate(Min("available_min_offer_price"))[
+            "available_min_offer_price__min"
+        ]
 
         stores_aggs = (
-            filterset.qs.filter(offer_price__exact=min_price)
+            filterset.qs.filter(available_min_offer_price__exact=min_price)
             .values("entity__store")
-            .annotate(max_timestamp=Max("timestamp"))
+            .annotate(max_timestamp=Max("available_min_offer_price_timestamp"))
             .order_by("entity__store")
         )
+        timestamp_range = filterset.form.cleaned_data.get("timestamp")
 
         stores_data = []
 
         for agg in stores_aggs:
+            max_timestamp = agg["max_timestamp"]
+
+            # Compressed registries may have been seen after the range
+            if timestamp_range and timestamp_range.stop:
+                max_timestamp = min(max_timestamp, timestamp_range.stop)
+
             stores_data.append(
                 {
                     "store": reverse(
@@ -1361,7 +1378,7 @@ class ProductViewSet(LoggingMixin, viewsets.ReadOnlyModelViewSet):
                         kwargs={"pk": agg["entity__store"]},
                         request=request,
                     ),
-                    "timestamp": agg["max_timestamp"],
+                    "timestamp": max_timestamp,
                 }
             )
 
@@ -1385,7 +1402,7 @@ class ProductViewSet(LoggingMixin, viewsets.ReadOnlyModelViewSet):
         )
 
         histories_by_entity = OrderedDict()
-        for entity_history in entity_histories:
+        for entity_history in filterset.expanded_qs(entity_histories):
             if entity_history.entity not in histories_by_entity:
                 histories_by_entity[entity_history.entity] = [entity_history]
             else:
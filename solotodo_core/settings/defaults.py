@@ -17,6 +17,7 @@ from datetime import timedelta
 from decimal import Decimal
 
 
+from celery.schedules import crontab
 from elasticsearch import Elasticsearch
 from elasticsearch_dsl import connections  # noqa
 
@@ -109,6 +110,7 @@ MIDDLEWARE = [
     "querycount.middleware.QueryCountMiddleware",
     "solotodo.middleware.CacheControlMiddleware",
     "solotodo.middleware.CrawlerMiddleware",
+    "solotodo.middleware.ProductSpecsLoaderMiddleware",
     "metamodel.middleware.CacheControlMiddleware",
 ]
 
@@ -242,6 +244,11 @@ LOGGING = {
             "level": "ERROR",
             "propagate": True,
         },
+        "solotodo.partitioning": {
+            "handlers": ["mail_admins", "console"],
+            "level": "ERROR",
+            "propagate": True,
+        },
         "werkzeug": {
             "handlers": ["console"],
             "level": "DEBUG",
@@ -267,6 +274,16 @@ CELERY_IMPORTS = "storescraper.store"
 
 CELERYD_TIME_LIMIT = 300
 
+CELERY_BEAT_SCHEDULE = {
+    # Inserts into EntityHistory / EntitySectionPosition go to the DEFAULT
+    # partition if the one of their month doesn't exist. Requires celery beat
+    # to be running (see start_celery_workers.sh)
+    "manage-history-partitions": {
+        "task": "solotodo.tasks.manage_history_partitions",
+        "schedule": crontab(hour=3, minute=0),
+    },
+}
+
 ##############################################################################
 # Django storages configuration
 ##############################################################################
@@ -402,6 +419,37 @@ CELL_CATEGORY = 6
 CELL_PLAN_CATEGORY = 20
 GROCERIES_CATEGORY_ID = 120
 
+# If True, scrapings that find an entity unchanged extend the validity
+# interval (EntityHistory.last_seen) of its active registry instead of
+# creating a new one
+ENTITY_HISTORY_COMPRESSION = False
+
+# Cold tier archive of old EntityHistory / EntitySectionPosition rows (see
+# solotodo.history_archive). The storage setting is the dotted path of a
+# callable returning a Django storage (S3 or local filesystem)
+HISTORY_ARCHIVE_STORAGE = "solotodo_core.s3utils.PrivateS3Boto3Storage"
+HISTORY_ARCHIVE_LOCATION = "entity_history_archive"
+HISTORY_ARCHIVE_AFTER_DAYS = 90
+
+# Products affected by an instance model change are reindexed in batches
+# by a task scheduled this amount of seconds after the first change, so
+# the changes made meanwhile are coalesced
+PRODUCT_REINDEX_DEBOUNCE_SECONDS = 30
+
+# Number of product Elasticsearch documents (specs and keywords) cached by
+# every process, see solotodo.product_specs_loader
+PRODUCT_SPECS_CACHE_SIZE = 10000
+
+# Seconds the discount updates of a product Elasticsearch document are
+# debounced for after the documents of its entities change
+ES_PRODUCT_DISCOUNT_UPDATE_DELAY = 10
+
+# Throttling of the update_by_query that recalculates the USD prices of the
+# entity Elasticsearch documents when an exchange rate changes, and seconds
+# between its progress reports
+ES_USD_PRICES_UPDATE_REQUESTS_PER_SECOND = 1000
+ES_USD_PRICES_UPDATE_POLL_INTERVAL = 10
+
 METAMODEL = {
     "DEBUG": False,
     "ADDITIONAL_ELASTICSEARCH_FIELDS_FUNCTIONS": [
@@ -1,2 +1,5 @@
 #!/usr/bin/env sh
 env/bin/celery -A solotodo_core multi start store_update general reports storescraper -Q:store_update store_update -c:store_update 3 -Q:general general -c:general 10 -Q:reports reports -c:reports 4 -Q:storescraper storescraper -c:storescraper 20 --logfile=solotodo_core/logs/celery/%n.log --pidfile=solotodo_core/pids/celery/%n.pid -l info
+# Runs the periodic tasks of CELERY_BEAT_SCHEDULE (e.g. the creation of the
+# history partitions)
+env/bin/celery -A solotodo_core beat --detach --schedule=solotodo_core/pids/celery/beat-schedule --logfile=solotodo_core/logs/celery/beat.log --pidfile=solotodo_core/pids/celery/beat.pid -l info
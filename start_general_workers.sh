@@ -4,3 +4,6 @@ source ~/.zshrc
 cd "${0%/*}"
 source env/bin/activate
 celery multi start -A solotodo_core store_update general reports -Q:store_update store_update -c:store_update 5 -Q:general general -c:general 12 -Q:reports reports -c:reports 5 --logfile=solotodo_core/logs/celery/%n.log --pidfile=solotodo_core/pids/celery/%n.pid -E -l info
+# Runs the periodic tasks of CELERY_BEAT_SCHEDULE (e.g. the creation of the
+# history partitions)
+celery -A solotodo_core beat --detach --schedule=solotodo_core/pids/celery/beat-schedule --logfile=solotodo_core/logs/celery/beat.log --pidfile=solotodo_core/pids/celery/beat.pid -l info
@@ -1,2 +1,3 @@
 #!/usr/bin/env sh
-env/bin/celery -A solotodo_core multi stopwait store_update general reports storescraper --pidfile=solotodo_core/pids/celery/%n.pid --logfile=solotodo_core/logs/celery/%n.log -l info
\ No newline at end of file
+env/bin/celery -A solotodo_core multi stopwait store_update general reports storescraper --pidfile=solotodo_core/pids/celery/%n.pid --logfile=solotodo_core/logs/celery/%n.log -l info
+kill -TERM $(cat solotodo_core/pids/celery/beat.pid)
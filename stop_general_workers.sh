@@ -4,3 +4,4 @@ source ~/.zshrc
 cd "${0%/*}"
 source env/bin/activate
 celery multi stop -A solotodo_core store_update general reports --logfile=solotodo_core/logs/celery/%n.log --pidfile=solotodo_core/pids/celery/%n.pid -E -l info
+kill -TERM $(cat solotodo_core/pids/celery/beat.pid)
@@ -154,10 +154,8 @@ class StoreSubscription(models.Model):
         search_date_to = timezone.now() - timezone.timedelta(days=1)
         search_date_from = timezone.now() - timezone.timedelta(days=2)
         ehs = EntityHistory.objects \
-            .filter(
-                entity=entity,
-                timestamp__gte=search_date_from,
-                timestamp__lte=search_date_to) \
+            .filter(entity=entity) \
+            .filter_seen_between(search_date_from, search_date_to) \
             .order_by('-timestamp')
 
         if ehs: